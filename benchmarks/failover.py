@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+"""Failover benchmark.
+
+Drives the real loop of many members, Governor.run_once, in one process, against fake
+Postgres instances and the in-memory DCS running on a simulated clock, and reports
+failover latency percentiles, split-brain windows and round trips per cycle as JSON.
+
+    python -m benchmarks.failover --members 3 10 100 --runs 20 > results.json
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+
+import psycopg2
+
+from governor import Governor, topology
+from governor.dcs import Member
+from governor.ha import Ha
+from governor.memory import Client, SimulatedClock, Store
+from governor.postgresql import Postgresql, State
+from governor.scheduler import Scheduler
+
+SCENARIOS = ('kill-leader', 'partition-leader', 'slow-peers')
+
+class FakePostgresql:
+    """Scriptable stand-in for Postgresql: LSNs, recovery state and injected latency.
+
+    Every call is counted as one round trip (a query or a fork of pg_ctl) and costs
+    `latency` simulated seconds of the current cycle.
+    """
+
+    PROBE_TIMEOUT = Postgresql.PROBE_TIMEOUT
+    needs_resync = False
+
+    def __init__(self, sim, name, maximum_lag):
+        self.sim = sim
+        self.name = name
+        self.config = argparse.Namespace(maximum_lag=maximum_lag)
+        self.running = False
+        self.in_recovery = True
+        self.upstream = None
+        self.lsn = 0
+        self.lag = 0
+        self.latency = 0.0
+        self.promoted = False
+        self.state = None
+        self.slots = set()
+        self.calls = collections.Counter()
+
+    def _call(self, method, query=True):
+        self.calls[method] += 1
+        self.sim.spend(self.latency)
+        if query and not self.running:
+            raise psycopg2.OperationalError('{} is not running'.format(self.name))
+
+    @property
+    def writable(self):
+        return self.running and not self.in_recovery
+
+    def is_healthy(self):
+        self._call('is_running', query=False)
+        return self.running
+
+    def write_recovery_conf(self, leader):
+        self.upstream = leader and leader.name
+
+    def start(self):
+        self._call('start', query=False)
+        self.running = True
+        self.in_recovery = True
+        return True
+
+    def is_leader(self):
+        self._call('is_leader')
+        if self.writable:
+            self.promoted = False
+        return self.writable
+
+    def promote(self):
+        self._call('promote', query=False)
+        if self.running and self.in_recovery:
+            self.in_recovery = False
+            self.promoted = True
+            self.sim.promoted(self)
+        return self.promoted
+
+    def follow_the_leader(self, leader):
+        upstream = leader and leader.name
+        if self.in_recovery and self.upstream == upstream:
+            return True
+        self._call('restart', query=False)
+        self.upstream = upstream
+        self.in_recovery = True
+        return True
+
+    def last_operation(self):
+        return self.xlog_position()
+
+    def xlog_position(self):
+        self._call('xlog_position')
+        return self.lsn
+
+    def collect_state(self):
+        try:
+            self._call('collect_state')
+        except psycopg2.Error:
+            self.state = None
+            return None
+        if self.writable:
+            self.promoted = False
+        self.state = State(self.in_recovery, None if self.in_recovery else self.lsn, self.lsn, self.lsn)
+        return self.state
+
+    def member_state(self):
+        return self.state.member_state() if self.state else {}
+
+    def probe_member(self, name, url, position):
+        peer = self.sim.members[name].psql
+        peer._call('probe')
+        return (peer.in_recovery, position - peer.lsn)
+
+    def is_healthiest_node(self, cluster, state=None):
+        return Postgresql.is_healthiest_node(self, cluster, state)
+
+    def sync_replication_slots(self, members):
+        # one statement, and only when the wanted slots differ from the existing ones
+        members = set(name for name in members if name != self.name)
+        if members != self.slots:
+            self._call('sync_replication_slots')
+            self.slots = members
+
+    def guard_replication_slots(self):
+        return []
+
+    def create_replication_slots(self, cluster, leader):
+        self.sync_replication_slots(topology.children(cluster, leader, self.name))
+
+    def drop_replication_slots(self):
+        self.sync_replication_slots([])
+
+    def set_synchronous_standbys(self, names):
+        # asynchronous, nothing to change
+        return False
+
+class SimulatedMember:
+
+    def __init__(self, sim, name):
+        self.sim = sim
+        self.name = name
+        self.dcs = Client(sim.store, ttl=sim.ttl)
+        self.psql = FakePostgresql(sim, name, sim.maximum_lag)
+        self.scheduler = Scheduler(sim.loop_time, sim.clock)
+        self.ha = Ha(self.psql, self.dcs, self.scheduler)
+        self.governor = self.build_governor()
+        self.alive = True
+        self.next_run = 0
+
+    def build_governor(self):
+        # the parts of a Governor its loop uses, without connecting to etcd or postgres
+        governor = Governor.__new__(Governor)
+        governor.name = governor.advertise_url = self.name
+        governor.api_address = governor.api = governor.heartbeat = None
+        governor.tags = {}
+        governor.dcs, governor.psql, governor.scheduler, governor.ha = self.dcs, self.psql, self.scheduler, self.ha
+        return governor
+
+    def cycle(self):
+        """Runs a cycle of the loop, and returns how long it waits for the next one."""
+        dcs_requests = sum(self.dcs.requests.values())
+        pg_calls = sum(self.psql.calls.values())
+        self.governor.run_once()
+        self.sim.cycles.append((sum(self.dcs.requests.values()) - dcs_requests,
+                                sum(self.psql.calls.values()) - pg_calls))
+        return self.scheduler.wait_time()
+
+class Simulation:
+    WATCH_DELAY = 0.01
+
+    def __init__(self, members, ttl, loop_time, watch=False, rate=1 << 20, maximum_lag=1 << 20, seed=None):
+        self.random = random.Random(seed)
+        self.clock = SimulatedClock()
+        self.store = Store(self.clock)
+        self.ttl = ttl
+        self.loop_time = loop_time
+        self.watch = watch
+        self.rate = rate
+        self.maximum_lag = maximum_lag
+
+        self.cost = 0.0
+        self.cycles = []
+        self.promotions = []
+        self.split_brain = 0.0
+        self.split_brain_windows = []
+        self._split_brain_start = None
+        self._seen_index = 0
+
+        self.members = collections.OrderedDict()
+        for i in range(members):
+            name = 'postgresql{}'.format(i)
+            self.members[name] = SimulatedMember(self, name)
+        self.bootstrap()
+
+    def bootstrap(self):
+        leader = next(iter(self.members.values()))
+        leader.dcs.init_cluster(leader.name)
+        leader.dcs.take_leadership(leader.name)
+        for m in self.members.values():
+            m.psql.running = True
+            m.psql.in_recovery = m is not leader
+            m.psql.upstream = None if m is leader else leader.name
+            m.psql.lag = self.random.randint(0, self.maximum_lag)
+            m.next_run = self.random.uniform(0, self.loop_time)
+            m.psql.collect_state()
+            member = Member(m.name, m.name, timestamp=0, **m.psql.member_state())
+            m.dcs.touch_member(m.name, member.to_value())
+
+    def spend(self, seconds):
+        self.cost += seconds
+
+    def promoted(self, psql):
+        self.promotions.append((self.clock.time() + self.cost, psql.name))
+
+    @property
+    def leader(self):
+        return next((m for m in self.members.values() if m.alive and m.psql.writable), None)
+
+    def advance(self, now):
+        dt = now - self.clock.time()
+        if dt <= 0:
+            return
+        writable = [m.psql for m in self.members.values() if m.psql.writable]
+        for psql in writable:
+            psql.lsn += int(self.rate * dt)
+        for m in self.members.values():
+            upstream = m.psql.upstream and self.members[m.psql.upstream].psql
+            if m.psql.running and m.psql.in_recovery and upstream and upstream.running:
+                m.psql.lsn = max(m.psql.lsn, upstream.lsn - m.psql.lag)
+
+        if len(writable) > 1:
+            self.split_brain += dt
+        self.clock.advance(dt)
+
+    def track_split_brain(self):
+        writable = sum(1 for m in self.members.values() if m.psql.writable)
+        now = self.clock.time()
+        if writable > 1 and self._split_brain_start is None:
+            self._split_brain_start = now
+        elif writable <= 1 and self._split_brain_start is not None:
+            if now > self._split_brain_start:
+                self.split_brain_windows.append(now - self._split_brain_start)
+            self._split_brain_start = None
+
+    def wake_watchers(self):
+        """Emulates --watch: members wake up shortly after the leader or the membership changes."""
+        events = [e for e in self.store.history if e.modifiedIndex > self._seen_index]
+        self._seen_index = self.store.index
+        if any(os.path.basename(e.key) != Client.OPTIME_KEY and e.action in ('expire', 'delete', 'compareAndDelete',
+               'create') for e in events):
+            wake = self.clock.time() + self.WATCH_DELAY
+            for m in self.members.values():
+                m.next_run = min(m.next_run, wake)
+
+    def next_expiry(self):
+        expiries = [expires for _, expires, _, _ in self.store.nodes.values() if expires is not None]
+        return min(expiries) if expiries else float('inf')
+
+    def step(self):
+        alive = [m for m in self.members.values() if m.alive]
+        member = min(alive, key=lambda m: m.next_run)
+        if self.watch and self.next_expiry() < member.next_run:
+            self.advance(self.next_expiry())
+            self.store.read('')
+            self.wake_watchers()
+            return
+
+        self.advance(member.next_run)
+        self.cost = 0.0
+        wait_time = member.cycle()
+        member.next_run = self.clock.time() + self.cost + wait_time
+        self.track_split_brain()
+        if self.watch:
+            self.wake_watchers()
+
+    def run_until(self, deadline, condition=lambda: False):
+        while self.clock.time() < deadline and not condition():
+            self.step()
+
+    def run_scenario(self, scenario):
+        self.run_until(3 * self.ttl)
+        old = self.leader
+        if scenario == 'partition-leader':
+            old.dcs.partitioned = True
+        else:
+            if scenario == 'slow-peers':
+                replicas = [m for m in self.members.values() if m is not old]
+                for m in self.random.sample(replicas, len(replicas) // 2):
+                    m.psql.latency = self.random.uniform(0.5, 2 * self.loop_time)
+            old.alive = False
+            old.psql.running = False
+
+        killed_at = self.clock.time()
+        del self.cycles[:]
+        self.promotions = []
+        self.split_brain = 0.0
+        self.split_brain_windows = []
+
+        self.run_until(killed_at + 10 * self.ttl, lambda: any(name != old.name for _, name in self.promotions))
+        failover = next((t - killed_at for t, name in self.promotions if name != old.name), None)
+        # keep running for a while to catch split brain after the promotion
+        self.run_until(self.clock.time() + 2 * self.loop_time)
+        return failover
+
+def percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {'p{}'.format(p): values[min(len(values) - 1, int(len(values) * p / 100))] for p in points}
+    result['max'] = values[-1]
+    result['mean'] = sum(values) / len(values)
+    return result
+
+def benchmark(scenario, members, runs, ttl, loop_time, watch, seed):
+    failovers, failed, split_brain, windows, dcs, pg = [], 0, [], [], [], []
+    for run in range(runs):
+        sim = Simulation(members, ttl, loop_time, watch=watch, seed=None if seed is None else seed + run)
+        failover = sim.run_scenario(scenario)
+        if failover is None:
+            failed += 1
+        else:
+            failovers.append(failover)
+        split_brain.append(sim.split_brain)
+        windows.extend(sim.split_brain_windows)
+        dcs.extend(c[0] for c in sim.cycles)
+        pg.extend(c[1] for c in sim.cycles)
+
+    return {
+        'scenario': scenario,
+        'members': members,
+        'runs': runs,
+        'ttl': ttl,
+        'loop_time': loop_time,
+        'watch': watch,
+        'failover_latency': percentiles(failovers),
+        'failed_failovers': failed,
+        'split_brain_seconds': percentiles(split_brain),
+        'split_brain_windows': len(windows),
+        'dcs_requests_per_cycle': percentiles(dcs),
+        'postgres_round_trips_per_cycle': percentiles(pg),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Failover benchmark against fake Postgres and an in-memory DCS')
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--members', nargs='+', type=int, default=[3, 10, 50])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--ttl', type=float, default=30)
+    parser.add_argument('--loop-time', type=float, default=10)
+    parser.add_argument('--watch', action='store_true', help='emulate governor --watch')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = [benchmark(scenario, members, args.runs, args.ttl, args.loop_time, args.watch, args.seed)
+               for scenario in args.scenario for members in args.members]
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -8,24 +8,23 @@ import socket
 import argparse
 
 from governor import Governor
+from governor.supervisor import Supervisor
+from governor.trace import TRACER
 
 def sigterm_handler(signo, stack_frame):
     sys.exit()
 
-# handle SIGCHILD, since we are the equivalent of the INIT process
-def sigchld_handler(signo, stack_frame):
-    try:
-        while True:
-            ret = os.waitpid(-1, os.WNOHANG)
-            if ret == (0, 0):
-                break
-    except OSError:
-        pass
+def sigusr1_handler(signo, stack_frame):
+    logging.info('Trace of the last %s cycles: %s', len(TRACER.cycles), TRACER.dumps())
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
     signal.signal(signal.SIGTERM, sigterm_handler)
-    signal.signal(signal.SIGCHLD, sigchld_handler)
+    signal.signal(signal.SIGUSR1, sigusr1_handler)
+    # handle SIGCHLD, since we are the equivalent of the INIT process
+    supervisor = Supervisor()
+    supervisor.start_reaper()
+    signal.signal(signal.SIGCHLD, supervisor.handle_sigchld)
 
     parser = argparse.ArgumentParser(description='Postgresql node with self-registration on etcd')
     parser.add_argument('--name', default=socket.gethostname(),
@@ -36,11 +35,32 @@ if __name__ == '__main__':
                         help='URL to advertise to the rest of the cluster')
     parser.add_argument('--loop-time', default=10, type=int,
                         help='length of time (seconds) for each loop, until members re-register themselves')
+    parser.add_argument('--heartbeat', action='store_true',
+                        help='renew the member and leader keys from a separate thread, so that slow '
+                             'postgres calls in the HA loop do not cost the leader lock')
+    parser.add_argument('--health-timeout', type=int,
+                        help='with --heartbeat, stop renewing and demote when postgres did not answer a query '
+                             'for this many seconds (default: --etcd-ttl)')
+    parser.add_argument('--api-address', metavar='HOST:PORT',
+                        help='serve the /master, /replica and /health checks for haproxy on this address')
+    parser.add_argument('--replicate-from', metavar='NAME',
+                        help='stream from this member instead of the leader, as long as it is a replica '
+                             'with room in its --max-fanout')
+    parser.add_argument('--max-fanout', type=int,
+                        help='how many replicas may stream from this member; by default the leader takes any '
+                             'number and a replica none. Replicas which do not fit on the leader cascade from '
+                             'the replicas with room')
+    parser.add_argument('--watch', action='store_true',
+                        help='wake up as soon as the leader, initialize or a member key changes in etcd '
+                             'instead of sleeping for --loop-time')
 
     group = parser.add_argument_group('etcd')
     group.add_argument('--etcd-url', metavar='PROTOCOL://HOST:PORT',
                        default='http://127.0.0.1:4001',
                         help='url to etcd (default: http://127.0.0.1:4001)')
+    group.add_argument('--etcd-api', choices=('v2', 'v3'), default='v2',
+                       help='etcd API to use; v3 talks to the JSON gateway and keeps the member and '
+                            'leader keys alive with a single lease (default: v2)')
     group.add_argument('--etcd-prefix', default='/governor',
                        help='etcd key prefix (default: /governor)')
     group.add_argument('--etcd-ttl', type=int,
@@ -57,6 +77,31 @@ if __name__ == '__main__':
                        help='data directory for psql (default: $PGDATA)')
     group.add_argument('--maximum-lag', default=0,
                        help='the maximum bytes a follower may lag before it is not eligible become leader')
+    group.add_argument('--clone-max-lag', type=int, default=16 * 1024 * 1024,
+                       help='bootstrap new members from a replica lagging at most this many bytes behind the '
+                            'leader, the least loaded one, and from the leader only when there is none '
+                            '(default: 16MB)')
+    group.add_argument('--max-basebackups', type=int, default=0,
+                       help='how many members may clone at the same time across the cluster, the others queue '
+                            'up in etcd (default: no limit)')
+    group.add_argument('--max-basebackups-per-source', type=int, default=0,
+                       help='how many of them may clone from the same member (default: no limit)')
+    group.add_argument('--max-rate',
+                       help='maximum transfer rate of a clone, passed to pg_basebackup --max-rate, e.g. 100M')
+    group.add_argument('--max-slot-wal-keep', type=int, default=0,
+                       help='drop the replication slot of a replica which is not streaming once it retained more '
+                            'than this many bytes of WAL for --slot-grace-period; the slot is created again, so a '
+                            'replica back in time resumes and one too late needs cloning (default: no limit)')
+    group.add_argument('--slot-grace-period', type=int, default=300,
+                       help='seconds a slot may stay over --max-slot-wal-keep (default: 300)')
+    group.add_argument('--synchronous-standbys', type=int, default=0,
+                       help='make commits on the leader wait for this many standbys, the streaming ones with the '
+                            'least lag, and prefer them on failover; fewer when not enough are streaming, so that '
+                            'writes do not stall (default: 0, asynchronous)')
+    group.add_argument('--use-pg-rewind', action='store_true',
+                       help='rewind a node whose timeline diverged from the new leader instead of leaving it '
+                            'unable to stream, clone it again only if that fails; starts postgres with '
+                            'wal_log_hints=on')
 
     group = parser.add_argument_group('auth')
     group.add_argument('--user', default=os.environ.get('POSTGRES_USER', 'postgres'),
@@ -81,10 +126,12 @@ if __name__ == '__main__':
 
     if config.etcd_ttl is None:
         config.etcd_ttl = config.loop_time * 2
+    if config.health_timeout is None:
+        config.health_timeout = config.etcd_ttl
     if config.repl_allow_address is None:
         config.repl_allow_address = config.allow_address
 
-    gov = Governor(config, psql_config)
+    gov = Governor(config, psql_config, supervisor)
     try:
         gov.initialize(force_leader=config.force_leader)
         gov.run()
@@ -1,26 +1,66 @@
 import logging
 import time
 import os
-import subprocess as sp
+import psycopg2
 
+from governor.api import Api, Status
+from governor.dcs import Member, DCSError, AlreadyExists, CompareFailed, KeyNotFound
 from governor.etcd import Client as Etcd
+from governor.etcd3 import Client as Etcd3
 from governor.postgresql import Postgresql
 from governor.ha import Ha
+from governor import topology
+from governor.heartbeat import Heartbeat
+from governor.metrics import REGISTRY, Gauge
+from governor.scheduler import Scheduler
+from governor.semaphore import Semaphore
+from governor.supervisor import Supervisor
+from governor.trace import TRACER, span
 
-import etcd
+IS_LEADER = Gauge('governor_is_leader', 'Whether this node holds the leader lock with a writable postgres')
+XLOG_POSITION = Gauge('governor_xlog_position_bytes', 'Replayed, or on the leader written, WAL position')
+REPLICATION_LAG = Gauge('governor_replication_lag_bytes', 'How far the replayed WAL is behind the leader')
 
 class Governor:
     INIT_SCRIPT_DIR = '/docker-entrypoint-initdb.d'
 
-    def __init__(self, config, psql_config):
+    def __init__(self, config, psql_config, supervisor=None):
         self.advertise_url = config.advertise_url
+        self.api_address = config.api_address
+        self.tags = {}
+        if config.replicate_from:
+            self.tags['replicatefrom'] = config.replicate_from
+        if config.max_fanout is not None:
+            self.tags['fanout'] = config.max_fanout
         self.loop_time = config.loop_time
+        self.watch = config.watch
+        self.clone_max_lag = config.clone_max_lag
+        self.max_basebackups = config.max_basebackups
+        self.max_basebackups_per_source = config.max_basebackups_per_source
+        self.supervisor = supervisor or Supervisor()
 
-        self.connect_to_etcd(config)
-        self.psql = Postgresql(config, psql_config)
-        self.ha = Ha(self.psql, self.etcd)
+        self.connect_to_dcs(config)
+        self.psql = Postgresql(config, psql_config, self.supervisor)
+        self.scheduler = Scheduler(self.loop_time)
+        self.ha = Ha(self.psql, self.dcs, self.scheduler, config.synchronous_standbys)
+        # run the next cycle right away when postgres dies
+        self.psql.on_exit = self.ha.view.wake
+        self.psql.reclone = self.reclone
 
         self.name = self.psql.name
+        self.member = None
+        self._clone_source = None
+        self._progress_reported = 0
+        self.api = None
+        if config.api_address:
+            # answers turn stale once the loop did not run for a whole ttl
+            self.api = Api(config.api_address, self.name, self.dcs.ttl)
+            self.api.register('/metrics', self.metrics)
+            self.api.register('/trace', self.trace)
+        self.heartbeat = None
+        if config.heartbeat:
+            interval = min(self.loop_time, self.dcs.ttl / 3.0)
+            self.heartbeat = Heartbeat(self, interval, config.health_timeout)
 
     def run_init_scripts(self):
         # run all the scripts /docker-entrypoint-initdb.d/*.sh
@@ -31,26 +71,32 @@ class Governor:
             if not file.endswith('.sh') or not os.path.isfile(file):
                 continue
             logging.info('Running init script: %s', file)
-            if sp.call(['sh', file]) != 0:
+            if self.supervisor.call(['sh', file]) != 0:
                 logging.warn('Failed to run init script: %s', file)
 
-    def connect_to_etcd(self, config):
+    def connect_to_dcs(self, config):
         while True:
             logging.info('waiting on etcd')
             try:
-                self.etcd = Etcd(config)
-            except (ConnectionRefusedError, etcd.EtcdConnectionFailed) as e:
+                self.dcs = (Etcd3 if config.etcd_api == 'v3' else Etcd)(config)
+            except (ConnectionRefusedError, DCSError) as e:
                 logging.error('Error communicating with etcd: %s', e)
             else:
                 return
             time.sleep(5)
 
+    def update_member(self):
+        # the snapshot also feeds the decisions of the HA cycle which follows
+        self.ha.collect_state()
+        self.member = Member(self.name, self.advertise_url, timestamp=time.time(), load=round(os.getloadavg()[0], 1),
+                             api=self.api_address, tags=self.tags, ttl=self.dcs.ttl, **self.psql.member_state())
+
+    def touch_member(self, leader=False):
+        return self.ha.touch_member(self.member.to_value(), leader)
+
     def keep_alive(self):
-        value = self.advertise_url
-        try:
-            self.etcd.write_scoped(self.name, value, ttl=self.etcd.ttl, prevValue=value)
-        except etcd.EtcdKeyNotFound:
-            self.etcd.write_scoped(self.name, value, ttl=self.etcd.ttl, prevExist=False)
+        self.update_member()
+        self.ha.keep_alive(self.member.to_value())
 
     def initialize(self, force_leader=False):
         self.keep_alive()
@@ -64,30 +110,99 @@ class Governor:
 
     def init_cluster(self, force_leader=False):
         try:
-            self.etcd.init_cluster(self.name)
-        except etcd.EtcdAlreadyExist:
+            self.dcs.init_cluster(self.name)
+        except AlreadyExists:
             if not force_leader:
                 return False
         self.psql.initialize()
-        self.etcd.take_leadership(self.name, first = not force_leader)
+        self.dcs.take_leadership(self.name, force=force_leader)
         self.psql.start()
         self.psql.create_users()
         return True
 
+    def clone_source(self, cluster, exclude=()):
+        """Picks the member to clone from, the least loaded up to date replica if there is one.
+
+        Returns the member and the reason it was picked.
+        """
+        leader = cluster.leader
+        position = cluster.optime if cluster.optime is not None else leader.lsn
+        if position is None:
+            return leader, 'the position of the leader is not known'
+
+        candidates = []
+        for name, m in cluster.members.items():
+            if name in (self.name, leader.name) or name in exclude or not m.has_state:
+                continue
+            # only replicas which published a record lately and are streaming
+            if name in cluster.stale or not m.in_recovery or m.lsn is None or m.receive_lsn is None:
+                continue
+            lag = position - m.lsn
+            if lag <= self.clone_max_lag:
+                candidates.append((m.load if m.load is not None else float('inf'), lag, name, m))
+
+        if not candidates:
+            return leader, 'no replica is streaming within {} bytes of the leader'.format(self.clone_max_lag)
+        load, lag, name, source = min(candidates)
+        return source, 'replica with load {} lagging {} bytes behind the leader'.format(load, lag)
+
+    def report_clone_progress(self, progress):
+        # published about every third of the ttl, which also keeps the member key alive
+        now = time.time()
+        if now - self._progress_reported < self.dcs.ttl / 3.0:
+            return
+        self._progress_reported = now
+        try:
+            progress.wal_lag = self.psql.clone_wal_lag(self._clone_source)
+        except psycopg2.Error as e:
+            logging.debug('Could not measure the WAL lag of the clone: %s', e)
+        logging.info('Clone progress: %s', progress)
+        self.member = Member(self.name, self.advertise_url, timestamp=now, load=round(os.getloadavg()[0], 1),
+                             clone=progress.to_record(), api=self.api_address, tags=self.tags)
+        try:
+            self.touch_member()
+        except DCSError as e:
+            logging.error('Could not publish the clone progress: %s', e)
+
+    def clone(self, source):
+        self._clone_source = source
+        self._progress_reported = time.time()
+        if not self.max_basebackups:
+            return self.psql.sync_from_leader(source, self.report_clone_progress)
+
+        semaphore = Semaphore(self.dcs, 'basebackup', self.name, self.max_basebackups,
+                              self.max_basebackups_per_source)
+        semaphore.acquire(source.name)
+        try:
+            self._progress_reported = time.time()
+            return self.psql.sync_from_leader(source, self.report_clone_progress)
+        finally:
+            semaphore.release()
+
+    def reclone(self, upstream):
+        """Replaces the data directory which cannot follow `upstream` with a new clone."""
+        cluster = self.ha.cluster
+        if cluster and cluster.leader:
+            source, reason = self.clone_source(cluster)
+        else:
+            source, reason = upstream, 'the leader is not known'
+        logging.info('cloning from %s, %s', source.name, reason)
+        self.psql.remove_data_directory()
+        return self.clone(source)
+
     def sync_from_leader(self):
+        failed = set()
         while True:
             logging.info('resolving leader')
-            try:
-                cluster = self.etcd.get_cluster()
-            except etcd.EtcdKeyNotFound:
-                cluster = None
-
-            if cluster and cluster.leader:
-                logging.info('syncing with leader')
-                if self.psql.sync_from_leader(cluster.leader):
-                    self.psql.write_recovery_conf(cluster.leader)
+            cluster = self.ha.view.cluster()
+            if cluster.leader:
+                source, reason = self.clone_source(cluster, failed)
+                logging.info('cloning from %s, %s', source.name, reason)
+                if self.clone(source):
+                    self.psql.write_recovery_conf(topology.upstream(cluster, self.name))
                     self.psql.start()
                     return True
+                failed.add(source.name)
             time.sleep(5)
 
     def load_psql(self):
@@ -95,17 +210,54 @@ class Governor:
         if self.psql.is_running():
             self.psql.load_replication_slots()
 
+    def metrics(self):
+        return 200, {'Content-Type': 'text/plain; version=0.0.4'}, REGISTRY.render().encode('utf-8')
+
+    def trace(self):
+        return 200, {}, TRACER.dump()
+
     def run(self):
+        if self.api:
+            self.api.start()
+        if self.heartbeat:
+            self.heartbeat.start()
         while True:
-            self.keep_alive()
+            self.run_once()
+            # with --watch the scheduler only remains as the keep-alive deadline
+            self.ha.wait_for_change(self.scheduler.wait_time(), self.watch)
+
+    def run_once(self):
+        """One cycle of the HA loop, until it is time to wait for the next one."""
+        with TRACER.cycle(), self.ha.lock:
+            self.scheduler.start_cycle()
+            if self.heartbeat:
+                self.heartbeat.step_down_if_released()
+            with span('keep_alive'):
+                try:
+                    self.keep_alive()
+                except DCSError as e:
+                    # the cycle runs into the DCS as well, and demotes a leader which cannot reach it
+                    logging.error('Could not publish our record: %s', e)
             logging.info(self.ha.run_cycle())
-            self.ha.sync_replication_slots()
-            time.sleep(self.loop_time)
+            self.ha.refresh_state()
+            if not self.ha.switchover:
+                # postgres is stopped for part of a switchover, and the replicas stay put meanwhile
+                self.ha.sync_replication_slots()
+                self.ha.update_synchronous_standbys()
+            status = Status.from_ha(self.ha)
+            IS_LEADER.set(int(status.role == 'master'))
+            XLOG_POSITION.set(status.lsn or 0)
+            REPLICATION_LAG.set(status.lag or 0)
+            if self.api:
+                self.api.status = status
+            self.scheduler.end_cycle()
 
     def cleanup(self):
+        if self.heartbeat:
+            self.heartbeat.stop()
         self.psql.stop()
-        self.etcd.delete(os.path.join(self.etcd.scope, self.name))
+        self.dcs.delete_member(self.name)
         try:
-            self.etcd.vacate_leadership(self.name)
-        except (etcd.EtcdCompareFailed, etcd.EtcdKeyNotFound):
+            self.dcs.vacate_leadership(self.name)
+        except (CompareFailed, KeyNotFound):
             pass
@@ -0,0 +1,141 @@
+import json
+import logging
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+def format_lsn(lsn):
+    return '' if lsn is None else '{:X}/{:X}'.format(lsn >> 32, lsn & 0xFFFFFFFF)
+
+class Status:
+    """What the last HA cycle found out about this node, served to health checks as is."""
+
+    __slots__ = ('name', 'role', 'running', 'lsn', 'lag', 'leader', 'updated')
+
+    def __init__(self, name, role='unknown', running=False, lsn=None, lag=None, leader=None, updated=None):
+        self.name = name
+        self.role = role
+        self.running = running
+        self.lsn = lsn
+        self.lag = lag
+        self.leader = leader
+        self.updated = time.time() if updated is None else updated
+
+    @classmethod
+    def from_ha(cls, ha):
+        state, cluster = ha.psql.state, ha.cluster
+        leader = cluster and cluster.leader_name
+        if state is None:
+            return cls(ha.psql.name, leader=leader)
+        if state.is_leader:
+            # a writable postgres without the lock is about to be demoted
+            return cls(ha.psql.name, 'master' if ha.has_lock else 'demoting', True, state.position, 0, leader)
+        lag = None
+        if cluster and cluster.optime is not None and state.position is not None:
+            lag = max(cluster.optime - state.position, 0)
+        return cls(ha.psql.name, 'replica', True, state.position, lag, leader)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'role': self.role,
+            'running': self.running,
+            'xlog_position': format_lsn(self.lsn),
+            'lag': self.lag,
+            'leader': self.leader,
+            'updated': self.updated,
+        }
+
+class StatusHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, fmt, *args):
+        logger.debug(fmt, *args)
+
+    CHECKS = ('/master', '/replica', '/health')
+
+    def check(self, path, query, status):
+        if path not in self.CHECKS:
+            return None
+        if time.time() - status.updated > self.server.stale_after:
+            # the HA loop is stuck, nothing it said can be trusted any more
+            return False
+        if path == '/master':
+            return status.role == 'master'
+        if path == '/replica':
+            max_lag = query.get('lag')
+            try:
+                if max_lag and (status.lag is None or status.lag > int(max_lag[0])):
+                    return False
+            except ValueError:
+                return False
+            return status.role == 'replica'
+        return status.running
+
+    def respond(self, body=True):
+        url = urlparse(self.path)
+        handler = self.server.handlers.get(url.path)
+        if handler:
+            code, headers, content = handler()
+        else:
+            status = self.server.status
+            ok = self.check(url.path or '/', parse_qs(url.query), status)
+            if ok is None:
+                code, headers, content = 404, {}, {'error': 'not found'}
+            else:
+                code = 200 if ok else 503
+                headers = {
+                    'X-Role': status.role,
+                    'X-XLOG-POSITION': format_lsn(status.lsn),
+                    'X-Replication-Lag': '' if status.lag is None else status.lag,
+                }
+                content = status.to_dict()
+
+        if isinstance(content, (dict, list)):
+            content = json.dumps(content).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    def do_GET(self):
+        self.respond()
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    do_OPTIONS = do_GET
+
+class Api(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server answering health checks from the Status of the last HA cycle.
+
+    /master answers 200 on the leader holding the lock, /replica on a streaming replica
+    (?lag=<bytes> also requires the lag to be within that) and /health whenever postgres
+    runs, 503 otherwise. Other endpoints can be added with `register`.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, name, stale_after):
+        host, _, port = address.rpartition(':')
+        super().__init__((host, int(port)), StatusHandler)
+        self.status = Status(name, updated=0)
+        self.stale_after = stale_after
+        self.handlers = {}
+
+    def register(self, path, handler):
+        """Serves `path` with `handler()`, which returns the code, the headers and the content."""
+        self.handlers[path] = handler
+
+    def start(self):
+        logger.info('Serving health checks on %s:%s', *self.server_address[:2])
+        threading.Thread(target=self.serve_forever, daemon=True).start()
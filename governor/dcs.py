@@ -0,0 +1,393 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from governor.metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+DCS_SECONDS = Histogram('governor_dcs_request_seconds', 'Duration of requests to the DCS', ['method'])
+DCS_ERRORS = Counter('governor_dcs_errors_total', 'Failed requests to the DCS', ['method', 'error'])
+
+def to_json(value):
+    """The one encoding of the JSON keys, so that they can be compared on value."""
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+class DCSError(Exception):
+    pass
+
+class DCSConnectionError(DCSError):
+    pass
+
+class DCSTimeout(DCSConnectionError):
+    pass
+
+class AlreadyExists(DCSError):
+    pass
+
+class CompareFailed(DCSError):
+    pass
+
+class KeyNotFound(DCSError):
+    pass
+
+class HistoryCleared(DCSError):
+    """The watch index is older than the history kept by the DCS."""
+
+class AbstractDCS:
+    """Distributed configuration store holding the leader lock and the member records.
+
+    Write methods return the written event (an object with action, key, value and
+    modifiedIndex) or None, so that it can be applied to a ClusterView right away.
+    """
+
+    LEADER_KEY = 'leader'
+    OPTIME_KEY = 'optime'
+    INIT_KEY = 'initialize'
+    SYNC_KEY = 'sync'
+    SWITCHOVER_KEY = 'switchover'
+
+    ttl = None
+    scope = None
+
+    def touch_member(self, name, value):
+        raise NotImplementedError
+
+    def delete_member(self, name):
+        raise NotImplementedError
+
+    def write_optime(self, value):
+        raise NotImplementedError
+
+    def write_sync(self, value):
+        """Publishes the synchronous standbys of the leader, a key without ttl."""
+        raise NotImplementedError
+
+    def init_cluster(self, value):
+        raise NotImplementedError
+
+    def take_leadership(self, value, force=False):
+        raise NotImplementedError
+
+    def update_leadership(self, value):
+        raise NotImplementedError
+
+    def touch_leader(self, name, value, optime=None):
+        """Writes the member record of the leader `name` and renews its leader key, with the optime unless None.
+
+        Returns whether the leader key is still held and the written events. The member
+        record is written either way.
+        """
+        events = [self.touch_member(name, value)]
+        try:
+            events.append(self.update_leadership(name))
+        except (CompareFailed, KeyNotFound):
+            return False, events
+        if optime is not None:
+            events.append(self.write_optime(optime))
+        return True, events
+
+    def vacate_leadership(self, value):
+        raise NotImplementedError
+
+    def transfer_leadership(self, value, target):
+        """Hands the leader key held by `value` over to `target`, raises CompareFailed if we do not hold it."""
+        raise NotImplementedError
+
+    def create_key(self, name, value, ttl):
+        """Creates `name` under the scope with `ttl`, raises AlreadyExists if it is there."""
+        raise NotImplementedError
+
+    def refresh_key(self, name, value, ttl):
+        """Renews the ttl of `name` if it still holds `value`."""
+        raise NotImplementedError
+
+    def delete_key(self, name, value):
+        """Deletes `name` if it still holds `value`."""
+        raise NotImplementedError
+
+    def list_keys(self, directory):
+        """Returns (name, value) of the keys in `directory` under the scope, in creation order."""
+        raise NotImplementedError
+
+    def load_scope(self):
+        """Returns the list of nodes under the scope and the index they were read at."""
+        raise NotImplementedError
+
+    def watch_scope(self, index, timeout):
+        """Returns the events under the scope starting from index, or [] after timeout."""
+        raise NotImplementedError
+
+    def cluster_view(self):
+        return ClusterView(self)
+
+    def get_cluster(self):
+        view = ClusterView(self)
+        view.load()
+        return Cluster(view.members, view.leader_name, view.optime, view.index, view.changed_index, view.sync,
+                       view.switchover)
+
+class Cluster:
+    __slots__ = ('members', 'leader_name', 'optime', 'index', 'changed_index', 'sync', 'switchover', 'stale',
+                 'down')
+
+    def __init__(self, members, leader_name=None, optime=None, index=0, changed_index=0, sync=None,
+                 switchover=None, stale=frozenset(), down=frozenset()):
+        self.members = members
+        self.leader_name = leader_name
+        self.optime = optime
+        self.index = index
+        self.changed_index = changed_index
+        self.sync = sync        # {'leader': name, 'members': [names]} as published by the leader
+        self.switchover = switchover    # {'leader': name, 'target': name}, and 'result' once done
+        self.stale = stale      # members whose record did not change for longer than the ttl
+        self.down = down        # members whose records had no postgres state for longer than the ttl
+
+    @property
+    def leader(self):
+        return self.members.get(self.leader_name)
+
+    @property
+    def sync_leader(self):
+        return self.sync and self.sync.get('leader')
+
+    @property
+    def sync_standbys(self):
+        """The published synchronous standbys which are still registered."""
+        if not self.sync:
+            return []
+        return [name for name in self.sync.get('members', []) if name in self.members]
+
+    @property
+    def switchover_target(self):
+        """The member a pending switchover away from the current leader hands over to."""
+        request = self.switchover
+        if request and 'result' not in request and request.get('leader') == self.leader_name:
+            return request.get('target')
+
+class ClusterView:
+    """Long-lived view of the scope, kept up to date by applying watch events.
+
+    Every key remembers the modifiedIndex it was last changed at, so results of our own
+    writes can be applied right away without being undone by older events from the watch.
+    `changed_index` only moves when the leader, initialize or the set of members changes.
+
+    Every member record is stamped anew by each HA cycle of its member, so a record which
+    did not change for longer than the ttl belongs to a member whose loop is stuck, even
+    while its key is kept alive. Likewise a member publishing records without the state of
+    postgres for longer than the ttl has postgres down, while its loop goes on. The view
+    times both on its own clock rather than trusting the clocks of the other members.
+    """
+
+    DELETE_ACTIONS = ('delete', 'compareAndDelete', 'expire')
+    WATCH_TIMEOUT = 30
+    RETRY_INTERVAL = 1
+
+    def __init__(self, client, threaded=True, clock=time):
+        self.client = client
+        self.threaded = threaded
+        self.clock = clock
+        self.members = {}
+        self.leader_name = None
+        self.optime = None
+        self.sync = None
+        self.switchover = None
+        self.index = 0
+        self.changed_index = 0
+        self.in_sync = False
+
+        self._modified = {}
+        self._records = {}      # member: (record, when we saw it change)
+        self._down = {}         # member: since when its records come without postgres state
+        self._condition = threading.Condition()
+        self._woken = False
+        self._thread = None
+
+    def load(self):
+        nodes, index = self.client.load_scope()
+        with self._condition:
+            self.members = {}
+            self.leader_name = self.optime = self.sync = self.switchover = None
+            self._modified = {}
+            for node in nodes:
+                name = os.path.relpath(node.key, self.client.scope)
+                self._modified[name] = node.modifiedIndex
+                self._update(name, node.value)
+            for name in set(self._records) - set(self.members):
+                del self._records[name]
+            for name in set(self._down) - set(self.members):
+                del self._down[name]
+            self.index = self.changed_index = index
+            self.in_sync = True
+            self._condition.notify_all()
+
+    def _update(self, name, value):
+        if name == AbstractDCS.OPTIME_KEY:
+            self.optime = value and int(value)
+        elif name == AbstractDCS.SYNC_KEY:
+            self.sync = value and json.loads(value)
+        elif name == AbstractDCS.SWITCHOVER_KEY:
+            self.switchover = value and json.loads(value)
+            # wakes up the leader to act on a request
+            return bool(self.switchover) and 'result' not in self.switchover
+        elif name == AbstractDCS.LEADER_KEY:
+            changed = value != self.leader_name
+            self.leader_name = value
+            return changed
+        elif name == AbstractDCS.INIT_KEY:
+            return True
+        elif '/' in name:
+            pass
+        elif value is None:
+            self._records.pop(name, None)
+            self._down.pop(name, None)
+            return self.members.pop(name, None) is not None
+        else:
+            changed = name not in self.members
+            member = self.members[name] = Member.from_value(name, value)
+            now = self.clock.time()
+            if self._records.get(name, (None, ))[0] != value:
+                self._records[name] = (value, now)
+            if member.has_state and member.lsn is None:
+                self._down.setdefault(name, now)
+            else:
+                self._down.pop(name, None)
+            return changed
+        return False
+
+    def apply(self, event, watched=False):
+        if not event:
+            return
+        name = os.path.relpath(event.key, self.client.scope)
+        index = event.modifiedIndex
+        with self._condition:
+            if watched:
+                self.index = max(self.index, index)
+            if index <= self._modified.get(name, 0):
+                return
+            self._modified[name] = index
+            value = None if event.action in self.DELETE_ACTIONS else event.value
+            # results of our own writes must not wake us up
+            if self._update(name, value) and watched:
+                self.changed_index = index
+                self._condition.notify_all()
+
+    def wait_for_change(self, index, timeout):
+        """Waits for a change after `index`, or only for wake() when `index` is None."""
+        with self._condition:
+            changed = self._condition.wait_for(
+                lambda: self._woken or index is not None and self.changed_index > index, timeout)
+            self._woken = False
+            return changed
+
+    def wake(self):
+        """Wakes up the waiter for a local reason, like postgres exiting."""
+        with self._condition:
+            self._woken = True
+            self._condition.notify_all()
+
+    def catch_up(self):
+        try:
+            events = self.client.watch_scope(self.index + 1, 0)
+            while events:
+                for event in events:
+                    self.apply(event, watched=True)
+                events = self.client.watch_scope(self.index + 1, 0)
+        except HistoryCleared:
+            self.load()
+
+    def cluster(self):
+        if self._thread and not self._thread.is_alive():
+            # the watcher is gone, what it left behind may be frozen at any point
+            logger.error('The DCS watcher died, reloading the cluster view')
+            self._thread = None
+            self.in_sync = False
+        if not self.in_sync:
+            self.load()
+        if not self.threaded:
+            # without a watcher thread the view is brought up to date on every read
+            self.catch_up()
+        elif not self._thread:
+            self._thread = threading.Thread(target=self._watch)
+            self._thread.daemon = True
+            self._thread.start()
+        with self._condition:
+            now = self.clock.time()
+            stale = frozenset(name for name, (_, changed) in self._records.items() if now - changed > self.client.ttl)
+            down = frozenset(name for name, since in self._down.items() if now - since > self.client.ttl)
+            return Cluster(dict(self.members), self.leader_name, self.optime, self.index, self.changed_index,
+                           self.sync, self.switchover, stale, down)
+
+    def _watch(self):
+        while True:
+            try:
+                if not self.in_sync:
+                    self.load()
+                for event in self.client.watch_scope(self.index + 1, self.WATCH_TIMEOUT):
+                    self.apply(event, watched=True)
+            except HistoryCleared:
+                logger.info('Watch index %s was cleared, reloading the cluster view', self.index + 1)
+                self.in_sync = False
+            except DCSError as e:
+                logger.error('Error watching the DCS: %s', e)
+                self.in_sync = False
+                time.sleep(self.RETRY_INTERVAL)
+            except Exception:
+                # a truncated response or a malformed record must not leave the view frozen
+                logger.exception('Unexpected error watching the DCS')
+                self.in_sync = False
+                time.sleep(self.RETRY_INTERVAL)
+
+class Member:
+    __slots__ = ('name', 'url', 'in_recovery', 'lsn', 'receive_lsn', 'timestamp', 'load', 'clone', 'api', 'tags',
+                 'timeline', 'ttl')
+
+    def __init__(self, name, url, in_recovery=None, lsn=None, receive_lsn=None, timestamp=None, load=None,
+                 clone=None, api=None, tags=None, timeline=None, ttl=None):
+        self.name = name
+        self.url = url
+        self.in_recovery = in_recovery
+        self.lsn = lsn
+        self.receive_lsn = receive_lsn
+        self.timestamp = timestamp
+        self.load = load
+        self.clone = clone      # progress of the basebackup this member is running
+        self.api = api          # HOST:PORT answering the health checks
+        self.tags = tags or {}  # preferences for the replication tree, see topology.plan
+        self.timeline = timeline
+        self.ttl = ttl          # of the keys of this member, which the switchover request has to outlive
+
+    @classmethod
+    def from_value(cls, name, value):
+        try:
+            record = json.loads(value)
+        except ValueError:
+            # older governors only publish the advertise url
+            return cls(name, value)
+        return cls(name, record['url'], record.get('recovery'), record.get('lsn'),
+                   record.get('receive'), record.get('time'), record.get('load'), record.get('clone'),
+                   record.get('api'), record.get('tags'), record.get('timeline'), record.get('ttl'))
+
+    def to_value(self):
+        record = {'url': self.url, 'time': self.timestamp}
+        if self.lsn is not None:
+            record.update(recovery=self.in_recovery, lsn=self.lsn, receive=self.receive_lsn)
+        if self.timeline is not None:
+            record['timeline'] = self.timeline
+        if self.load is not None:
+            record['load'] = self.load
+        if self.clone is not None:
+            record['clone'] = self.clone
+        if self.api is not None:
+            record['api'] = self.api
+        if self.tags:
+            record['tags'] = self.tags
+        if self.ttl is not None:
+            record['ttl'] = self.ttl
+        return json.dumps(record, separators=(',', ':'))
+
+    @property
+    def has_state(self):
+        return self.timestamp is not None
@@ -1,13 +1,49 @@
 import etcd
+import functools
 import os
 import re
-
-class Client(etcd.Client):
-    LEADER_KEY = 'leader'
-    OPTIME_KEY = 'optime'
-    INIT_KEY = 'initialize'
-
-    url_regex = re.compile('^(?P<protocol>http(s?))://(?P<host>.*?):(?P<port>\d+)$')
+import threading
+
+from governor.dcs import DCS_SECONDS, DCS_ERRORS, AbstractDCS, ClusterView, DCSError, DCSConnectionError, \
+    AlreadyExists, CompareFailed, KeyNotFound, HistoryCleared
+from governor.trace import span
+
+ERRORS = (
+    (etcd.EtcdAlreadyExist, AlreadyExists),
+    (etcd.EtcdCompareFailed, CompareFailed),
+    (etcd.EtcdKeyNotFound, KeyNotFound),
+    (etcd.EtcdEventIndexCleared, HistoryCleared),
+    (etcd.EtcdConnectionFailed, DCSConnectionError),
+    (etcd.EtcdException, DCSError),
+)
+
+def translate_errors(func):
+    seconds = DCS_SECONDS.labels(func.__name__)
+    name = 'etcd ' + func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            with seconds.time(), span(name):
+                return func(*args, **kwargs)
+        except etcd.EtcdException as e:
+            for etcd_error, error in ERRORS:
+                if isinstance(e, etcd_error):
+                    DCS_ERRORS.labels(func.__name__, error.__name__).inc()
+                    raise error(str(e)) from e
+
+    return wrapper
+
+class Client(etcd.Client, AbstractDCS):
+    """DCS client talking to the v2 API of etcd.
+
+    A wait on the scope returns a single event, so when the response shows more of them
+    waiting, watch_scope reads the whole scope once instead of waiting for each of them.
+    Deletions do not show up in that read, so the client remembers the keys it has seen
+    and reports the ones missing from it as deleted.
+    """
+
+    url_regex = re.compile(r'^(?P<protocol>http(s?))://(?P<host>.*?):(?P<port>\d+)$')
 
     def __init__(self, config):
         match = self.url_regex.match(config.etcd_url).groupdict()
@@ -26,54 +62,111 @@ class Client(etcd.Client):
         )
         self.ttl = config.etcd_ttl
         self.scope = config.etcd_prefix
+        self._known = {}    # key: modifiedIndex it was last seen at
+        self._known_lock = threading.Lock()
+
+    def _seen(self, nodes, reset=False):
+        with self._known_lock:
+            if reset:
+                self._known = {}
+            for node in nodes:
+                if node.action in ClusterView.DELETE_ACTIONS:
+                    self._known.pop(node.key, None)
+                elif node.modifiedIndex >= self._known.get(node.key, 0):
+                    self._known[node.key] = node.modifiedIndex
 
     def write_scoped(self, key, value, **kwargs):
         key = os.path.join(self.scope, key)
-        return self.write(key, value, **kwargs)
+        result = self.write(key, value, **kwargs)
+        self._seen([result])
+        return result
+
+    @translate_errors
+    def touch_member(self, name, value):
+        return self.write_scoped(name, value, ttl=self.ttl)
+
+    @translate_errors
+    def delete_member(self, name):
+        return self.delete(os.path.join(self.scope, name))
 
+    @translate_errors
     def write_optime(self, value):
         return self.write_scoped(self.OPTIME_KEY, value)
 
+    @translate_errors
+    def write_sync(self, value):
+        return self.write_scoped(self.SYNC_KEY, value)
+
+    @translate_errors
     def init_cluster(self, value):
         return self.write_scoped(self.INIT_KEY, value, prevExist=False)
 
-    def take_leadership(self, value, force=False, first=False):
-        kwargs = {}
-        if first:
-            kwargs['prevExist'] = False
-        elif not force:
-            kwargs['prevValue'] = value
+    @translate_errors
+    def take_leadership(self, value, force=False):
+        kwargs = {} if force else {'prevExist': False}
         return self.write_scoped(self.LEADER_KEY, value, ttl=self.ttl, **kwargs)
 
-    def vacate_leadership(self, value):
-        key = os.path.join(self.scope, self.LEADER_KEY)
-        return self.delete(key, value, prevValue=value)
+    @translate_errors
+    def update_leadership(self, value):
+        return self.write_scoped(self.LEADER_KEY, value, ttl=self.ttl, prevValue=value)
 
-    def get_leader(self):
+    @translate_errors
+    def vacate_leadership(self, value):
         key = os.path.join(self.scope, self.LEADER_KEY)
-        return self.read(key)
-
-    def get_cluster(self, recursive=True):
-        cluster = self.read(self.scope, recursive=recursive)
-        return Cluster(cluster, self)
-
-class Cluster:
-    __slots__ = ('members', 'leader', 'leader_node', 'optime')
-
-    def __init__(self, nodes, client):
-        self.members = {os.path.basename(m.key): m for m in nodes.leaves}
-        self.optime = self.members.pop(Client.OPTIME_KEY, None)
-        self.leader_node = self.members.pop(Client.LEADER_KEY, None)
-        self.leader = None
-
-        if not self.leader_node:
-            return
-
-        self.leader = self.members.get(self.leader_node.value)
-        if not self.leader:
-            try:
-                # leader is not a member! delete
-                client.delete(self.leader_node.key, prevValue=self.leader_node.value)
-            except (etcd.EtcdCompareFailed, EtcdKeyNotFound):
-                pass
-            self.leader_node = None
+        return self.delete(key, prevValue=value)
+
+    @translate_errors
+    def transfer_leadership(self, value, target):
+        return self.write_scoped(self.LEADER_KEY, target, ttl=self.ttl, prevValue=value)
+
+    @translate_errors
+    def create_key(self, name, value, ttl):
+        return self.write_scoped(name, value, ttl=ttl, prevExist=False)
+
+    @translate_errors
+    def refresh_key(self, name, value, ttl):
+        return self.write_scoped(name, value, ttl=ttl, prevValue=value)
+
+    @translate_errors
+    def delete_key(self, name, value):
+        return self.delete(os.path.join(self.scope, name), prevValue=value)
+
+    @translate_errors
+    def list_keys(self, directory):
+        try:
+            result = self.read(os.path.join(self.scope, directory), recursive=True)
+        except etcd.EtcdKeyNotFound:
+            return []
+        nodes = sorted((n for n in result.leaves if not n.dir), key=lambda n: n.createdIndex)
+        return [(os.path.basename(n.key), n.value) for n in nodes]
+
+    def _read_scope(self):
+        try:
+            result = self.read(self.scope, recursive=True)
+        except etcd.EtcdKeyNotFound as e:
+            return [], e.payload.get('index', 0)
+        return [n for n in result.leaves if not n.dir], result.etcd_index
+
+    @translate_errors
+    def load_scope(self):
+        nodes, index = self._read_scope()
+        self._seen(nodes, reset=True)
+        return nodes, index
+
+    @translate_errors
+    def watch_scope(self, index, timeout):
+        try:
+            result = self.read(self.scope, recursive=True, wait=True, waitIndex=index, timeout=timeout)
+        except etcd.EtcdWatchTimedOut:
+            return []
+        events = [result]
+        # the index etcd was at when the wait started is past the event, so more are waiting
+        if result.etcd_index > result.modifiedIndex:
+            nodes, index = self._read_scope()
+            present = set(n.key for n in nodes)
+            with self._known_lock:
+                deleted = [key for key, modified in self._known.items() if key not in present and modified <= index]
+            events.extend(n for n in nodes if n.modifiedIndex > result.modifiedIndex)
+            events.extend(etcd.EtcdResult('delete', {'key': key, 'modifiedIndex': index}) for key in deleted)
+        self._seen(events)
+        return events
@@ -0,0 +1,323 @@
+import base64
+import json
+import logging
+import os
+import socket
+import ssl
+import threading
+import urllib.error
+import urllib.request
+
+from governor.dcs import DCS_SECONDS, DCS_ERRORS, AbstractDCS, DCSError, DCSConnectionError, DCSTimeout, \
+    AlreadyExists, CompareFailed, HistoryCleared
+from governor.trace import span
+
+logger = logging.getLogger(__name__)
+
+def _encode(value):
+    return base64.b64encode(value.encode('utf-8')).decode('ascii')
+
+def _decode(value):
+    return base64.b64decode(value).decode('utf-8')
+
+def _prefix_end(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class Result:
+    __slots__ = ('action', 'key', 'value', 'modifiedIndex', 'dir')
+
+    def __init__(self, action, key, value=None, modified_index=0):
+        self.action = action
+        self.key = key
+        self.value = value
+        self.modifiedIndex = modified_index
+        self.dir = False
+
+    @classmethod
+    def from_kv(cls, action, kv):
+        return cls(action, _decode(kv['key']), _decode(kv.get('value', '')), int(kv.get('mod_revision', 0)))
+
+class Client(AbstractDCS):
+    """DCS client talking to the JSON gateway of etcd v3.
+
+    The member key and the leader key are attached to one lease, so a single keepalive per
+    cycle refreshes both. Compare-and-swap on leadership is done with transactions, and the
+    leader writes its record, the renewal of the leader key and the optime in one of them.
+    """
+
+    API_PREFIX = '/v3'
+    TIMEOUT = 5
+
+    def __init__(self, config):
+        self.base_url = config.etcd_url.rstrip('/') + self.API_PREFIX
+        self.ttl = config.etcd_ttl
+        self.scope = config.etcd_prefix
+
+        self._context = None
+        if config.ca_file or config.cert_file:
+            self._context = ssl.create_default_context(cafile=config.ca_file)
+            if config.cert_file:
+                self._context.load_cert_chain(config.cert_file, config.key_file)
+
+        self.lease = None
+        self._leases = {}
+        self._leases_lock = threading.Lock()
+        self._optime = None
+        self.grant_lease()
+
+    def _open(self, path, body, timeout):
+        request = urllib.request.Request(self.base_url + path, data=json.dumps(body).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            return urllib.request.urlopen(request, timeout=timeout, context=self._context)
+        except urllib.error.HTTPError as e:
+            raise DCSError('{} returned {}: {}'.format(path, e.code, e.read().decode('utf-8', 'replace')))
+        except socket.timeout as e:
+            raise DCSTimeout('Timed out communicating with etcd: {}'.format(e))
+        except urllib.error.URLError as e:
+            if isinstance(e.reason, socket.timeout):
+                raise DCSTimeout('Timed out communicating with etcd: {}'.format(e))
+            raise DCSConnectionError('Error communicating with etcd: {}'.format(e))
+        except OSError as e:
+            raise DCSConnectionError('Error communicating with etcd: {}'.format(e))
+
+    def _post(self, path, body, timeout=None):
+        try:
+            with DCS_SECONDS.labels(path).time(), span('etcd ' + path), \
+                    self._open(path, body, timeout or self.TIMEOUT) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except DCSError as e:
+            DCS_ERRORS.labels(path, e.__class__.__name__).inc()
+            raise
+
+    def _key(self, name):
+        return os.path.join(self.scope, name)
+
+    def _put(self, name, value, lease=False):
+        request = {'key': _encode(self._key(name)), 'value': _encode(value)}
+        if lease:
+            request['lease'] = self.lease if lease is True else lease
+        return request
+
+    def _txn(self, compare, success, failure=()):
+        response = self._post('/kv/txn', {'compare': compare, 'success': success, 'failure': list(failure)})
+        return response.get('succeeded', False), response
+
+    def _compare(self, name, target, result='EQUAL', **kwargs):
+        kwargs.update(key=_encode(self._key(name)), target=target, result=result)
+        return kwargs
+
+    def _revision(self, response):
+        return int(response['header']['revision'])
+
+    def grant_lease(self):
+        self.lease = self._post('/lease/grant', {'TTL': self.ttl})['ID']
+        logger.info('Granted lease %s with ttl %s', self.lease, self.ttl)
+
+    def _keepalive(self, lease):
+        result = self._post('/lease/keepalive', {'ID': lease}).get('result', {})
+        return int(result.get('TTL', 0)) > 0
+
+    def keepalive(self):
+        if not self._keepalive(self.lease):
+            # the lease expired, together with the member and the leader key
+            logger.warning('Lease %s expired', self.lease)
+            self.grant_lease()
+
+    def touch_member(self, name, value):
+        self.keepalive()
+        response = self._post('/kv/put', self._put(name, value, lease=True))
+        return Result('set', self._key(name), value, self._revision(response))
+
+    def delete_member(self, name):
+        self._post('/kv/deleterange', {'key': _encode(self._key(name))})
+
+    def write_optime(self, value):
+        value = str(value)
+        if value == self._optime:
+            return None
+        response = self._post('/kv/put', self._put(self.OPTIME_KEY, value))
+        self._optime = value
+        return Result('set', self._key(self.OPTIME_KEY), value, self._revision(response))
+
+    def write_sync(self, value):
+        response = self._post('/kv/put', self._put(self.SYNC_KEY, value))
+        return Result('set', self._key(self.SYNC_KEY), value, self._revision(response))
+
+    def init_cluster(self, value):
+        succeeded, response = self._txn([self._compare(self.INIT_KEY, 'CREATE', create_revision='0')],
+                                        [{'request_put': self._put(self.INIT_KEY, value)}])
+        if not succeeded:
+            raise AlreadyExists('Key already exists')
+        return Result('create', self._key(self.INIT_KEY), value, self._revision(response))
+
+    def take_leadership(self, value, force=False):
+        key = self._key(self.LEADER_KEY)
+        put = self._put(self.LEADER_KEY, value, lease=True)
+        if force:
+            response = self._post('/kv/put', put)
+            return Result('set', key, value, self._revision(response))
+
+        succeeded, response = self._txn([self._compare(self.LEADER_KEY, 'CREATE', create_revision='0')],
+                                        [{'request_put': put}])
+        if not succeeded:
+            raise AlreadyExists('Key already exists')
+        return Result('create', key, value, self._revision(response))
+
+    def update_leadership(self, value):
+        key = self._key(self.LEADER_KEY)
+        # the lease keeps the key alive, so holding the lock only needs a compare
+        succeeded, response = self._txn([self._compare(self.LEADER_KEY, 'VALUE', value=_encode(value))],
+                                        [{'request_range': {'key': _encode(key)}}])
+        if not succeeded:
+            raise CompareFailed('Compare failed')
+        kvs = response['responses'][0]['response_range'].get('kvs', [])
+        if kvs and kvs[0].get('lease') != str(self.lease):
+            # handed over by a switchover on the lease of the previous leader, move it to ours
+            succeeded, response = self._txn([self._compare(self.LEADER_KEY, 'VALUE', value=_encode(value))],
+                                            [{'request_put': self._put(self.LEADER_KEY, value, lease=True)}])
+            if not succeeded:
+                raise CompareFailed('Compare failed')
+            return Result('compareAndSwap', key, value, self._revision(response))
+        return kvs and Result.from_kv('compareAndSwap', kvs[0])
+
+    def touch_leader(self, name, value, optime=None):
+        self.keepalive()
+        put = {'request_put': self._put(name, value, lease=True)}
+        success = [put]
+        optime = None if optime is None or str(optime) == self._optime else str(optime)
+        if optime is not None:
+            success.append({'request_put': self._put(self.OPTIME_KEY, optime)})
+        # a leader key still on our lease is renewed by the keepalive, so one revision holds the whole cycle
+        compare = [self._compare(self.LEADER_KEY, 'VALUE', value=_encode(name)),
+                   self._compare(self.LEADER_KEY, 'LEASE', lease=self.lease)]
+        failure = [put, {'request_range': {'key': _encode(self._key(self.LEADER_KEY))}}]
+        succeeded, response = self._txn(compare, success, failure)
+        revision = self._revision(response)
+        events = [Result('set', self._key(name), value, revision)]
+        if succeeded:
+            if optime is not None:
+                self._optime = optime
+                events.append(Result('set', self._key(self.OPTIME_KEY), optime, revision))
+            return True, events
+
+        kvs = response['responses'][1]['response_range'].get('kvs', [])
+        if not kvs or _decode(kvs[0].get('value', '')) != name:
+            return False, events
+        # ours, but handed over on the lease of the previous leader
+        try:
+            events.append(self.update_leadership(name))
+        except CompareFailed:
+            return False, events
+        if optime is not None:
+            events.append(self.write_optime(optime))
+        return True, events
+
+    def transfer_leadership(self, value, target):
+        succeeded, response = self._txn([self._compare(self.LEADER_KEY, 'VALUE', value=_encode(value))],
+                                        [{'request_put': self._put(self.LEADER_KEY, target, lease=True)}])
+        if not succeeded:
+            raise CompareFailed('Compare failed')
+        return Result('compareAndSwap', self._key(self.LEADER_KEY), target, self._revision(response))
+
+    def vacate_leadership(self, value):
+        succeeded, response = self._txn([self._compare(self.LEADER_KEY, 'VALUE', value=_encode(value))],
+                                        [{'request_delete_range': {'key': _encode(self._key(self.LEADER_KEY))}}])
+        if not succeeded:
+            raise CompareFailed('Compare failed')
+        return Result('compareAndDelete', self._key(self.LEADER_KEY), None, self._revision(response))
+
+    # the keys below live on the lease of the member key when they have its ttl; keys with
+    # another ttl share one lease per ttl, kept alive by refresh_key and revoked with the last key
+
+    def _lease(self, ttl):
+        if ttl == self.ttl:
+            self.keepalive()
+            return True
+        with self._leases_lock:
+            lease, names = self._leases.get(ttl, (None, set()))
+            if lease is not None and not self._keepalive(lease):
+                logger.warning('Lease %s expired', lease)
+                lease, names = None, set()
+            if lease is None:
+                lease = self._post('/lease/grant', {'TTL': ttl})['ID']
+                logger.info('Granted lease %s with ttl %s', lease, ttl)
+            self._leases[ttl] = (lease, names)
+            return lease
+
+    def create_key(self, name, value, ttl):
+        lease = self._lease(ttl)
+        succeeded, response = self._txn([self._compare(name, 'CREATE', create_revision='0')],
+                                        [{'request_put': self._put(name, value, lease=lease)}])
+        if not succeeded:
+            raise AlreadyExists('Key already exists')
+        if lease is not True:
+            with self._leases_lock:
+                self._leases[ttl][1].add(name)
+        return Result('create', self._key(name), value, self._revision(response))
+
+    def refresh_key(self, name, value, ttl):
+        self._lease(ttl)
+        succeeded, _ = self._txn([self._compare(name, 'VALUE', value=_encode(value))], [])
+        if not succeeded:
+            raise CompareFailed('Compare failed')
+
+    def delete_key(self, name, value):
+        succeeded, response = self._txn([self._compare(name, 'VALUE', value=_encode(value))],
+                                        [{'request_delete_range': {'key': _encode(self._key(name))}}])
+        if not succeeded:
+            raise CompareFailed('Compare failed')
+        with self._leases_lock:
+            for ttl, (lease, names) in list(self._leases.items()):
+                if name not in names:
+                    continue
+                names.discard(name)
+                if not names:
+                    del self._leases[ttl]
+                    self._revoke(lease)
+        return Result('compareAndDelete', self._key(name), None, self._revision(response))
+
+    def _revoke(self, lease):
+        try:
+            self._post('/lease/revoke', {'ID': lease})
+        except DCSError as e:
+            # it expires on its own
+            logger.warning('Could not revoke lease %s: %s', lease, e)
+
+    def list_keys(self, directory):
+        prefix = self._key(directory) + '/'
+        response = self._post('/kv/range', {'key': _encode(prefix), 'range_end': _encode(_prefix_end(prefix))})
+        kvs = sorted(response.get('kvs', []), key=lambda kv: int(kv.get('create_revision', 0)))
+        return [(os.path.basename(_decode(kv['key'])), _decode(kv.get('value', ''))) for kv in kvs]
+
+    def load_scope(self):
+        prefix = self._key('')
+        response = self._post('/kv/range', {'key': _encode(prefix), 'range_end': _encode(_prefix_end(prefix))})
+        return [Result.from_kv('get', kv) for kv in response.get('kvs', [])], self._revision(response)
+
+    def watch_scope(self, index, timeout):
+        prefix = self._key('')
+        request = {'create_request': {
+            'key': _encode(prefix),
+            'range_end': _encode(_prefix_end(prefix)),
+            'start_revision': index,
+        }}
+        try:
+            response = self._open('/watch', request, timeout)
+        except DCSTimeout:
+            return []
+        with response:
+            try:
+                for line in response:
+                    result = json.loads(line.decode('utf-8')).get('result', {})
+                    if int(result.get('compact_revision', 0)):
+                        raise HistoryCleared('Revision {} was compacted'.format(index))
+                    if result.get('events'):
+                        return [Result.from_kv('delete' if e.get('type') == 'DELETE' else 'set', e['kv'])
+                                for e in result['events']]
+            except socket.timeout:
+                # no events within the timeout
+                pass
+            except OSError as e:
+                raise DCSConnectionError('Error communicating with etcd: {}'.format(e))
+        return []
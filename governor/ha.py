@@ -1,76 +1,353 @@
+import json
 import logging
-import etcd
+import threading
+import time
 
+from governor import topology
+from governor.dcs import DCSError, AlreadyExists, CompareFailed, KeyNotFound, to_json
+from governor.metrics import Counter, Gauge, Histogram
+from governor.scheduler import Scheduler
+from governor.trace import span
 from psycopg2 import InterfaceError, OperationalError
 
 logger = logging.getLogger(__name__)
 
+CYCLE_SECONDS = Histogram('governor_ha_cycle_seconds', 'Duration of the HA decision cycle')
+LEADER_RENEWALS = Counter('governor_leader_renewals_total', 'Renewals of the leader lock', ['result'])
+SLOT_SYNC_SECONDS = Histogram('governor_slot_sync_seconds', 'Duration of the replication slot sync')
+SWITCHOVER_SECONDS = Histogram('governor_switchover_unavailable_seconds', 'Writes unavailable during a switchover')
+SYNC_STANDBYS = Gauge('governor_synchronous_standbys', 'Standbys commits on this leader wait for')
+
+class Switchover:
+    """A switchover away from this leader, which the HA cycles advance step by step."""
+
+    __slots__ = ('request', 'target', 'step', 'position', 'started', 'deadline')
+
+    def __init__(self, request, target, deadline):
+        self.request = request
+        self.target = target
+        self.step = 'catch up'  # then 'hand over' once postgres is stopped, then 'promote'
+        self.position = None    # the WAL position the target has to replay in this step
+        self.started = None     # when postgres was stopped
+        self.deadline = deadline
+
 class Ha:
 
-    def __init__(self, psql, etcd):
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, psql, dcs, scheduler=None, synchronous_standbys=0):
         self.psql = psql
-        self.etcd = etcd
+        self.dcs = dcs
+        self.synchronous_standbys = synchronous_standbys
+        self.view = dcs.cluster_view()
+        self.scheduler = scheduler or Scheduler(dcs.ttl / 2)
+        self.lock = threading.Lock()   # held by the HA loop for a whole cycle, and by the heartbeat to fence
         self.cluster = None
+        self.state = None
+        self.has_lock = False
+        self._renewed = False   # the leader key was renewed together with our record this cycle
+        self.switchover = None  # the Switchover away from us in progress
+
+    def collect_state(self):
+        """Takes the snapshot of local Postgres the decisions of this cycle are based on."""
+        self._renewed = False
+        self.state = self.psql.collect_state()
+        return self.state
+
+    def touch_member(self, value, leader=False, optime=None):
+        """Writes our member record, and renews the leader key with it when `leader`.
+
+        Returns False when the leader key turned out not to be ours any more, without
+        deciding anything about it: that is up to the HA cycle.
+        """
+        started = time.time()
+        if not leader:
+            self.view.apply(self.dcs.touch_member(self.psql.name, value))
+            self.scheduler.refreshed(self.psql.name, self.dcs.ttl, started)
+            return True
+        held, events = self.dcs.touch_leader(self.psql.name, value, optime)
+        for event in events:
+            self.view.apply(event)
+        self.scheduler.refreshed(self.psql.name, self.dcs.ttl, started)
+        if not held:
+            LEADER_RENEWALS.labels('lost').inc()
+            self.scheduler.forget(self.dcs.LEADER_KEY)
+            return False
+        LEADER_RENEWALS.labels('renewed').inc()
+        self.scheduler.refreshed(self.dcs.LEADER_KEY, self.dcs.ttl, started)
+        return True
+
+    def keep_alive(self, value):
+        """Publishes our record at the start of the cycle, with the leader key and optime while we hold the lock."""
+        if not self.has_lock:
+            self.touch_member(value)
+            return
+        optime = self.state.position if self.state else None
+        try:
+            self.has_lock = self._renewed = self.touch_member(value, True, optime)
+        except DCSError as e:
+            # the cycle renews again, and demotes while the DCS stays unreachable
+            logger.error('Could not renew the leader key with our record: %s', e)
+
+    def refresh_state(self):
+        """Takes a new snapshot when the cycle changed postgres, so the health checks see the outcome at once."""
+        if self.state is None:
+            self.state = self.psql.collect_state()
+        return self.state
 
+    def psql_is_leader(self):
+        # the snapshot is dropped whenever the cycle changes postgres, then ask again
+        if self.state is None:
+            return self.psql.is_leader()
+        return self.state.is_leader
+
+    @span('refresh_cluster')
     def refresh_cluster(self):
-        self.cluster = self.etcd.get_cluster()
+        cluster = self.view.cluster()
+        if cluster.leader_name and not cluster.leader:
+            try:
+                # leader is not a member! delete
+                self.dcs.vacate_leadership(cluster.leader_name)
+            except (CompareFailed, KeyNotFound):
+                pass
+            cluster.leader_name = None
+        self.cluster = cluster
 
     def acquire_leadership(self):
+        started = time.time()
         try:
-            self.etcd.take_leadership(self.psql.name, first=True)
-        except ectd.EtcdAlreadyExist:
+            self.view.apply(self.dcs.take_leadership(self.psql.name))
+        except AlreadyExists:
             return False
+        self.scheduler.refreshed(self.dcs.LEADER_KEY, self.dcs.ttl, started)
+        self.has_lock = True
         return True
 
-    def update_leadership(self):
-        optime = self.psql.last_operation()
+    def renew_leadership(self):
+        started = time.time()
         try:
-            self.etcd.take_leadership(self.psql.name)
-        except etcd.EtcdCompareFailed:
+            self.view.apply(self.dcs.update_leadership(self.psql.name))
+        except (CompareFailed, KeyNotFound):
+            LEADER_RENEWALS.labels('lost').inc()
+            self.scheduler.forget(self.dcs.LEADER_KEY)
+            self.has_lock = False
+            return False
+        LEADER_RENEWALS.labels('renewed').inc()
+        self.scheduler.refreshed(self.dcs.LEADER_KEY, self.dcs.ttl, started)
+        self.has_lock = True
+        return True
+
+    @span('update_leadership')
+    def update_leadership(self):
+        if self._renewed:
+            # renewed together with our record at the start of the cycle
+            return True
+        optime = self.state.position if self.state else self.psql.last_operation()
+        if not self.renew_leadership():
             return False
-        self.etcd.write_optime(optime)
+        self.view.apply(self.dcs.write_optime(optime))
         return True
 
+    @span('step_down')
+    def step_down(self):
+        """Demotes postgres, and only then gives up the leader key, which otherwise expires on its own."""
+        self.has_lock = False
+        self.state = None
+        self.scheduler.forget(self.dcs.LEADER_KEY)
+        if not self.psql.follow_the_leader(None):
+            logger.error('Could not demote postgres, leaving the leader key to expire')
+            return False
+        self.release_leadership()
+        return True
+
+    def release_leadership(self):
+        """Deletes the leader key if it is still ours, leaving Postgres and has_lock alone."""
+        try:
+            self.view.apply(self.dcs.vacate_leadership(self.psql.name))
+        except (CompareFailed, KeyNotFound):
+            pass
+
     def is_leader(self):
-        leader = (self.cluster.leader_node and self.cluster.leader_node.value)
+        leader = self.cluster.leader_name
         logger.info('Lock owner: %s; I am %s', leader, self.psql.name)
         return leader == self.psql.name
 
+    def upstream(self):
+        """The member to stream from, the leader or a replica in the replication tree."""
+        return topology.upstream(self.cluster, self.psql.name)
+
+    @span('recover')
     def recover(self):
-        if not self.psql.is_healthy():
+        # postgres which answered the snapshot query is running
+        if self.state is None and not self.psql.is_healthy():
             locked = self.is_leader()
-            self.psql.write_recovery_conf(None if locked else self.cluster.leader_node)
+            if self.psql.needs_resync and not locked:
+                # stopped on purpose, following the leader resyncs it first
+                return False
+            self.psql.write_recovery_conf(None if locked else self.upstream())
             self.psql.start()
             if locked:
                 logging.info('Started as readonly because I had the session lock')
                 self.refresh_cluster()
             return True
 
+    def replayed(self, target, position):
+        """Whether `target` is a replica which replayed WAL up to `position`."""
+        try:
+            in_recovery, behind = self.psql.probe_member(target.name, target.url, position)
+            return in_recovery and behind <= 0
+        except (InterfaceError, OperationalError) as e:
+            logger.warning('Could not ask %s for its position: %s', target.name, e)
+            return False
+
+    def promoted(self, target):
+        try:
+            return not self.psql.probe_member(target.name, target.url, 0)[0]
+        except (InterfaceError, OperationalError):
+            return False
+
+    def finish_switchover(self, result, **details):
+        request, self.switchover = self.switchover.request, None
+        value = to_json(dict(request, result=result, **details))
+        try:
+            try:
+                self.dcs.delete_key(self.dcs.SWITCHOVER_KEY, to_json(request))
+            except (CompareFailed, KeyNotFound):
+                pass
+            self.view.apply(self.dcs.create_key(self.dcs.SWITCHOVER_KEY, value, self.dcs.ttl))
+        except DCSError as e:
+            logger.error('Could not report the switchover: %s', e)
+
+    @span('start_switchover')
+    def start_switchover(self, name):
+        """Hands leadership over to `name` with writes unavailable only while it catches up on the
+        last few WAL records and promotes.
+
+        A checkpoint first, so that the shutdown checkpoint has little to write, and the target
+        catches up on everything before it while we still take writes. Then postgres is stopped,
+        which sends the shutdown checkpoint to the standbys, and the leader key goes to the
+        target with a compare-and-swap once it replayed that. The waits in between are steps
+        of the following HA cycles, see advance_switchover, so the leader key stays renewed.
+        """
+        target = self.cluster.members.get(name)
+        self.switchover = Switchover(self.cluster.switchover, target, time.time() + self.dcs.ttl / 2.0)
+        if not target or name == self.psql.name or not target.in_recovery:
+            logger.error('Refusing the switchover to %s, it is not a replica', name)
+            self.finish_switchover('failed', reason='not a replica')
+            return 'Refused the switchover to {}'.format(name)
+        self.psql.checkpoint()
+        self.switchover.position = self.psql.xlog_position()
+        return 'Switching over to {}, waiting for it to catch up'.format(name)
+
+    def hold_switchover_lock(self):
+        # postgres may be stopped, so the optime is left alone until the switchover is over
+        if not self.is_leader():
+            self.has_lock = False
+            return False
+        try:
+            return self._renewed or self.renew_leadership()
+        except DCSError as e:
+            logger.error('Could not renew the leader key: %s', e)
+            self.has_lock = False
+            return False
+
+    @span('advance_switchover')
+    def advance_switchover(self):
+        """Takes the switchover in progress a step further, asking the target once per cycle."""
+        switchover = self.switchover
+        name = switchover.target.name
+        if switchover.step != 'promote' and not self.hold_switchover_lock():
+            # whoever has it now is followed in the next cycle
+            if switchover.step == 'hand over':
+                self.psql.start()
+            self.finish_switchover('failed', reason='lost the leader lock')
+            return 'Switchover to {} failed, lost the leader lock'.format(name)
+
+        if switchover.step == 'catch up':
+            if not self.replayed(switchover.target, switchover.position):
+                if time.time() < switchover.deadline:
+                    return 'Switching over to {}, waiting for it to catch up'.format(name)
+                self.finish_switchover('failed', reason='did not catch up')
+                return 'Switchover to {} failed, it did not catch up'.format(name)
+            switchover.started = time.time()
+            self.psql.stop()
+            self.state = None
+            _, switchover.position = self.psql.local_position()
+            switchover.step = 'hand over'
+
+        if switchover.step == 'hand over':
+            if not self.replayed(switchover.target, switchover.position):
+                if time.time() < switchover.deadline:
+                    return 'Switching over to {}, waiting for it to replay the shutdown checkpoint'.format(name)
+                self.psql.start()
+                self.finish_switchover('failed', reason='did not receive the shutdown checkpoint')
+                return 'Switchover to {} failed, it did not receive the shutdown checkpoint'.format(name)
+            try:
+                self.view.apply(self.dcs.transfer_leadership(self.psql.name, name))
+            except (CompareFailed, KeyNotFound):
+                self.has_lock = False
+                self.psql.start()
+                self.finish_switchover('failed', reason='lost the leader lock')
+                return 'Switchover to {} failed, lost the leader lock'.format(name)
+            self.has_lock = False
+            self.scheduler.forget(self.dcs.LEADER_KEY)
+            self.psql.write_recovery_conf(switchover.target)
+            self.psql.start()
+            switchover.step = 'promote'
+            switchover.deadline = time.time() + self.dcs.ttl
+
+        if self.promoted(switchover.target):
+            unavailable = time.time() - switchover.started
+            SWITCHOVER_SECONDS.observe(unavailable)
+            self.finish_switchover('done', unavailable=round(unavailable, 3))
+            return 'Switched over to {}, writes were unavailable for {:.3f}s'.format(name, unavailable)
+        if time.time() >= switchover.deadline:
+            self.finish_switchover('unknown', reason='handed over, but did not see the promotion')
+            return 'Handed over to {}, which did not promote within {}s'.format(name, self.dcs.ttl)
+        return 'Handed over to {}, waiting for it to promote'.format(name)
+
+    def is_failover_candidate(self):
+        # a synchronous standby of the last leader has every acknowledged commit, no need to ask around
+        sync = self.cluster.sync_standbys
+        if sync and self.cluster.sync_leader != self.psql.name:
+            return self.psql.name in sync
+        return self.psql.is_healthiest_node(self.cluster, self.state)
+
+    @span('become_leader')
     def become_leader(self):
-        if self.etcd.take_leadership(self.psql.name, first=True):
-            if self.psql.is_leader() or self.psql.promoted:
+        if self.acquire_leadership():
+            if self.psql_is_leader() or self.psql.promoted:
                 return 'Acquired session lock as a leader'
             self.psql.promote()
+            self.state = None
             return 'Promoted self to leader by acquiring session lock'
 
+    @span('follow_leader')
     def follow_leader(self, refresh=True):
+        self.has_lock = False
+        self.scheduler.forget(self.dcs.LEADER_KEY)
         if refresh:
             self.refresh_cluster()
 
-        if self.psql.is_leader():
-            self.psql.follow_the_leader(self.cluster.leader)
-            return 'Demoted self'
-        self.psql.follow_the_leader(self.cluster.leader)
-        return 'Following the leader'
+        is_leader = self.psql_is_leader()
+        if not self.psql.follow_the_leader(self.upstream()) or is_leader:
+            # a replica which came up again stays one, following another upstream or not, and its snapshot with it
+            self.state = None
+        return 'Demoted self' if is_leader else 'Following the leader'
 
+    @CYCLE_SECONDS.time()
+    @span('run_cycle')
     def run_cycle(self):
         try:
             self.refresh_cluster()
+            if self.switchover:
+                # postgres is stopped on purpose for part of it, nothing to recover
+                return self.advance_switchover()
             if self.recover() and not self.is_leader():
                 return 'Started as secondary'
 
             if not self.cluster.leader:
-                if self.psql.is_healthiest_node(self.cluster):
+                if self.is_failover_candidate():
                     status = self.become_leader()
                     if status:
                         return status
@@ -81,24 +358,88 @@ class Ha:
                 logger.info('Does not have lock')
                 return self.follow_leader()
 
-            if self.psql.is_leader():
+            if self.psql_is_leader():
+                if self.cluster.switchover_target:
+                    return self.start_switchover(self.cluster.switchover_target)
                 return 'No action. I am the leader with the lock'
             self.psql.promote()
+            self.state = None
             return 'Promoted self to leader'
 
-        except etcd.EtcdException:
-            logger.error('Error communicating with Etcd')
-            if self.psql.is_leader():
+        except DCSError:
+            logger.error('Error communicating with the DCS')
+            self.has_lock = False
+            if self.psql_is_leader():
                 self.psql.follow_the_leader(None)
-                return 'Demoted self because etcd is not accessible and I was a leader'
+                self.state = None
+                return 'Demoted self because the DCS is not accessible and I was a leader'
         except (InterfaceError, OperationalError):
             logger.exception('Error communicating with Postgresql. Will try again')
 
+    def wait_for_change(self, timeout, watch=True):
+        # without watching, only a local event like postgres exiting cuts the wait short; the target of a
+        # switchover watches anyway, to promote as soon as it is handed the leader key
+        if self.cluster and self.cluster.switchover_target == self.psql.name:
+            watch = True
+        if self.switchover:
+            # the next step of our switchover asks the target again
+            timeout = min(timeout, self.POLL_INTERVAL)
+        index = self.cluster.changed_index if watch and self.cluster else None
+        return self.view.wait_for_change(index, timeout)
+
+    @SLOT_SYNC_SECONDS.time()
+    @span('sync_replication_slots')
     def sync_replication_slots(self):
         try:
-            if not self.psql.is_leader():
+            self.psql.guard_replication_slots()
+            if self.psql_is_leader():
+                if self.cluster:
+                    self.psql.create_replication_slots(self.cluster, self.psql.name)
+            elif self.cluster and self.cluster.leader_name:
+                # replicas keep the slots of the replicas cascading from them
+                self.psql.create_replication_slots(self.cluster, self.cluster.leader_name)
+            else:
                 self.psql.drop_replication_slots()
-            elif self.cluster:
-                self.psql.create_replication_slots(self.cluster)
         except:
             logging.exception('Exception when changing replication slots')
+
+    def publish_synchronous_standbys(self, names):
+        current = self.cluster.sync.get('members') if self.cluster.sync_leader == self.psql.name else None
+        if current == names or not names and not self.cluster.sync:
+            return
+        value = to_json({'leader': self.psql.name, 'members': names})
+        self.view.apply(self.dcs.write_sync(value))
+        self.cluster.sync = json.loads(value)
+
+    @span('update_synchronous_standbys')
+    def update_synchronous_standbys(self):
+        """Makes the leader wait for the standbys with the least lag, and publishes them.
+
+        A standby leaves the published set before postgres stops waiting for it, and joins
+        it only once postgres reports it as synchronous, so that whoever is published has
+        every acknowledged commit.
+        """
+        try:
+            if not self.has_lock or not self.psql_is_leader():
+                # a replica must not come up as a leader waiting for the standbys of another
+                self.psql.set_synchronous_standbys([])
+                return
+            if not self.synchronous_standbys:
+                self.psql.set_synchronous_standbys([])
+                self.publish_synchronous_standbys([])
+                return
+
+            streaming = self.psql.replication_lag()
+            candidates = sorted((lag, name) for name, (lag, _) in streaming.items()
+                                if name in self.cluster.members and name != self.psql.name and lag is not None)
+            wanted = sorted(name for _, name in candidates[:self.synchronous_standbys])
+
+            published = self.cluster.sync.get('members', []) if self.cluster.sync_leader == self.psql.name else []
+            kept = sorted(set(published) & set(wanted))
+            self.publish_synchronous_standbys(kept)
+            self.psql.set_synchronous_standbys(wanted)
+            confirmed = [name for name in wanted if streaming[name][1] in ('sync', 'quorum')]
+            self.publish_synchronous_standbys(sorted(set(kept) | set(confirmed)))
+            SYNC_STANDBYS.set(len(wanted))
+        except Exception:
+            logger.exception('Could not update the synchronous standbys')
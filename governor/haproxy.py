@@ -0,0 +1,214 @@
+import logging
+import os
+import shlex
+import socket
+import subprocess
+import tempfile
+
+from urllib.parse import urlparse
+
+from governor.dcs import DCSError
+
+logger = logging.getLogger(__name__)
+
+# the backends of haproxy.cfg whose servers follow the members, and the options of their servers
+BACKENDS = {
+    'bk_db': 'maxconn 100 check port {port} inter 1s fall 2 rise 1 on-marked-down shutdown-sessions',
+    'bk_db_replicas': 'maxconn 100 check port {port} inter 1s fall 2 rise 1',
+}
+
+class HAProxyError(Exception):
+    pass
+
+def servers(cluster):
+    """{server name: (address, check port)} of the members which advertise a health check address.
+
+    Both pools get every member, the /master and /replica checks decide which ones serve.
+    """
+    result = {}
+    for member in cluster.members.values():
+        if not member.api:
+            continue
+        url = urlparse(member.url)
+        if not url.hostname:
+            continue
+        _, colon, check_port = member.api.rpartition(':')
+        try:
+            address = '{}:{}'.format(url.hostname, url.port or 5432)
+            if not colon:
+                raise ValueError('no port')
+            result['postgresql_' + member.name] = (address, int(check_port))
+        except ValueError as e:
+            # one bad record must not stop the others from being synced
+            logger.warning('Skipping member %s, malformed url %r or api %r: %s', member.name, member.url, member.api, e)
+    return result
+
+def server_line(backend, name, address, check_port):
+    return 'server {} {} {}'.format(name, address, BACKENDS[backend].format(port=check_port))
+
+def render(config, servers):
+    """`config` with the server lines of the managed backends replaced by `servers`."""
+    sections = [[]]
+    for line in config.splitlines():
+        if line[:1].strip() and not line.startswith('#'):
+            sections.append([])
+        sections[-1].append(line)
+
+    lines = []
+    for section in sections:
+        words = section[0].split() if section else []
+        if len(words) > 1 and words[0] == 'backend' and words[1] in BACKENDS:
+            old = [i for i, line in enumerate(section) if line.strip().startswith('server ')]
+            section = [line for i, line in enumerate(section) if i not in old]
+            if old:
+                # where the first server was
+                end = old[0]
+            else:
+                end = len(section)
+                while end > 1 and not section[end - 1].strip():
+                    end -= 1
+            section[end:end] = ['  ' + server_line(words[1], name, *servers[name]) for name in sorted(servers)]
+        lines.extend(section)
+    return '\n'.join(lines) + '\n'
+
+class RuntimeApi:
+    """Client of the haproxy runtime API on a stats socket, one connection per command."""
+
+    TIMEOUT = 5
+
+    def __init__(self, path):
+        self.path = path
+
+    def execute(self, command, expect=None):
+        """Runs `command`, raising HAProxyError unless the response starts with one of `expect`."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.TIMEOUT)
+            sock.connect(self.path)
+            sock.sendall(command.encode('utf-8') + b'\n')
+            chunks = []
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                chunks.append(data)
+        response = b''.join(chunks).decode('utf-8').strip()
+        if expect is None and response or expect is not None and not response.startswith(expect):
+            raise HAProxyError('{}: {}'.format(command, response))
+        return response
+
+    def servers(self, backend):
+        """{server name: address} of `backend` as haproxy runs it."""
+        lines = self.execute('show servers state ' + backend, expect=('1',)).splitlines()
+        header = lines[1].lstrip('# ').split() if len(lines) > 1 else []
+        result = {}
+        for line in lines[2:]:
+            fields = dict(zip(header, line.split()))
+            if fields.get('be_name') == backend:
+                result[fields['srv_name']] = '{}:{}'.format(fields['srv_addr'], fields['srv_port'])
+        return result
+
+class HAProxy:
+    """Keeps the servers of the haproxy backends in line with the members of the cluster.
+
+    Changes are applied through the runtime API when a stats socket is given, without
+    dropping the connections to the servers which stay. The configuration file is always
+    rendered again, atomically, so a restarted haproxy comes up with the same servers, and
+    haproxy is reloaded with `reload_command` when the runtime API could not be used.
+    """
+
+    def __init__(self, config_path, socket_path=None, reload_command=None):
+        self.config_path = config_path
+        self.runtime = socket_path and RuntimeApi(socket_path)
+        self.reload_command = reload_command
+        self._reload_pending = False
+
+    def write_config(self, servers):
+        """Renders the configuration file, returns whether it changed."""
+        with open(self.config_path) as f:
+            old = f.read()
+        new = render(old, servers)
+        if new == old:
+            return False
+        directory = os.path.dirname(os.path.abspath(self.config_path))
+        fd, path = tempfile.mkstemp(dir=directory, prefix='.haproxy')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(new)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(path, os.stat(self.config_path).st_mode & 0o7777)
+            os.replace(path, self.config_path)
+        except OSError:
+            os.unlink(path)
+            raise
+        return True
+
+    def update_runtime(self, servers):
+        """Adds, moves and removes servers through the runtime API, returns what was done."""
+        changes = []
+        for backend in sorted(BACKENDS):
+            running = self.runtime.servers(backend)
+            for name in sorted(set(running) - set(servers)):
+                server = '{}/{}'.format(backend, name)
+                self.runtime.execute('disable server ' + server)
+                self.runtime.execute('shutdown sessions server ' + server)
+                self.runtime.execute('del server ' + server, expect=('Server deleted',))
+                changes.append('removed ' + server)
+            for name, (address, check_port) in sorted(servers.items()):
+                server = '{}/{}'.format(backend, name)
+                if name not in running:
+                    options = BACKENDS[backend].format(port=check_port)
+                    self.runtime.execute('add server {} {} {}'.format(server, address, options),
+                                         expect=('New server registered',))
+                    # dynamic servers start in maintenance and without checks
+                    self.runtime.execute('enable health ' + server)
+                    self.runtime.execute('enable server ' + server)
+                    changes.append('added ' + server)
+                elif running[name] != address:
+                    host, _, port = address.rpartition(':')
+                    self.runtime.execute('set server {} addr {} port {}'.format(server, host, port),
+                                         expect=('IP changed', 'no need to change', 'port changed'))
+                    changes.append('moved {} to {}'.format(server, address))
+        return changes
+
+    def reload(self):
+        logger.info('Reloading haproxy: %s', self.reload_command)
+        if subprocess.call(shlex.split(self.reload_command)):
+            raise HAProxyError('{} failed'.format(self.reload_command))
+
+    def apply(self, servers):
+        if self.write_config(servers):
+            logger.info('Rendered %s servers into %s', len(servers), self.config_path)
+            self._reload_pending = True
+        if self.runtime:
+            try:
+                changes = self.update_runtime(servers)
+            except (OSError, HAProxyError) as e:
+                logger.warning('Could not update haproxy through the runtime API: %s', e)
+            else:
+                if changes:
+                    logger.info('Updated haproxy: %s', ', '.join(changes))
+                self._reload_pending = False
+                return
+        if self._reload_pending and self.reload_command:
+            self.reload()
+            self._reload_pending = False
+
+    def sync(self, view, interval):
+        """Applies the members of the cluster whenever they change, and every `interval` seconds."""
+        applied = None
+        while True:
+            try:
+                cluster = view.cluster()
+            except DCSError as e:
+                logger.error('Error reading the cluster: %s', e)
+                view.wait_for_change(None, interval)
+                continue
+            wanted = servers(cluster)
+            if wanted != applied or self._reload_pending:
+                try:
+                    self.apply(wanted)
+                    applied = wanted
+                except (OSError, HAProxyError) as e:
+                    logger.error('Could not apply the members to haproxy: %s', e)
+            view.wait_for_change(cluster.changed_index, interval)
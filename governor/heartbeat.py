@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+
+from governor.dcs import DCSError
+
+logger = logging.getLogger(__name__)
+
+class Heartbeat(threading.Thread):
+    """Renews the member key, and the leader key while we hold it, from its own thread.
+
+    The HA cycle can block on Postgres for a long time (query retries sleep between
+    attempts), so renewal does not wait for it. Renewal goes on as long as Postgres
+    answered a query within `health_timeout` seconds; once that verdict goes stale
+    nothing is renewed any more until Postgres answers again.
+
+    A stale leader is demoted right away when the HA loop is between cycles, and the
+    leader key is released once it is. A loop stuck in a cycle holds the lock of the HA,
+    so the key is left to expire within the ttl instead, and the loop demotes whenever
+    it gets to its next cycle. Nothing else the heartbeat finds out is acted on here: a
+    lost leader key wakes up the HA loop.
+    """
+
+    def __init__(self, governor, interval, health_timeout):
+        super().__init__()
+        self.daemon = True
+        self.governor = governor
+        self.ha = governor.ha
+        self.psql = governor.psql
+        self.interval = interval
+        self.health_timeout = health_timeout
+        self.released = False   # we gave up the leader key since Postgres last answered
+        self._demote = threading.Event()
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def is_stale(self):
+        return time.time() - self.psql.responded_at > self.health_timeout
+
+    def beat(self):
+        if self.is_stale():
+            if self.ha.has_lock and not self.released:
+                logger.error('Postgres did not answer for more than %s seconds, giving up the leader lock',
+                             self.health_timeout)
+                self.released = True
+                try:
+                    if not self.fence():
+                        self._demote.set()
+                finally:
+                    self.ha.view.wake()
+            return False
+
+        self.released = False
+        if not self.governor.touch_member(self.ha.has_lock):
+            logger.warning('Lost the leader lock')
+            self.ha.view.wake()
+        return True
+
+    def fence(self):
+        """Demotes postgres and releases the leader key unless the HA loop is busy with a cycle."""
+        if not self.ha.lock.acquire(timeout=self.interval):
+            logger.error('The HA loop is stuck, leaving the leader key to expire')
+            return False
+        try:
+            return self.ha.step_down()
+        finally:
+            self.ha.lock.release()
+
+    def step_down_if_released(self):
+        """Demotes Postgres from the HA loop when the heartbeat could not fence it."""
+        if not self._demote.is_set():
+            return False
+        self._demote.clear()
+        self.ha.step_down()
+        return True
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.beat()
+            except DCSError:
+                logger.exception('Error renewing keys in the DCS')
+            except Exception:
+                logger.exception('Unexpected error in the heartbeat')
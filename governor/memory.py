@@ -0,0 +1,198 @@
+import collections
+import os
+import threading
+import time
+
+from governor.dcs import AbstractDCS, ClusterView, DCSConnectionError, AlreadyExists, CompareFailed, \
+    KeyNotFound, HistoryCleared
+
+class SimulatedClock:
+    """Clock which only moves when it is told to, so that TTLs expire deterministically."""
+
+    def __init__(self, now=0.0):
+        self.now = now
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        with self._lock:
+            self.now += seconds
+
+class Event:
+    __slots__ = ('action', 'key', 'value', 'modifiedIndex', 'dir')
+
+    def __init__(self, action, key, value, index):
+        self.action = action
+        self.key = key
+        self.value = value
+        self.modifiedIndex = index
+        self.dir = False
+
+class Store:
+    """Thread-safe key-value store with TTLs, shared by all the clients of one simulated cluster."""
+
+    def __init__(self, clock=time, history=1000):
+        self.clock = clock
+        self.index = 0
+        self.nodes = {}
+        self.history = collections.deque(maxlen=history)
+        self._condition = threading.Condition()
+
+    def _event(self, action, key, value):
+        self.index += 1
+        event = Event(action, key, value, self.index)
+        self.history.append(event)
+        self._condition.notify_all()
+        return event
+
+    def _expire(self):
+        now = self.clock.time()
+        for key, (_, expires, _, _) in list(self.nodes.items()):
+            if expires is not None and expires <= now:
+                del self.nodes[key]
+                self._event('expire', key, None)
+
+    def set(self, key, value, ttl=None, prev_exist=None, prev_value=None):
+        with self._condition:
+            self._expire()
+            node = self.nodes.get(key)
+            if prev_exist is False and node:
+                raise AlreadyExists(key)
+            if prev_value is not None:
+                if not node:
+                    raise KeyNotFound(key)
+                if node[0] != prev_value:
+                    raise CompareFailed(key)
+            event = self._event('set' if node else 'create', key, value)
+            expires = None if ttl is None else self.clock.time() + ttl
+            created = node[3] if node else event.modifiedIndex
+            self.nodes[key] = (value, expires, event.modifiedIndex, created)
+            return event
+
+    def delete(self, key, prev_value=None):
+        with self._condition:
+            self._expire()
+            node = self.nodes.get(key)
+            if not node:
+                raise KeyNotFound(key)
+            if prev_value is not None and node[0] != prev_value:
+                raise CompareFailed(key)
+            del self.nodes[key]
+            return self._event('delete' if prev_value is None else 'compareAndDelete', key, None)
+
+    def read(self, prefix):
+        with self._condition:
+            self._expire()
+            nodes = [Event('get', key, value, index) for key, (value, _, index, _) in sorted(self.nodes.items())
+                     if key.startswith(prefix)]
+            return nodes, self.index
+
+    def list(self, prefix):
+        """Returns (key, value) of the keys starting with prefix, in creation order."""
+        with self._condition:
+            self._expire()
+            nodes = sorted((created, key, value) for key, (value, _, _, created) in self.nodes.items()
+                           if key.startswith(prefix))
+            return [(key, value) for _, key, value in nodes]
+
+    def watch(self, prefix, index, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                self._expire()
+                full = len(self.history) == self.history.maxlen
+                if full and index < self.history[0].modifiedIndex:
+                    raise HistoryCleared('Index {} was cleared'.format(index))
+                events = [e for e in self.history if e.modifiedIndex >= index and e.key.startswith(prefix)]
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events
+                # expiries are lazy, so wake up now and then to apply them
+                self._condition.wait(min(remaining, 0.1))
+
+class Client(AbstractDCS):
+    """In-memory DCS client, one per simulated member.
+
+    Every call is counted in `requests` and fails with DCSConnectionError while the
+    client is partitioned away from the store.
+    """
+
+    def __init__(self, store, scope='/governor', ttl=30):
+        self.store = store
+        self.scope = scope
+        self.ttl = ttl
+        self.partitioned = False
+        self.requests = collections.Counter()
+
+    def _call(self, method):
+        self.requests[method] += 1
+        if self.partitioned:
+            raise DCSConnectionError('{} is partitioned away from the DCS'.format(self.scope))
+
+    def _key(self, name):
+        return os.path.join(self.scope, name)
+
+    def cluster_view(self):
+        return ClusterView(self, threaded=False, clock=self.store.clock)
+
+    def touch_member(self, name, value):
+        self._call('touch_member')
+        return self.store.set(self._key(name), value, ttl=self.ttl)
+
+    def delete_member(self, name):
+        self._call('delete_member')
+        return self.store.delete(self._key(name))
+
+    def write_optime(self, value):
+        self._call('write_optime')
+        return self.store.set(self._key(self.OPTIME_KEY), str(value))
+
+    def write_sync(self, value):
+        self._call('write_sync')
+        return self.store.set(self._key(self.SYNC_KEY), value)
+
+    def init_cluster(self, value):
+        self._call('init_cluster')
+        return self.store.set(self._key(self.INIT_KEY), value, prev_exist=False)
+
+    def take_leadership(self, value, force=False):
+        self._call('take_leadership')
+        return self.store.set(self._key(self.LEADER_KEY), value, ttl=self.ttl, prev_exist=None if force else False)
+
+    def update_leadership(self, value):
+        self._call('update_leadership')
+        return self.store.set(self._key(self.LEADER_KEY), value, ttl=self.ttl, prev_value=value)
+
+    def vacate_leadership(self, value):
+        self._call('vacate_leadership')
+        return self.store.delete(self._key(self.LEADER_KEY), prev_value=value)
+
+    def transfer_leadership(self, value, target):
+        self._call('transfer_leadership')
+        return self.store.set(self._key(self.LEADER_KEY), target, ttl=self.ttl, prev_value=value)
+
+    def create_key(self, name, value, ttl):
+        self._call('create_key')
+        return self.store.set(self._key(name), value, ttl=ttl, prev_exist=False)
+
+    def refresh_key(self, name, value, ttl):
+        self._call('refresh_key')
+        return self.store.set(self._key(name), value, ttl=ttl, prev_value=value)
+
+    def delete_key(self, name, value):
+        self._call('delete_key')
+        return self.store.delete(self._key(name), prev_value=value)
+
+    def list_keys(self, directory):
+        self._call('list_keys')
+        return [(os.path.basename(key), value) for key, value in self.store.list(self._key(directory) + '/')]
+
+    def load_scope(self):
+        self._call('load_scope')
+        return self.store.read(self._key(''))
+
+    def watch_scope(self, index, timeout):
+        self._call('watch_scope')
+        return self.store.watch(self._key(''), index, timeout)
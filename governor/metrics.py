@@ -0,0 +1,160 @@
+import bisect
+import contextlib
+import threading
+import time
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Timer(contextlib.ContextDecorator):
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def _recreate_cm(self):
+        # a decorated function may run in several threads at once
+        return Timer(self.metric)
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metric.observe(time.time() - self.started)
+        return False
+
+class Metric:
+    """Base of the metric types: a name, help text and optional labels.
+
+    A metric with labels hands out one child per combination of label values, which is
+    what gets updated; a metric without labels is updated directly.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        self._init()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _init(self):
+        pass
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self.__class__.__new__(self.__class__)
+                    child.name, child._lock = self.name, threading.Lock()
+                    child._init()
+        return child
+
+    def children(self):
+        """The label values of all the children."""
+        return list(self._children)
+
+    def remove(self, *values):
+        """Stops exporting the child of a label combination which went away."""
+        with self._lock:
+            self._children.pop(tuple(str(v) for v in values), None)
+
+    def samples(self):
+        """Returns (suffix, label values, extra labels, value) of all the children."""
+        children = sorted(self._children.items()) if self.labelnames else [((), self)]
+        for values, child in children:
+            for suffix, extra, value in child._samples():
+                yield suffix, values, extra, value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+        for suffix, values, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(self.labelnames, values, extra),
+                                            _format_value(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _init(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def _samples(self):
+        yield '', (), self.value
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _init(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def _samples(self):
+        yield '', (), self.value
+
+class Histogram(Metric):
+    type = 'histogram'
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, float('inf'))
+
+    def _init(self):
+        self.buckets = [0] * len(self.BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.BUCKETS, value)
+        with self._lock:
+            self.buckets[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Observes the duration of a with block or of every call of a decorated function."""
+        return Timer(self)
+
+    def _samples(self):
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS, self.buckets):
+            cumulative += count
+            yield '_bucket', (('le', _format_value(bound)),), cumulative
+        yield '_sum', (), self.sum
+        yield '_count', (), self.count
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format."""
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+REGISTRY = Registry()
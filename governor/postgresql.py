@@ -1,28 +1,156 @@
 import logging
 import os
+import re
 import psycopg2
+import psycopg2.extras
 import time
 import shlex
 import subprocess
 import shutil
-import threading
 
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
 from urllib.parse import urlparse
 
+from governor import topology
+from governor.metrics import Counter, Gauge, Histogram
+from governor.supervisor import Supervisor
+from governor.trace import span
+
 logger = logging.getLogger(__name__)
 
+QUERY_SECONDS = Histogram('governor_postgres_query_seconds', 'Duration of queries to the local postgres')
+QUERY_RETRIES = Counter('governor_postgres_query_retries_total', 'Queries attempted again after a connection error')
+PG_CTL_SECONDS = Histogram('governor_pg_ctl_seconds', 'Duration of pg_ctl runs, one fork each', ['command'])
+SLOT_CHANGES = Counter('governor_replication_slot_changes_total', 'Replication slots created or dropped',
+                       ['action'])
+SLOT_RETAINED = Gauge('governor_replication_slot_retained_bytes', 'WAL retained by a replication slot', ['slot'])
+
+class State:
+    """Snapshot of local Postgres, taken with one query at the start of every HA cycle.
+
+    `slots` maps the physical replication slots to the bytes of WAL they retain, None when
+    they reserve none, and whether a walsender is using them.
+    """
+
+    __slots__ = ('in_recovery', 'current_lsn', 'receive_lsn', 'replay_lsn', 'timeline', 'slots')
+
+    def __init__(self, in_recovery, current_lsn=None, receive_lsn=None, replay_lsn=None, timeline=None, slots=None):
+        self.in_recovery = in_recovery
+        self.current_lsn = current_lsn
+        self.receive_lsn = receive_lsn
+        self.replay_lsn = replay_lsn
+        self.timeline = timeline
+        self.slots = slots or {}
+
+    @property
+    def is_leader(self):
+        return not self.in_recovery
+
+    @property
+    def position(self):
+        return self.replay_lsn if self.in_recovery else self.current_lsn
+
+    def member_state(self):
+        return {'in_recovery': self.in_recovery, 'lsn': self.position, 'receive_lsn': self.receive_lsn,
+                'timeline': self.timeline}
+
+def _lsn(value):
+    return None if value is None else int(value)
+
+class CloneProgress:
+    """Progress of a basebackup, parsed from the output of pg_basebackup -P."""
+
+    __slots__ = ('source', 'started', 'updated', 'done', 'total', 'rate', 'wal_lag')
+
+    PATTERN = re.compile(r'(\d+)/(\d+) kB')
+    RATE_WEIGHT = 0.2
+
+    def __init__(self, source, now=None):
+        self.source = source
+        self.started = self.updated = now or time.time()
+        self.done = self.total = 0
+        self.rate = None
+        self.wal_lag = None
+
+    def parse(self, line, now=None):
+        match = self.PATTERN.search(line)
+        if not match:
+            return False
+        now = now or time.time()
+        done, self.total = int(match.group(1)) * 1024, int(match.group(2)) * 1024
+        if now > self.updated:
+            # pg_basebackup reports about once a second, smooth the rate over a few reports
+            rate = (done - self.done) / (now - self.updated)
+            self.rate = rate if self.rate is None else (1 - self.RATE_WEIGHT) * self.rate + self.RATE_WEIGHT * rate
+        self.done, self.updated = done, now
+        return True
+
+    @property
+    def eta(self):
+        if not self.rate:
+            return None
+        return max(self.total - self.done, 0) / self.rate
+
+    def to_record(self):
+        return {
+            'source': self.source,
+            'bytes': self.done,
+            'total': self.total,
+            'rate': self.rate and int(self.rate),
+            'eta': self.eta and int(self.eta),
+            'wal_lag': self.wal_lag,
+        }
+
+    def __str__(self):
+        return '{}/{} MB ({:.0f}%) from {}, {:.1f} MB/s, eta {}s, wal lag {}'.format(
+            self.done >> 20, self.total >> 20, 100.0 * self.done / self.total if self.total else 0, self.source,
+            (self.rate or 0) / (1 << 20), self.eta and int(self.eta), self.wal_lag)
+
+def parse_lsn(lsn):
+    high, _, low = lsn.partition('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+def parse_history(history):
+    """Parses a timeline history file into (parent timeline, switch point) pairs."""
+    for line in history.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].isdigit():
+            yield int(fields[0]), parse_lsn(fields[1])
+
+def process_start_time(pid):
+    """Start time of `pid` in seconds since the epoch, None when /proc can not tell."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            stat = f.read()
+        with open('/proc/stat') as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith('btime '))
+    except (OSError, StopIteration):
+        return None
+    # the command name may contain spaces, the fields after it start with field 3
+    ticks = int(stat.rpartition(')')[2].split()[19])
+    return boot_time + ticks / os.sysconf('SC_CLK_TCK')
+
 class Postgresql:
     CONN_OPTIONS = {
         'connect_timeout': 3,
         'options': '-c statement_timeout=2000',
         }
+    # overall time budget for probing all the other members during an election
+    PROBE_TIMEOUT = 5
+    # postmaster.pid holds a whole second, /proc the boot time in whole seconds
+    START_TIME_TOLERANCE = 2
 
     _conn = None
     _cursor_holder = None
+    _postmaster = None
+    needs_resync = False    # left stopped, the data directory cannot follow the leader as it is
 
-    def __init__(self, config, psql_config):
+    def __init__(self, config, psql_config, supervisor=None):
         self.config = config
         self.psql_config = psql_config
+        self.supervisor = supervisor or Supervisor()
+        self.on_exit = None     # called when the postmaster we started exits
+        self.reclone = None     # replaces the data directory with a new basebackup of the cluster
 
         self.name = config.name
         self.listen_addresses, self.port = config.listen_address.split(':')
@@ -33,7 +161,11 @@ class Postgresql:
         self._pg_ctl = ('pg_ctl', '-w', '-D', self.data_dir)
 
         self.members = set()    # list of already existing replication slots
+        self._over_budget = {}  # slot: since when it retains more WAL than allowed
         self.promoted = False
+        self.responded_at = 0   # when postgres last answered a query
+        self.state = None       # last snapshot, None when postgres did not answer
+        self.synchronous_standby_names = None   # as last set by us, None when unknown
 
     def parseurl(self, url):
         r = urlparse('postgres://' + url)
@@ -51,7 +183,8 @@ class Postgresql:
     def pg_ctl(self, *args, **kwargs):
         cmd = self._pg_ctl + args
         logger.info(cmd)
-        return subprocess.call(cmd, **kwargs)
+        with PG_CTL_SECONDS.labels(args[0]).time(), span('pg_ctl ' + args[0]):
+            return self.supervisor.call(cmd, **kwargs)
 
     def connection(self):
         if not self._conn or self._conn.closed:
@@ -80,9 +213,13 @@ class Postgresql:
 
         for i in range(max_attempts):
             ex = None
+            if i:
+                QUERY_RETRIES.inc()
             try:
                 cursor = self._cursor()
-                cursor.execute(sql, params)
+                with QUERY_SECONDS.time(), span('query'):
+                    cursor.execute(sql, params)
+                self.responded_at = time.time()
                 return cursor
             except psycopg2.InterfaceError as e:
                 ex = e
@@ -100,13 +237,15 @@ class Postgresql:
         return not (os.path.exists(self.data_dir) and os.listdir(self.data_dir))
 
     def initialize(self):
-        if subprocess.call(['initdb', '-D', self.data_dir, '--encoding', 'UTF-8']) == 0:
+        if self.supervisor.call(['initdb', '-D', self.data_dir, '--encoding', 'UTF-8']) == 0:
             self.write_pg_hba()
             return True
         return False
 
-    def sync_from_leader(self, leader):
-        r = self.parseurl(leader.value)
+    def sync_from_leader(self, leader, on_progress=None):
+        # postgresql.auto.conf comes along with the copy
+        self.synchronous_standby_names = None
+        r = self.parseurl(leader.url)
         env = os.environ.copy()
 
         if r['password'] is not None:
@@ -116,43 +255,115 @@ class Postgresql:
                 f.write('{host}:{port}:*:{user}:{password}\n'.format(**r))
             env['PGPASSFILE'] = pgpass
 
+        cmd = [
+            'pg_basebackup', '-P', '-w',
+            '-D', self.data_dir,
+            '--host', r['host'],
+            '--port', str(r['port']),
+            '-U', self.config.repl_user,
+            # tells the walsender of the clone apart in pg_stat_replication of the source, the
+            # recovery.conf written after the clone streams under the member name
+            '--dbname', 'application_name={}'.format(self.clone_application_name),
+        ]
+        if self.config.max_rate:
+            cmd.append('--max-rate={}'.format(self.config.max_rate))
+
+        progress = CloneProgress(leader.name)
+        proc = self.supervisor.popen(cmd, env=env, stderr=subprocess.PIPE, universal_newlines=True)
         try:
-            subprocess.check_call([
-                'pg_basebackup', '-R', '-P', '-w',
-                '-D', self.data_dir,
-                '--host', r['host'],
-                '--port', str(r['port']),
-                '-U', self.config.repl_user,
-            ], env=env)
-        except subprocess.CalledProcessError:
-            return False
+            # the progress report ends with a carriage return, which universal newlines splits on
+            for line in proc.stderr:
+                if progress.parse(line):
+                    if on_progress:
+                        on_progress(progress)
+                elif line.strip():
+                    logger.info('pg_basebackup: %s', line.strip())
         finally:
+            self.supervisor.wait(proc)
             os.chmod(self.data_dir, 0o700)
+        if proc.returncode != 0:
+            logger.error('pg_basebackup from %s exited with code %s', leader.name, proc.returncode)
+            return False
+        # the copy of a replica brings along the recovery.conf pointing at its own upstream
+        for path in (self.recovery_conf, self.recovery_conf + '.backup'):
+            if os.path.exists(path):
+                os.remove(path)
+        logger.info('Cloned %s MB from %s in %.0f seconds', progress.done >> 20, leader.name,
+                    time.time() - progress.started)
         return True
 
+    @property
+    def clone_application_name(self):
+        return 'governor_clone_{}'.format(self.name)
+
+    def clone_wal_lag(self, source):
+        """Bytes of WAL the source generated but did not yet send to our running basebackup."""
+        r = self.parseurl(source.url)
+        r.update(user=self.config.user, password=self.config.password)
+        conn = psycopg2.connect(**r)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_xlog_replay_location()
+                                           ELSE pg_current_xlog_location() END - sent_location
+                                FROM pg_stat_replication WHERE application_name = %s""",
+                           (self.clone_application_name, ))
+            row = cursor.fetchone()
+        finally:
+            conn.close()
+        return int(row[0]) if row and row[0] is not None else None
+
     def is_leader(self):
         is_leader = not self.query('SELECT pg_is_in_recovery()').fetchone()[0]
         if is_leader:
             self.promoted = False
         return is_leader
 
+    def postmaster_alive(self):
+        """Checks postmaster.pid the way pg_ctl status does, without forking.
+
+        Returns None when the answer needs pg_ctl after all.
+        """
+        try:
+            with open(self.pid_path) as f:
+                pid, data_dir, start_time = f.read().splitlines()[:3]
+            pid, start_time = int(pid), int(start_time)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            # partially written during startup
+            return None
+
+        if pid <= 0:
+            # negative in single user mode
+            return None
+        if os.path.realpath(data_dir) != os.path.realpath(self.data_dir):
+            logger.warning('%s belongs to %s', self.pid_path, data_dir)
+            return False
+        try:
+            os.kill(pid, 0)
+        except (ProcessLookupError, PermissionError):
+            return False
+
+        started = process_start_time(pid)
+        if started is None:
+            return None
+        if abs(started - start_time) > self.START_TIME_TOLERANCE:
+            logger.warning('Pid %s from %s was reused by another process', pid, self.pid_path)
+            return False
+        return True
+
     def is_running(self):
+        if self._postmaster and self._postmaster.poll() is None:
+            return True
+        alive = self.postmaster_alive()
+        if alive is not None:
+            return alive
         return self.pg_ctl('status', stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
 
-    def start_threaded(self):
-        logger = logging.getLogger('postgres')
-        cmd = [
-            'postgres', '-i',
-            '-p', self.port,
-            '-h', self.listen_addresses,
-            '-D', self.data_dir,
-            ] + self.psql_config
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-        while True:
-            line = proc.stdout.readline()
-            if not line:
-                break
-            logging.info(line)
+    def postmaster_exited(self, proc):
+        self.state = None
+        if self.on_exit:
+            self.on_exit()
 
     def start(self):
         if self.is_running():
@@ -165,9 +376,17 @@ class Postgresql:
             logger.info('Removed %s', self.pid_path)
 
         self.disconnect()
-        thread = threading.Thread(target=self.start_threaded)
-        thread.daemon = True
-        thread.start()
+        cmd = [
+            'postgres', '-i',
+            '-p', self.port,
+            '-h', self.listen_addresses,
+            '-D', self.data_dir,
+            ]
+        if self.config.use_pg_rewind:
+            # pg_rewind needs hint bit changes in the WAL unless the cluster has data checksums
+            cmd += ['-c', 'wal_log_hints=on']
+        cmd += self.psql_config
+        self._postmaster = self.supervisor.start(cmd, logging.getLogger('postgres'), self.postmaster_exited)
         return True
 
     def stop(self):
@@ -187,31 +406,68 @@ class Postgresql:
             return False
         return True
 
-    def is_healthiest_node(self, cluster):
-        if self.is_leader():
+    def probe_member(self, name, url, position):
+        member_conn = psycopg2.connect(**self.parseurl(url))
+        try:
+            member_conn.autocommit = True
+            member_cursor = member_conn.cursor()
+            member_cursor.execute(
+                "SELECT pg_is_in_recovery(), %s - (pg_last_xlog_replay_location() - '0/0000000'::pg_lsn)",
+                (position, ))
+            row = member_cursor.fetchone()
+            member_cursor.close()
+        finally:
+            member_conn.close()
+        logger.info([self.name, name, row])
+        return row
+
+    @span('is_healthiest_node')
+    def is_healthiest_node(self, cluster, state=None):
+        if state is None:
+            if self.is_leader():
+                return True
+            position = self.xlog_position()
+        elif state.is_leader:
             return True
+        else:
+            position = state.position
 
-        if int(cluster.optime.value) - self.xlog_position() > self.config.maximum_lag:
+        if cluster.optime is not None and cluster.optime - position > self.config.maximum_lag:
             return False
 
+        members = []
         for name, m in cluster.members.items():
             if name == self.name:
                 continue
-            try:
-                member_conn = psycopg2.connect(**self.parseurl(m.value))
-                member_conn.autocommit = True
-                member_cursor = member_conn.cursor()
-                member_cursor.execute(
-                    "SELECT pg_is_in_recovery(), %s - (pg_last_xlog_replay_location() - '0/0000000'::pg_lsn)",
-                    (self.xlog_position(), ))
-                row = member_cursor.fetchone()
-                member_cursor.close()
-                member_conn.close()
-                logger.error([self.name, name, row])
+            if not m.has_state or name in cluster.stale:
+                # without a record of its state, or with one too old to go by, ask the member itself
+                members.append((name, m.url))
+            elif m.lsn is None:
+                # postgres of this member was not answering when it published its record
+                continue
+            elif not m.in_recovery or m.lsn > position:
+                logger.info('%s is healthier according to its record: %s', name, m.to_value())
+                return False
+
+        if not members:
+            return True
+
+        executor = ThreadPoolExecutor(max_workers=len(members))
+        try:
+            futures = {executor.submit(self.probe_member, name, url, position): name for name, url in members}
+            for future in as_completed(futures, timeout=self.PROBE_TIMEOUT):
+                try:
+                    row = future.result()
+                except psycopg2.Error:
+                    continue
                 if not row[0] or row[1] < 0:
                     return False
-            except psycopg2.Error:
-                continue
+        except TimeoutError:
+            logger.warning('Members did not answer within %s seconds: %s', self.PROBE_TIMEOUT,
+                           ', '.join(futures[f] for f in futures if not f.done()))
+        finally:
+            # do not wait for the probes which are still hanging in connect
+            executor.shutdown(wait=False)
         return True
 
     def write_pg_hba(self):
@@ -242,13 +498,15 @@ class Postgresql:
         values = ['{}={}'.format(k, r[k]) for k in ['user', 'host', 'port']]
         if r['password'] is not None:
             values.append('password={}'.format(r['password']))
+        # the leader tells its standbys apart by member name, in pg_stat_replication and synchronous_standby_names
+        values.append('application_name={}'.format(self.name))
         return '{} sslmode=prefer sslcompression=1'.format(' '.join(values))
 
     def check_recovery_conf(self, leader):
         if not os.path.isfile(self.recovery_conf):
             return False
 
-        pattern = (leader and self.primary_conninfo(leader.value))
+        pattern = (leader and self.primary_conninfo(leader.url))
         for key, value in RecoveryConf(self.recovery_conf).load_config():
             if key == 'primary_conninfo':
                 if not pattern:
@@ -264,17 +522,148 @@ class Postgresql:
         ]
         if leader:
             contents.append(('primary_slot_name', self.name))
-            contents.append(('primary_conninfo', self.primary_conninfo(leader.value)))
+            contents.append(('primary_conninfo', self.primary_conninfo(leader.url)))
 
         config = RecoveryConf(self.recovery_conf)
         config.write_config(*contents, truncate = not leader)
 
+    @span('follow_the_leader')
     def follow_the_leader(self, leader):
-        if not self.check_recovery_conf(leader):
+        """Points postgres at `leader`, or demotes it without one; False when it could not be (re)started."""
+        if not self.needs_resync and self.check_recovery_conf(leader):
+            return True
+        if leader and self.config.use_pg_rewind and (self.needs_resync or self.may_have_diverged(leader)):
+            self.stop()
+            self.needs_resync = not self.resync(leader)
+            if self.needs_resync:
+                # started as it is, it would not stream from the leader anyway
+                logger.error('Could not resync with %s, leaving postgres stopped', leader.name)
+                return False
+            self.write_recovery_conf(leader)
+            return self.start()
+        else:
             self.write_recovery_conf(leader)
-            self.restart()
+            return self.restart()
 
+    def may_have_diverged(self, leader):
+        """Whether following `leader` may need a rewind, judged by the timelines of the snapshot and the record."""
+        state = self.state
+        if state is None or state.is_leader or state.timeline is None or leader.timeline is None:
+            return True
+        return state.timeline != leader.timeline
+
+    def controldata(self):
+        env = dict(os.environ, LANG='C', LC_ALL='C')
+        output = self.supervisor.check_output(['pg_controldata', self.data_dir], env=env)
+        return dict((k.strip(), v.strip()) for k, _, v in (line.partition(':') for line in output.splitlines()) if v)
+
+    def local_position(self):
+        """Timeline and end of WAL of the stopped data directory."""
+        data = self.controldata()
+        if data['Database cluster state'] in ('in production', 'in crash recovery'):
+            # crashed, let crash recovery run to completion before looking
+            logger.info('Running crash recovery in single user mode')
+            self.supervisor.call(['postgres', '--single', '-D', self.data_dir, '-c', 'archive_mode=off', 'template1'],
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+            data = self.controldata()
+        lsn = parse_lsn(data['Latest checkpoint location'])
+        if data['Database cluster state'] == 'shut down in recovery':
+            lsn = max(lsn, parse_lsn(data['Minimum recovery ending location']))
+        return int(data["Latest checkpoint's TimeLineID"]), lsn
+
+    def leader_timeline(self, leader):
+        """Timeline of the leader and its history, over a replication connection."""
+        conn = psycopg2.connect(connection_factory=psycopg2.extras.PhysicalReplicationConnection,
+                                **self.parseurl(leader.url))
+        try:
+            cursor = conn.cursor()
+            cursor.execute('IDENTIFY_SYSTEM')
+            timeline = cursor.fetchone()[1]
+            history = []
+            if timeline > 1:
+                cursor.execute('TIMELINE_HISTORY {}'.format(timeline))
+                content = cursor.fetchone()[1]
+                history = list(parse_history(bytes(content).decode('utf-8') if isinstance(content, memoryview)
+                                             else content))
+        finally:
+            conn.close()
+        return timeline, history
+
+    def diverged(self, leader):
+        timeline, lsn = self.local_position()
+        leader_timeline, history = self.leader_timeline(leader)
+        if timeline == leader_timeline:
+            return False
+        if timeline < leader_timeline:
+            switch_point = dict(history).get(timeline)
+            if switch_point is not None and lsn <= switch_point:
+                return False
+        logger.info('Timeline %s at %X/%X diverged from the timeline %s of %s', timeline, lsn >> 32,
+                    lsn & 0xFFFFFFFF, leader_timeline, leader.name)
+        return True
+
+    @span('rewind')
+    def rewind(self, leader):
+        r = self.parseurl(leader.url)
+        # pg_rewind reads data files through SQL, which needs the superuser rather than the replication user
+        conninfo = 'host={} port={} user={} dbname={}'.format(r['host'], r['port'], self.config.user,
+                                                              self.config.dbname)
+        env = os.environ.copy()
+        if self.config.password:
+            env['PGPASSWORD'] = self.config.password
+        logger.info('Rewinding to %s', leader.name)
+        return self.supervisor.call(['pg_rewind', '-D', self.data_dir, '--source-server', conninfo], env=env) == 0
+
+    def remove_data_directory(self):
+        shutil.rmtree(self.data_dir)
+        os.mkdir(self.data_dir, 0o700)
+
+    @span('resync')
+    def resync(self, leader):
+        """Lets the stopped data directory follow `leader` if it can no longer stream from it.
+
+        Rewinds when the timelines diverged and clones with a basebackup through `reclone`
+        only when that fails, or when an earlier clone left the data directory empty.
+        """
+        if not self.data_directory_empty():
+            try:
+                if not self.diverged(leader):
+                    return True
+            except (psycopg2.Error, subprocess.CalledProcessError, KeyError, ValueError) as e:
+                logger.warning('Could not compare the timeline with %s: %s', leader.name, e)
+                return False
+            if self.rewind(leader):
+                return True
+            logger.error('pg_rewind failed')
+        if not self.reclone:
+            return False
+        logger.info('Cloning the data directory again')
+        return self.reclone(leader)
+
+    def checkpoint(self):
+        self.query('CHECKPOINT')
+
+    def replication_lag(self):
+        """{application_name: (bytes not flushed yet, sync_state)} of the streaming standbys."""
+        cursor = self.query("""SELECT application_name, pg_current_xlog_location() - flush_location, sync_state
+                                 FROM pg_stat_replication WHERE state = 'streaming'""")
+        return dict((name, (_lsn(lag), sync_state)) for name, lag, sync_state in cursor)
+
+    def set_synchronous_standbys(self, names):
+        """Makes commits wait for all of `names`, for none when empty. Returns whether it changed."""
+        value = '{} ({})'.format(len(names), ', '.join('"{}"'.format(n) for n in names)) if names else ''
+        if value == self.synchronous_standby_names:
+            return False
+        self.query('ALTER SYSTEM SET synchronous_standby_names = %s', value)
+        self.query('SELECT pg_reload_conf()')
+        logger.info('Set synchronous_standby_names to %r', value)
+        self.synchronous_standby_names = value
+        return True
+
+    @span('promote')
     def promote(self):
+        # standbys named by an earlier leader must not hold up the first commits
+        self.synchronous_standby_names = None
         self.promoted = (self.pg_ctl('promote') == 0)
         return self.promoted
 
@@ -291,6 +680,43 @@ class Postgresql:
             return self.query(query + ' ENCRYPTED PASSWORD %s', password)
         return self.query(query)
 
+    @span('collect_state')
+    def collect_state(self):
+        try:
+            cursor = self._cursor()
+            cursor.execute("""SELECT pg_is_in_recovery(),
+                                     CASE WHEN NOT pg_is_in_recovery()
+                                          THEN pg_current_xlog_location() - '0/0000000'::pg_lsn END,
+                                     pg_last_xlog_receive_location() - '0/0000000'::pg_lsn,
+                                     pg_last_xlog_replay_location() - '0/0000000'::pg_lsn,
+                                     CASE WHEN pg_is_in_recovery()
+                                          THEN (SELECT timeline_id FROM pg_control_checkpoint())
+                                          -- the checkpoint lags behind a promotion, the WAL file name does not
+                                          ELSE ('x' || substr(pg_xlogfile_name(pg_current_xlog_location()), 1, 8))
+                                               ::bit(32)::int END,
+                                     (SELECT json_object_agg(slot_name, json_build_array(
+                                                 CASE WHEN pg_is_in_recovery() THEN pg_last_xlog_replay_location()
+                                                      ELSE pg_current_xlog_location() END - restart_lsn, active))
+                                        FROM pg_replication_slots WHERE slot_type = 'physical')""")
+            in_recovery, current_lsn, receive_lsn, replay_lsn, timeline, slots = cursor.fetchone()
+            self.responded_at = time.time()
+        except psycopg2.Error:
+            # a single attempt is enough, the decisions fall back to querying when needed
+            self.disconnect()
+            self.state = None
+            return None
+
+        slots = dict((name, (_lsn(retained), active)) for name, (retained, active) in (slots or {}).items())
+        self.state = State(in_recovery, _lsn(current_lsn), _lsn(receive_lsn), _lsn(replay_lsn), timeline, slots)
+        if self.state.is_leader:
+            self.promoted = False
+        # the slots which really exist, so that leftovers of a previous run get dropped too
+        self.members = set(self.state.slots)
+        return self.state
+
+    def member_state(self):
+        return self.state.member_state() if self.state else {}
+
     def xlog_position(self):
         return self.query("""SELECT CASE WHEN pg_is_in_recovery()
                                          THEN pg_last_xlog_replay_location() - '0/0000000'::pg_lsn
@@ -301,22 +727,77 @@ class Postgresql:
         self.members = set(r[0] for r in cursor)
 
     def sync_replication_slots(self, members):
+        """Creates the slots of `members` and drops all the others, in a single statement.
+
+        Nothing is sent while the slots seen by the last snapshot are the ones wanted, so in
+        a steady cluster this costs no round trip at all. Slots still in use are left alone
+        until their walsender is gone.
+        """
         members = set(name for name in members if name != self.name)
-        # drop unused slots
-        for slot in self.members - members:
-            self.query("""SELECT pg_drop_replication_slot(%s)
-                           WHERE EXISTS(SELECT 1 FROM pg_replication_slots
-                           WHERE slot_name = %s)""", slot, slot)
-
-        # create new slots
-        for slot in members - self.members:
-            self.query("""SELECT pg_create_physical_replication_slot(%s)
-                           WHERE NOT EXISTS (SELECT 1 FROM pg_replication_slots
-                           WHERE slot_name = %s)""", slot, slot)
-        self.members = members
-
-    def create_replication_slots(self, cluster):
-        self.sync_replication_slots([name for name in cluster.members if name != self.name])
+        if members == self.members:
+            return
+        cursor = self.query("""WITH wanted AS (SELECT unnest(%s::text[]) AS slot_name),
+                                    dropped AS (SELECT slot_name::text, pg_drop_replication_slot(slot_name)
+                                                  FROM pg_replication_slots
+                                                 WHERE slot_type = 'physical' AND NOT active
+                                                   AND slot_name::text NOT IN (SELECT slot_name FROM wanted)),
+                                    created AS (SELECT slot_name, pg_create_physical_replication_slot(slot_name)
+                                                  FROM wanted
+                                                 WHERE slot_name NOT IN (SELECT slot_name::text
+                                                                           FROM pg_replication_slots))
+                               SELECT 'dropped', slot_name FROM dropped
+                                UNION ALL
+                               SELECT 'created', slot_name FROM created""", sorted(members))
+        changes = {'created': [], 'dropped': []}
+        for action, slot in cursor:
+            changes[action].append(slot)
+        for action, slots in sorted(changes.items()):
+            if slots:
+                SLOT_CHANGES.labels(action).inc(len(slots))
+                logger.info('Replication slots %s: %s', action, ', '.join(sorted(slots)))
+        # slots which were in use remain, and are tried again next time
+        self.members = members | (self.members - members - set(changes['dropped']))
+
+    def guard_replication_slots(self, now=None):
+        """Drops the unused slots which retained more than --max-slot-wal-keep bytes of WAL for
+        longer than --slot-grace-period, returns their names.
+
+        The slot of a member which is still around is created again right away, reserving
+        nothing until its replica streams again, if the WAL it needs is still there.
+        """
+        if self.state is None:
+            return []
+        for name, in SLOT_RETAINED.children():
+            if name not in self.state.slots:
+                SLOT_RETAINED.remove(name)
+        for name, (retained, _) in self.state.slots.items():
+            SLOT_RETAINED.labels(name).set(retained or 0)
+
+        budget = self.config.max_slot_wal_keep
+        if not budget:
+            return []
+        now = now or time.time()
+        self._over_budget = dict((name, self._over_budget.get(name, now))
+                                 for name, (retained, _) in self.state.slots.items()
+                                 if retained is not None and retained > budget)
+        expired = sorted(name for name, since in self._over_budget.items()
+                         if now - since >= self.config.slot_grace_period and not self.state.slots[name][1])
+        if not expired:
+            return []
+        dropped = [r[0] for r in self.query("""SELECT slot_name::text, pg_drop_replication_slot(slot_name)
+                                                 FROM pg_replication_slots
+                                                WHERE slot_name::text = ANY(%s) AND NOT active""", expired)]
+        for name in dropped:
+            logger.warning('Dropped replication slot %s, it retained %s bytes of WAL for more than %ss',
+                           name, self.state.slots[name][0], self.config.slot_grace_period)
+            self._over_budget.pop(name, None)
+        SLOT_CHANGES.labels('expired').inc(len(dropped))
+        self.members -= set(dropped)
+        return dropped
+
+    def create_replication_slots(self, cluster, leader):
+        """Keeps the slots of the members streaming from us in the tree rooted at `leader`."""
+        self.sync_replication_slots(topology.children(cluster, leader, self.name))
 
     def drop_replication_slots(self):
         self.sync_replication_slots([])
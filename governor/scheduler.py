@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+
+from governor.metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+OVERRUNS = Counter('governor_cycle_overruns_total', 'Cycles which took longer than the loop time')
+MISSED_REFRESHES = Counter('governor_missed_refreshes_total', 'Keys refreshed only after their ttl ran out')
+
+class Scheduler:
+    """Decides when the next HA cycle has to start.
+
+    Cycles normally start every `loop_time` seconds, measured from the start of the
+    previous cycle. For every key with a TTL (the member key and, on the leader, the
+    leader key) the scheduler remembers when it was last refreshed, how far into the
+    cycle the refresh happened and the measured DCS round trip time, and brings the next
+    cycle forward so that the key is refreshed `SAFETY_RTTS` round trips before it expires.
+    """
+
+    SAFETY_RTTS = 3
+    RTT_WEIGHT = 0.2
+
+    def __init__(self, loop_time, clock=time):
+        self.loop_time = loop_time
+        self.clock = clock
+        self.rtt = 0.0
+        self.cycle_started = None
+        self.in_cycle = False
+        self.overruns = 0
+        self.missed = 0
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def start_cycle(self):
+        self.cycle_started = self.clock.time()
+        self.in_cycle = True
+
+    def end_cycle(self):
+        self.in_cycle = False
+        duration = self.clock.time() - self.cycle_started
+        if duration > self.loop_time:
+            self.overruns += 1
+            OVERRUNS.inc()
+            logger.warning('Cycle took %.3f seconds, longer than the loop time of %s seconds', duration, self.loop_time)
+        return duration
+
+    def refreshed(self, key, ttl, started):
+        """Records a successful write of `key` with `ttl`, issued at `started`."""
+        now = self.clock.time()
+        self.rtt = (1 - self.RTT_WEIGHT) * self.rtt + self.RTT_WEIGHT * (now - started)
+
+        previous = self._keys.get(key)
+        if previous and previous[0] + previous[1] < started:
+            self.missed += 1
+            MISSED_REFRESHES.inc()
+            logger.error('The %s key was refreshed %.3f seconds after it expired', key,
+                         started - previous[0] - previous[1])
+        # the TTL starts counting somewhere during the request, assume the worst;
+        # refreshes done outside of a cycle (by the heartbeat) need no head start
+        offset = started - self.cycle_started if self.in_cycle else 0
+        with self._lock:
+            self._keys[key] = (started, ttl, offset)
+
+    def forget(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def next_cycle(self):
+        deadline = (self.cycle_started or self.clock.time()) + self.loop_time
+        with self._lock:
+            keys = list(self._keys.values())
+        for refreshed, ttl, offset in keys:
+            # the next cycle needs `offset` seconds to get to the refresh again
+            deadline = min(deadline, refreshed + ttl - offset - self.SAFETY_RTTS * self.rtt)
+        return deadline
+
+    def wait_time(self):
+        return max(self.next_cycle() - self.clock.time(), 0)
@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+
+from governor.dcs import DCSError, AlreadyExists, CompareFailed, KeyNotFound
+
+logger = logging.getLogger(__name__)
+
+def holders(tickets, limit, source_limit=0):
+    """Names of the tickets holding the semaphore, given all the tickets in creation order.
+
+    Tickets are served in order, skipping the ones whose source already has `source_limit`
+    holders, so every participant comes to the same answer from the same list.
+    """
+    result, per_source = [], {}
+    for name, source in tickets:
+        if len(result) >= limit:
+            break
+        if source_limit and per_source.get(source, 0) >= source_limit:
+            continue
+        per_source[source] = per_source.get(source, 0) + 1
+        result.append(name)
+    return result
+
+class Semaphore:
+    """Counting semaphore under `directory` of the scope, shared by the whole cluster.
+
+    Every participant creates a ticket, a TTL key named after itself holding the source it
+    works against, and the first `limit` tickets in creation order hold the semaphore. A
+    refresher thread keeps the ticket alive while waiting and holding, so the slot of a
+    participant which died is freed once its ticket expires.
+    """
+
+    POLL_INTERVAL = 5
+
+    def __init__(self, dcs, directory, name, limit, source_limit=0, ttl=None):
+        self.dcs = dcs
+        self.key = '{}/{}'.format(directory, name)
+        self.directory = directory
+        self.name = name
+        self.limit = limit
+        self.source_limit = source_limit
+        self.ttl = ttl or dcs.ttl
+        self.source = None
+        self._stopped = threading.Event()
+
+    def _create_ticket(self):
+        try:
+            self.dcs.create_key(self.key, self.source, self.ttl)
+        except AlreadyExists:
+            # left behind by a previous run of ours, queue again from the back
+            self.dcs.delete_key(self.key, dict(self.dcs.list_keys(self.directory)).get(self.name))
+            self.dcs.create_key(self.key, self.source, self.ttl)
+
+    def _refresh(self):
+        while not self._stopped.wait(self.ttl / 3.0):
+            try:
+                self.dcs.refresh_key(self.key, self.source, self.ttl)
+            except (CompareFailed, KeyNotFound):
+                logger.warning('Ticket %s expired, queueing again', self.key)
+                try:
+                    self._create_ticket()
+                except DCSError:
+                    logger.exception('Could not queue again for %s', self.directory)
+            except DCSError:
+                logger.exception('Could not refresh %s', self.key)
+
+    def position(self):
+        """0 when holding the semaphore, otherwise the position in the queue."""
+        tickets = self.dcs.list_keys(self.directory)
+        if self.name not in dict(tickets):
+            self._create_ticket()
+            tickets = self.dcs.list_keys(self.directory)
+        holding = holders(tickets, self.limit, self.source_limit)
+        if self.name in holding:
+            return 0
+        waiting = [name for name, _ in tickets if name not in holding]
+        return waiting.index(self.name) + 1 if self.name in waiting else len(waiting) + 1
+
+    def acquire(self, source):
+        self.source = source
+        self._stopped.clear()
+        self._create_ticket()
+        threading.Thread(target=self._refresh, daemon=True).start()
+
+        last = None
+        while True:
+            try:
+                position = self.position()
+            except DCSError:
+                logger.exception('Could not read the queue of %s', self.directory)
+                position = last
+            if position == 0:
+                logger.info('Acquired a %s slot', self.directory)
+                return
+            if position != last:
+                logger.info('Waiting for a %s slot, position %s in the queue', self.directory, position)
+                last = position
+            time.sleep(self.POLL_INTERVAL)
+
+    def release(self):
+        self._stopped.set()
+        try:
+            self.dcs.delete_key(self.key, self.source)
+        except (CompareFailed, KeyNotFound):
+            pass
+        except DCSError:
+            logger.exception('Could not release %s, it will expire', self.key)
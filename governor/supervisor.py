@@ -0,0 +1,188 @@
+import collections
+import logging
+import os
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+def zombie_children():
+    """Pids of the exited, not yet reaped children of this process, according to /proc."""
+    parent = os.getpid()
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return []
+    pids = []
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            continue
+        if fields[0] == 'Z' and int(fields[1]) == parent:
+            pids.append(int(entry))
+    return pids
+
+class LogPump:
+    """Forwards the output of a child process to logging without ever blocking the child.
+
+    A reader thread drains the pipe into a bounded buffer, dropping the oldest lines when
+    logging can not keep up, and a writer thread logs what is buffered in batches of at
+    most `BATCH` lines, at most `RATE` lines per second. Dropped lines are counted and
+    reported.
+    """
+
+    MAX_LINES = 10000
+    BATCH = 100
+    RATE = 1000
+
+    def __init__(self, stream, log, max_lines=MAX_LINES, rate=RATE):
+        self.stream = stream
+        self.log = log
+        self.rate = rate
+        self.lines = collections.deque(maxlen=max_lines)
+        self.dropped = 0
+        self.closed = False
+        self._condition = threading.Condition()
+
+    def start(self):
+        for target in (self._read, self._write):
+            threading.Thread(target=target, daemon=True).start()
+
+    def _read(self):
+        try:
+            for line in self.stream:
+                with self._condition:
+                    if len(self.lines) == self.lines.maxlen:
+                        self.dropped += 1
+                    self.lines.append(line.rstrip('\n'))
+                    self._condition.notify()
+        finally:
+            with self._condition:
+                self.closed = True
+                self._condition.notify()
+
+    def _write(self):
+        tokens, last = self.BATCH, time.time()
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self.lines or self.closed)
+                if not self.lines and self.closed:
+                    break
+                now = time.time()
+                tokens, last = min(self.rate, tokens + (now - last) * self.rate), now
+                count = min(len(self.lines), self.BATCH, int(tokens))
+                batch = [self.lines.popleft() for _ in range(count)]
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                self.log.warning('Dropped %s lines of output', dropped)
+            if batch:
+                tokens -= len(batch)
+                self.log.info('\n'.join(batch))
+            else:
+                time.sleep(1.0 / self.rate)
+
+class Supervisor:
+    """Starts and reaps child processes.
+
+    Children started through the supervisor are owned: they are reaped by whoever waits
+    for them. The SIGCHLD handler only wakes up the reaper thread, which reaps the zombie
+    children nobody owns, like orphans reparented to us when we run as pid 1, and leaves
+    the exit statuses of owned children alone.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owned = set()
+        self._spawning = 0
+        self._sigchld = threading.Event()
+
+    def popen(self, cmd, **kwargs):
+        with self._lock:
+            # the pid is only known after the fork, keep the reaper away until then
+            self._spawning += 1
+        try:
+            proc = subprocess.Popen(cmd, **kwargs)
+            with self._lock:
+                self._owned.add(proc.pid)
+        finally:
+            with self._lock:
+                self._spawning -= 1
+        return proc
+
+    def wait(self, proc, timeout=None):
+        try:
+            return proc.wait(timeout)
+        finally:
+            if proc.returncode is not None:
+                with self._lock:
+                    self._owned.discard(proc.pid)
+
+    def call(self, cmd, **kwargs):
+        proc = self.popen(cmd, **kwargs)
+        try:
+            return self.wait(proc)
+        except (OSError, subprocess.SubprocessError):
+            proc.kill()
+            self.wait(proc)
+            raise
+
+    def check_call(self, cmd, **kwargs):
+        returncode = self.call(cmd, **kwargs)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    def check_output(self, cmd, **kwargs):
+        proc = self.popen(cmd, stdout=subprocess.PIPE, universal_newlines=True, **kwargs)
+        try:
+            output = proc.communicate()[0]
+        except (OSError, subprocess.SubprocessError):
+            proc.kill()
+            raise
+        finally:
+            self.wait(proc)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+        return output
+
+    def start(self, cmd, log, on_exit=None):
+        """Starts a long running child, pumps its output to `log` and calls `on_exit(proc)` once it exits."""
+        proc = self.popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        LogPump(proc.stdout, log).start()
+
+        def wait():
+            self.wait(proc)
+            logger.warning('%s exited with code %s', cmd[0], proc.returncode)
+            if on_exit:
+                on_exit(proc)
+        threading.Thread(target=wait, daemon=True).start()
+        return proc
+
+    def reap(self):
+        with self._lock:
+            if self._spawning:
+                return False
+            for pid in zombie_children():
+                if pid not in self._owned:
+                    try:
+                        os.waitpid(pid, os.WNOHANG)
+                    except ChildProcessError:
+                        pass
+        return True
+
+    def handle_sigchld(self, signo, stack_frame):
+        self._sigchld.set()
+
+    def _reap_forever(self):
+        while True:
+            self._sigchld.wait()
+            self._sigchld.clear()
+            while not self.reap():
+                time.sleep(0.1)
+
+    def start_reaper(self):
+        threading.Thread(target=self._reap_forever, daemon=True).start()
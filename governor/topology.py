@@ -0,0 +1,79 @@
+INFINITY = float('inf')
+
+def _tag(member, name):
+    return member.tags.get(name) if member and member.tags else None
+
+def fanout(member, is_leader=False):
+    value = _tag(member, 'fanout')
+    if value is None:
+        return INFINITY if is_leader else 0
+    return int(value)
+
+def can_serve(member, excluded=()):
+    """Whether the member could pass WAL on to others.
+
+    Judged by its tags, not by the state in its record: postgres missing a single snapshot
+    must not re-parent the replicas streaming from it. Only a record gone stale or without
+    the state of postgres for a whole ttl, which `excluded` names, or a basebackup in
+    progress takes a member out of the tree.
+    """
+    return fanout(member) > 0 and member.name not in excluded and member.clone is None
+
+def plan(cluster, leader):
+    """{member name: upstream name} of all the members but `leader`, a tree rooted at it.
+
+    Every member plans the same tree from the DCS alone. Members tag themselves with
+    `replicatefrom`, the member they would like to stream from, and `fanout`, how many
+    replicas may stream from them; without one the leader serves any number of replicas
+    and a replica none, which is plain streaming from the leader.
+
+    Members are attached to an upstream already in the tree only, so there are no cycles,
+    and the replicas able to serve others are placed first, as close to the leader as
+    there is room. A member the tree has no room for streams from the leader.
+    """
+    if leader is None:
+        return {}
+    members, excluded = cluster.members, cluster.stale | cluster.down
+    result, depth = {}, {leader: 0}
+    capacity = {leader: fanout(members.get(leader), True)}
+    names = sorted(name for name in members if name != leader)
+
+    def room(name):
+        return fanout(members[name]) if can_serve(members[name], excluded) else 0
+
+    def attach(name, upstream):
+        result[name] = upstream
+        depth[name] = depth[upstream] + 1
+        capacity[upstream] -= 1
+        capacity[name] = room(name)
+
+    def waits(name):
+        # its upstream of choice may still join the tree
+        target = _tag(members[name], 'replicatefrom')
+        return target in members and target not in depth and target != name
+
+    while len(result) < len(names):
+        progress = True
+        while progress:
+            progress = False
+            for name in names:
+                target = _tag(members[name], 'replicatefrom')
+                if name not in result and target in depth and capacity[target] > 0:
+                    attach(name, target)
+                    progress = True
+
+        waiting = [name for name in names if name not in result]
+        if not waiting:
+            break
+        name = min(waiting, key=lambda n: (waits(n), -room(n), n))
+        upstreams = [u for u in depth if capacity[u] > 0]
+        attach(name, min(upstreams, key=lambda u: (depth[u], -capacity[u], u)) if upstreams else leader)
+    return result
+
+def upstream(cluster, name):
+    """The member `name` streams from, the leader unless the tree says otherwise."""
+    return cluster.members.get(plan(cluster, cluster.leader_name).get(name)) or cluster.leader
+
+def children(cluster, leader, name):
+    """Names of the members streaming from `name`, which need a slot there."""
+    return sorted(child for child, parent in plan(cluster, leader).items() if parent == name)
@@ -0,0 +1,94 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+
+class Span:
+    __slots__ = ('name', 'started', 'duration', 'error', 'children')
+
+    def __init__(self, name, started):
+        self.name = name
+        self.started = started
+        self.duration = None
+        self.error = None
+        self.children = []
+
+    def to_dict(self, origin=None):
+        result = {'name': self.name, 'duration': self.duration}
+        if origin is None:
+            result['started'] = self.started
+        else:
+            result['offset'] = self.started - origin
+        if self.error:
+            result['error'] = self.error
+        if self.children:
+            result['spans'] = [child.to_dict(origin or self.started) for child in self.children]
+        return result
+
+class SpanContext(contextlib.ContextDecorator):
+    """Records a span inside the cycle traced by the current thread, does nothing outside of one."""
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+        self.span = None
+
+    def _recreate_cm(self):
+        return SpanContext(self.tracer, self.name)
+
+    def __enter__(self):
+        stack = getattr(self.tracer.local, 'stack', None)
+        if stack:
+            self.span = Span(self.name, time.time())
+            stack[-1].children.append(self.span)
+            stack.append(self.span)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span:
+            self.span.duration = time.time() - self.span.started
+            if exc_type:
+                self.span.error = exc_type.__name__
+            self.tracer.local.stack.pop()
+            self.span = None
+        return False
+
+class Tracer:
+    """Keeps the span trees of the last `size` cycles in a ring buffer.
+
+    Spans are only recorded by the thread running a cycle, everything else (the
+    heartbeat, the watch thread, health checks) pays for one attribute lookup.
+    """
+
+    CYCLES = 100
+
+    def __init__(self, size=CYCLES):
+        self.cycles = collections.deque(maxlen=size)
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def cycle(self, name='cycle'):
+        root = Span(name, time.time())
+        self.local.stack = [root]
+        try:
+            yield root
+        except BaseException as e:
+            root.error = e.__class__.__name__
+            raise
+        finally:
+            root.duration = time.time() - root.started
+            self.local.stack = None
+            self.cycles.append(root)
+
+    def span(self, name):
+        return SpanContext(self, name)
+
+    def dump(self):
+        return [cycle.to_dict() for cycle in list(self.cycles)]
+
+    def dumps(self):
+        return json.dumps(self.dump())
+
+TRACER = Tracer()
+span = TRACER.span
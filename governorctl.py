@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import sys
+import time
+
+from governor.dcs import AlreadyExists, CompareFailed, KeyNotFound, to_json
+from governor.etcd import Client as Etcd
+from governor.etcd3 import Client as Etcd3
+
+POLL_INTERVAL = 0.1
+# governorctl keeps no keys alive, this only sizes the lease the v3 client is granted
+CLIENT_TTL = 20
+
+def request_ttl(cluster):
+    """A ttl for the request which outlives the switchover, that takes the leader up to one and a half of its ttl."""
+    leader = cluster.leader
+    if not leader or leader.ttl is None:
+        raise SystemExit('{} does not publish its ttl, it is too old to switch over'.format(cluster.leader_name))
+    return leader.ttl * 2
+
+def request_switchover(dcs, target):
+    """Asks the leader to hand over to `target`, replacing the result of an earlier switchover."""
+    cluster = dcs.get_cluster()
+    if not cluster.leader_name:
+        raise SystemExit('There is no leader to switch over from')
+    if target not in cluster.members or target == cluster.leader_name:
+        raise SystemExit('{} is not a replica of {}'.format(target, cluster.leader_name))
+    request = {'leader': cluster.leader_name, 'target': target}
+    ttl = request_ttl(cluster)
+    try:
+        dcs.create_key(dcs.SWITCHOVER_KEY, to_json(request), ttl)
+    except AlreadyExists:
+        if not cluster.switchover or 'result' not in cluster.switchover:
+            raise SystemExit('A switchover is in progress already: {}'.format(cluster.switchover))
+        try:
+            dcs.delete_key(dcs.SWITCHOVER_KEY, to_json(cluster.switchover))
+        except (CompareFailed, KeyNotFound):
+            pass
+        dcs.create_key(dcs.SWITCHOVER_KEY, to_json(request), ttl)
+    return request
+
+def wait_for_result(dcs, request, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        switchover = dcs.get_cluster().switchover
+        if switchover is None:
+            # expired without an answer, the leader never picked it up
+            break
+        if 'result' in switchover:
+            try:
+                dcs.delete_key(dcs.SWITCHOVER_KEY, to_json(switchover))
+            except (CompareFailed, KeyNotFound):
+                pass
+            return switchover
+        time.sleep(POLL_INTERVAL)
+    return dict(request, result='timeout')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Control a governor cluster through etcd')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    switchover = subparsers.add_parser('switchover', help='hand the leadership over to a replica')
+    switchover.add_argument('target', help='name of the replica to promote')
+    switchover.add_argument('--timeout', type=float, default=60,
+                            help='seconds to wait for the leader to report back (default: 60)')
+
+    group = parser.add_argument_group('etcd')
+    group.add_argument('--etcd-url', metavar='PROTOCOL://HOST:PORT',
+                       default='http://127.0.0.1:4001',
+                       help='url to etcd (default: http://127.0.0.1:4001)')
+    group.add_argument('--etcd-api', choices=('v2', 'v3'), default='v2',
+                       help='etcd API to use (default: v2)')
+    group.add_argument('--etcd-prefix', default='/governor',
+                       help='etcd key prefix (default: /governor)')
+    group.add_argument('--ca-file', help='path to TLS CA file')
+    group.add_argument('--cert-file', help='path to TLS cert file')
+    group.add_argument('--key-file', help='path to TLS key file')
+
+    config = parser.parse_args()
+    config.etcd_ttl = CLIENT_TTL
+
+    if bool(config.cert_file) != bool(config.key_file):
+        raise ValueError("Expected both or none of --cert-file and --key-file options")
+
+    dcs = (Etcd3 if config.etcd_api == 'v3' else Etcd)(config)
+    result = wait_for_result(dcs, request_switchover(dcs, config.target), config.timeout)
+    print(json.dumps(result))
+    if result['result'] != 'done':
+        sys.exit(1)
+    print('Switched over from {leader} to {target}, writes were unavailable for {unavailable}s'.format(**result))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import signal
+import sys
+
+from governor.etcd import Client as Etcd
+from governor.etcd3 import Client as Etcd3
+from governor.haproxy import HAProxy
+
+def sigterm_handler(signo, stack_frame):
+    sys.exit()
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+    parser = argparse.ArgumentParser(description='Keep the haproxy servers in line with the members in etcd')
+    parser.add_argument('--config', default='haproxy.cfg',
+                        help='haproxy configuration to render the servers into (default: haproxy.cfg)')
+    parser.add_argument('--socket',
+                        help='haproxy stats socket with admin level, to add and remove servers without a reload')
+    parser.add_argument('--reload-command',
+                        help='command reloading haproxy when the stats socket is not given or does not answer, '
+                             'e.g. "systemctl reload haproxy"')
+    parser.add_argument('--interval', default=10, type=int,
+                        help='apply the members at least this often, in seconds (default: 10)')
+
+    group = parser.add_argument_group('etcd')
+    group.add_argument('--etcd-url', metavar='PROTOCOL://HOST:PORT',
+                       default='http://127.0.0.1:4001',
+                       help='url to etcd (default: http://127.0.0.1:4001)')
+    group.add_argument('--etcd-api', choices=('v2', 'v3'), default='v2',
+                       help='etcd API to use (default: v2)')
+    group.add_argument('--etcd-prefix', default='/governor',
+                       help='etcd key prefix (default: /governor)')
+    group.add_argument('--etcd-ttl', type=int, default=20,
+                       help='time-to-live of the keys we create (default: 20)')
+    group.add_argument('--ca-file', help='path to TLS CA file')
+    group.add_argument('--cert-file', help='path to TLS cert file')
+    group.add_argument('--key-file', help='path to TLS key file')
+
+    config = parser.parse_args()
+
+    if bool(config.cert_file) != bool(config.key_file):
+        raise ValueError("Expected both or none of --cert-file and --key-file options")
+
+    dcs = (Etcd3 if config.etcd_api == 'v3' else Etcd)(config)
+    try:
+        HAProxy(config.config, config.socket, config.reload_command).sync(dcs.cluster_view(), config.interval)
+    except KeyboardInterrupt:
+        pass
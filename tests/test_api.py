@@ -0,0 +1,74 @@
+import json
+import unittest
+import urllib.error
+import urllib.request
+
+from argparse import Namespace
+
+from governor.api import Api, Status
+from governor.dcs import Cluster
+from governor.postgresql import State
+
+
+class TestApi(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestApi, self).__init__(method_name)
+
+    def set_up(self):
+        self.api = Api('127.0.0.1:0', 'postgresql0', 30)
+        self.api.start()
+
+    def tear_down(self):
+        self.api.shutdown()
+        self.api.server_close()
+
+    def get(self, path):
+        url = 'http://127.0.0.1:{}{}'.format(self.api.server_port, path)
+        try:
+            response = urllib.request.urlopen(url, timeout=5)
+        except urllib.error.HTTPError as e:
+            response = e
+        return response.getcode(), response.headers, json.loads(response.read().decode('utf-8'))
+
+    def ha(self, state, has_lock=False, optime=None):
+        psql = Namespace(name='postgresql0', state=state)
+        return Namespace(psql=psql, has_lock=has_lock, cluster=Cluster({}, 'postgresql1', optime))
+
+    def test_stale_until_the_first_cycle(self):
+        self.assertEqual(self.get('/health')[0], 503)
+        self.assertEqual(self.get('/nonsense')[0], 404)
+
+    def test_master(self):
+        self.api.status = Status.from_ha(self.ha(State(False, (1 << 32) + 16), has_lock=True))
+        code, headers, body = self.get('/master')
+        self.assertEqual(code, 200)
+        self.assertEqual(headers['X-Role'], 'master')
+        self.assertEqual(headers['X-XLOG-POSITION'], '1/10')
+        self.assertEqual(body['xlog_position'], '1/10')
+        self.assertEqual(self.get('/replica')[0], 503)
+
+        self.api.status = Status.from_ha(self.ha(State(False, 16)))
+        self.assertEqual(self.get('/master')[0], 503)
+
+    def test_replica(self):
+        self.api.status = Status.from_ha(self.ha(State(True, None, 1000, 900), optime=1000))
+        code, headers, body = self.get('/replica')
+        self.assertEqual(code, 200)
+        self.assertEqual(headers['X-Replication-Lag'], '100')
+        self.assertEqual(self.get('/replica?lag=100')[0], 200)
+        self.assertEqual(self.get('/replica?lag=99')[0], 503)
+        self.assertEqual(self.get('/master')[0], 503)
+        self.assertEqual(self.get('/health')[0], 200)
+
+    def test_not_running(self):
+        self.api.status = Status.from_ha(self.ha(None))
+        self.assertEqual(self.get('/health')[2]['role'], 'unknown')
+        self.assertEqual(self.get('/health')[0], 503)
+
+    def test_register(self):
+        self.api.register('/extra', lambda: (200, {'Content-Type': 'text/plain'}, b'extra'))
+        response = urllib.request.urlopen('http://127.0.0.1:{}/extra'.format(self.api.server_port), timeout=5)
+        self.assertEqual(response.read(), b'extra')
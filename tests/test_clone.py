@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from argparse import Namespace
+
+from governor import Governor
+from governor.dcs import Cluster, Member
+from governor.postgresql import CloneProgress, Postgresql
+
+PG_BASEBACKUP = """#!/bin/sh
+printf '    0/20480 kB (0%%), 0/1 tablespace\\r' >&2
+printf '10240/20480 kB (50%%), 0/1 tablespace\\r' >&2
+echo 'WARNING: something to log' >&2
+printf '20480/20480 kB (100%%), 1/1 tablespace\\n' >&2
+"""
+
+# the data directory of a replica comes with its recovery.conf, and its backup
+REPLICA_BASEBACKUP = """#!/bin/sh
+while [ "$1" != -D ]; do shift; done
+echo "primary_conninfo = 'host=postgresql2 application_name=governor_clone_postgresql1'" > "$2/recovery.conf"
+echo "primary_conninfo = 'host=postgresql3 application_name=postgresql2'" > "$2/recovery.conf.backup"
+"""
+
+
+class TestCloneSource(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestCloneSource, self).__init__(method_name)
+
+    def set_up(self):
+        self.governor = Governor.__new__(Governor)
+        self.governor.name = 'postgresql9'
+        self.governor.clone_max_lag = 1000
+        self.governor.dcs = Namespace(ttl=30)
+
+    def member(self, name, in_recovery=True, lsn=10000, load=1.0):
+        return Member(name, name + ':5432', in_recovery, lsn, lsn, time.time(), load)
+
+    def cluster(self, *members, stale=()):
+        members = (self.member('postgresql0', False),) + members
+        return Cluster({m.name: m for m in members}, 'postgresql0', optime=10000, stale=frozenset(stale))
+
+    def test_least_loaded_replica(self):
+        cluster = self.cluster(self.member('postgresql1', load=2.5), self.member('postgresql2', lsn=9500, load=0.5),
+                               self.member('postgresql3', lsn=8000, load=0.1))
+        source, reason = self.governor.clone_source(cluster)
+        self.assertEqual(source.name, 'postgresql2')
+        self.assertIn('lagging 500 bytes', reason)
+
+        self.assertEqual(self.governor.clone_source(cluster, {'postgresql2'})[0].name, 'postgresql1')
+
+    def test_falls_back_to_leader(self):
+        cluster = self.cluster(self.member('postgresql1', lsn=1000), self.member('postgresql2'),
+                               self.member('postgresql3', lsn=None), stale={'postgresql2'})
+        self.assertEqual(self.governor.clone_source(cluster)[0].name, 'postgresql0')
+        self.assertEqual(self.governor.clone_source(self.cluster())[0].name, 'postgresql0')
+
+    def test_reclone(self):
+        cluster = self.cluster(self.member('postgresql1', load=2.5), self.member('postgresql2', load=0.5))
+        calls = []
+        self.governor.ha = Namespace(cluster=cluster)
+        self.governor.psql = Namespace(remove_data_directory=lambda: calls.append('remove'))
+        self.governor.clone = lambda source: calls.append(source.name) or True
+        self.assertTrue(self.governor.reclone(cluster.members['postgresql1']))
+        # goes through the choice of the source, the basebackup limits and the progress reports of clone()
+        self.assertEqual(calls, ['remove', 'postgresql2'])
+
+    def test_record_load(self):
+        member = Member.from_value('postgresql1', self.member('postgresql1', load=0.7).to_value())
+        self.assertEqual(member.load, 0.7)
+
+
+class TestCloneProgress(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestCloneProgress, self).__init__(method_name)
+
+    def set_up(self):
+        self.tmp = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp, 'bin'))
+        self.pg_basebackup(PG_BASEBACKUP)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = os.path.join(self.tmp, 'bin') + os.pathsep + self.path
+        self.config = Namespace(name='postgresql1', listen_address='127.0.0.1:5432',
+                                data_dir=os.path.join(self.tmp, 'data'), repl_user='replication', repl_password=None,
+                                dbname='postgres', max_rate=None)
+        os.mkdir(self.config.data_dir)
+
+    def pg_basebackup(self, script):
+        with open(os.path.join(self.tmp, 'bin', 'pg_basebackup'), 'w') as f:
+            f.write(script)
+        os.chmod(os.path.join(self.tmp, 'bin', 'pg_basebackup'), 0o755)
+
+    def tear_down(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmp)
+
+    def test_parse(self):
+        progress = CloneProgress('postgresql0', now=100)
+        self.assertFalse(progress.parse('pg_basebackup: starting background WAL receiver', now=101))
+        self.assertTrue(progress.parse('10240/20480 kB (50%), 0/1 tablespace', now=110))
+        self.assertEqual(progress.to_record(), {'source': 'postgresql0', 'bytes': 10485760, 'total': 20971520,
+                                                'rate': 1048576, 'eta': 10, 'wal_lag': None})
+
+    def test_sync_from_leader(self):
+        reports = []
+        p = Postgresql(self.config, [])
+        self.assertTrue(p.sync_from_leader(Member('postgresql0', 'host:5432'), lambda pr: reports.append(pr.done)))
+        self.assertEqual(reports, [0, 10485760, 20971520])
+
+    def test_recovery_conf_of_a_replica_copy(self):
+        self.pg_basebackup(REPLICA_BASEBACKUP)
+        p = Postgresql(self.config, [])
+        self.assertTrue(p.sync_from_leader(Member('postgresql2', 'postgresql2:5432')))
+        leader = Member('postgresql0', 'postgresql0:5432')
+        p.write_recovery_conf(leader)
+        self.assertTrue(p.check_recovery_conf(leader))
+        with open(p.recovery_conf) as f:
+            recovery_conf = f.read()
+        # streams from the planned upstream under its own name, the slot of which is kept for it
+        self.assertNotIn('postgresql2', recovery_conf)
+        self.assertNotIn('postgresql3', recovery_conf)
+        self.assertIn('application_name=postgresql1', recovery_conf)
+        self.assertIn("primary_slot_name = 'postgresql1'", recovery_conf)
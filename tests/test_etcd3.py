@@ -0,0 +1,297 @@
+import base64
+import json
+import socket
+import threading
+import time
+import unittest
+
+from argparse import Namespace
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from governor.dcs import ClusterView, Member, AlreadyExists, CompareFailed, DCSTimeout
+from governor.etcd3 import Client
+
+
+def b64(value):
+    return base64.b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def unb64(value):
+    return base64.b64decode(value).decode('utf-8')
+
+
+def record(name, timestamp, in_recovery, lsn):
+    return Member(name, 'host:5432', in_recovery, lsn, lsn, timestamp, load=0.1 * timestamp).to_value()
+
+
+class Etcd3Gateway(ThreadingMixIn, HTTPServer):
+    """In-process stand-in for the subset of the etcd v3 JSON gateway used by governor."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), Etcd3Handler)
+        self.lock = threading.Condition()
+        self.revision = 1
+        self.kvs = {}
+        self.leases = {}
+        self.history = []
+        self.requests = []
+
+    def expire(self):
+        now = time.time()
+        for lease, deadline in list(self.leases.items()):
+            if deadline < now:
+                del self.leases[lease]
+                for key in [k for k, kv in self.kvs.items() if kv.get('lease') == lease]:
+                    self.delete(key)
+
+    def put(self, key, value, lease=None):
+        self.revision += 1
+        kv = self.kvs.get(key, {'create_revision': str(self.revision)})
+        kv.update(key=b64(key), value=b64(value), mod_revision=str(self.revision), lease=lease)
+        self.kvs[key] = kv
+        self.history.append({'kv': dict(kv)})
+        self.lock.notify_all()
+
+    def delete(self, key):
+        self.revision += 1
+        kv = self.kvs.pop(key)
+        self.history.append({'type': 'DELETE', 'kv': {'key': kv['key'], 'mod_revision': str(self.revision)}})
+        self.lock.notify_all()
+
+    def compare(self, compare):
+        kv = self.kvs.get(unb64(compare['key']))
+        if compare['target'] == 'CREATE':
+            return (kv['create_revision'] if kv else '0') == compare['create_revision']
+        if compare['target'] == 'LEASE':
+            return kv is not None and kv['lease'] == compare['lease']
+        return kv is not None and kv['value'] == compare['value']
+
+    def header(self):
+        return {'revision': str(self.revision)}
+
+    def handle(self, path, body):
+        if path == '/v3/lease/grant':
+            lease = str(len(self.requests))
+            self.leases[lease] = time.time() + body['TTL']
+            return {'header': self.header(), 'ID': lease, 'TTL': str(body['TTL'])}
+        if path == '/v3/lease/keepalive':
+            if body['ID'] not in self.leases:
+                return {'result': {'header': self.header(), 'ID': body['ID']}}
+            self.leases[body['ID']] = time.time() + 30
+            return {'result': {'header': self.header(), 'ID': body['ID'], 'TTL': '30'}}
+        if path == '/v3/lease/revoke':
+            self.leases.pop(body['ID'], None)
+            for key in [k for k, kv in self.kvs.items() if kv.get('lease') == body['ID']]:
+                self.delete(key)
+        if path == '/v3/kv/put':
+            self.put(unb64(body['key']), unb64(body['value']), body.get('lease'))
+        elif path == '/v3/kv/deleterange':
+            if unb64(body['key']) in self.kvs:
+                self.delete(unb64(body['key']))
+        elif path == '/v3/kv/range':
+            start = unb64(body['key'])
+            end = unb64(body.get('range_end', b64(start + '\0')))
+            return {'header': self.header(),
+                    'kvs': [kv for key, kv in sorted(self.kvs.items()) if start <= key < end]}
+        elif path == '/v3/kv/txn':
+            succeeded = all(self.compare(c) for c in body['compare'])
+            responses = []
+            for op in body['success'] if succeeded else body.get('failure', []):
+                if 'request_put' in op:
+                    self.handle('/v3/kv/put', op['request_put'])
+                    responses.append({'response_put': {}})
+                elif 'request_delete_range' in op:
+                    self.handle('/v3/kv/deleterange', op['request_delete_range'])
+                    responses.append({'response_delete_range': {}})
+                else:
+                    responses.append({'response_range': self.handle('/v3/kv/range', op['request_range'])})
+            return {'header': self.header(), 'succeeded': succeeded, 'responses': responses}
+        return {'header': self.header()}
+
+
+class Etcd3Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        self.send_response(200)
+        self.end_headers()
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            self.server.expire()
+            if self.path != '/v3/watch':
+                self.wfile.write(json.dumps(self.server.handle(self.path, body)).encode('utf-8'))
+                return
+            start = int(body['create_request']['start_revision'])
+            self.wfile.write(json.dumps({'result': {'created': True}}).encode('utf-8') + b'\n')
+            self.wfile.flush()
+            while True:
+                events = [e for e in self.server.history if int(e['kv']['mod_revision']) >= start]
+                if events:
+                    break
+                self.server.lock.wait(0.05)
+                self.server.expire()
+            self.wfile.write(json.dumps({'result': {'events': events}}).encode('utf-8') + b'\n')
+
+
+class TestEtcd3(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestEtcd3, self).__init__(method_name)
+
+    def set_up(self):
+        self.server = Etcd3Gateway()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.config = Namespace(etcd_url='http://127.0.0.1:{}'.format(self.server.server_port), etcd_ttl=30,
+                                etcd_prefix='/governor', ca_file=None, cert_file=None, key_file=None)
+        self.client = Client(self.config)
+
+    def tear_down(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_single_lease_for_member_and_leader(self):
+        self.client.touch_member('postgresql0', record('postgresql0', 1, False, 100))
+        self.client.take_leadership('postgresql0')
+        kvs = self.server.kvs
+        self.assertEqual(kvs['/governor/postgresql0']['lease'], self.client.lease)
+        self.assertEqual(kvs['/governor/leader']['lease'], self.client.lease)
+
+    def test_requests_per_cycle(self):
+        self.client.take_leadership('postgresql0')
+        replica = Client(self.config)
+        del self.server.requests[:]
+        for cycle in range(1, 4):
+            # the position and the load move on every cycle
+            held, events = self.client.touch_leader('postgresql0', record('postgresql0', cycle, False, 100 * cycle),
+                                                    100 * cycle)
+            self.assertTrue(held)
+            self.assertEqual([e.key for e in events], ['/governor/postgresql0', '/governor/optime'])
+            replica.touch_member('postgresql1', record('postgresql1', cycle, True, 100 * cycle - 10))
+        self.assertEqual(self.server.requests, ['/v3/lease/keepalive', '/v3/kv/txn',
+                                                '/v3/lease/keepalive', '/v3/kv/put'] * 3)
+
+        cluster = self.client.get_cluster()
+        self.assertEqual((cluster.leader_name, cluster.optime), ('postgresql0', 300))
+        self.assertEqual(cluster.members['postgresql0'].lsn, 300)
+        self.assertEqual(cluster.members['postgresql1'].lsn, 290)
+
+        # the optime is only written when it moved
+        held, events = self.client.touch_leader('postgresql0', record('postgresql0', 4, False, 300), 300)
+        self.assertEqual([e.key for e in events], ['/governor/postgresql0'])
+
+    def test_touch_leader_lost(self):
+        self.client.take_leadership('postgresql1', force=True)
+        held, events = self.client.touch_leader('postgresql0', record('postgresql0', 1, False, 100), 100)
+        self.assertFalse(held)
+        self.assertEqual([e.key for e in events], ['/governor/postgresql0'])
+        self.assertIn('/governor/postgresql0', self.server.kvs)
+        self.assertNotIn('/governor/optime', self.server.kvs)
+        self.assertEqual(unb64(self.server.kvs['/governor/leader']['value']), 'postgresql1')
+
+    def test_touch_leader_after_transfer(self):
+        other = Client(self.config)
+        other.take_leadership('postgresql1')
+        other.transfer_leadership('postgresql1', 'postgresql0')
+        held, _ = self.client.touch_leader('postgresql0', record('postgresql0', 1, False, 100), 100)
+        self.assertTrue(held)
+        # moved off the lease of the previous leader
+        self.assertEqual(self.server.kvs['/governor/leader']['lease'], self.client.lease)
+        self.assertEqual(unb64(self.server.kvs['/governor/optime']['value']), '100')
+
+    def test_take_leadership(self):
+        self.client.take_leadership('postgresql0')
+        self.assertRaises(AlreadyExists, self.client.take_leadership, 'postgresql1')
+        self.assertRaises(CompareFailed, self.client.update_leadership, 'postgresql1')
+        self.assertRaises(CompareFailed, self.client.vacate_leadership, 'postgresql1')
+        self.client.vacate_leadership('postgresql0')
+        self.assertNotIn('/governor/leader', self.server.kvs)
+
+    def test_transfer_leadership(self):
+        self.client.take_leadership('postgresql0')
+        self.assertRaises(CompareFailed, self.client.transfer_leadership, 'postgresql1', 'postgresql2')
+        self.client.transfer_leadership('postgresql0', 'postgresql1')
+
+        # the new leader moves the key off the lease of the previous one
+        other = Client(self.config)
+        other.update_leadership('postgresql1')
+        self.assertEqual(self.server.kvs['/governor/leader']['lease'], other.lease)
+        self.assertNotEqual(other.lease, self.client.lease)
+
+    def test_init_cluster(self):
+        self.client.init_cluster('postgresql0')
+        self.assertRaises(AlreadyExists, self.client.init_cluster, 'postgresql1')
+
+    def test_expired_lease(self):
+        self.client.take_leadership('postgresql0')
+        self.server.leases[self.client.lease] = 0
+        self.client.touch_member('postgresql0', record('postgresql0', 1, False, 100))
+        self.assertNotIn('/governor/leader', self.server.kvs)
+        self.assertRaises(CompareFailed, self.client.update_leadership, 'postgresql0')
+
+    def test_cluster_view(self):
+        self.client.touch_member('postgresql0', record('postgresql0', 1, False, 100))
+        self.client.take_leadership('postgresql0')
+        view = ClusterView(self.client)
+        cluster = view.cluster()
+        self.assertEqual(cluster.leader.url, 'host:5432')
+
+        self.client.vacate_leadership('postgresql0')
+        self.assertTrue(view.wait_for_change(cluster.changed_index, 5))
+        self.assertIsNone(view.cluster().leader_name)
+
+    def test_keys(self):
+        self.client.create_key('basebackup/postgresql2', 'postgresql0', 30)
+        self.client.create_key('basebackup/postgresql1', 'postgresql0', 30)
+        self.assertRaises(AlreadyExists, self.client.create_key, 'basebackup/postgresql1', 'postgresql0', 30)
+        self.client.refresh_key('basebackup/postgresql1', 'postgresql0', 30)
+        self.assertRaises(CompareFailed, self.client.refresh_key, 'basebackup/postgresql1', 'postgresql3', 30)
+        self.assertEqual(self.client.list_keys('basebackup'),
+                         [('postgresql2', 'postgresql0'), ('postgresql1', 'postgresql0')])
+        self.client.delete_key('basebackup/postgresql2', 'postgresql0')
+        self.assertEqual(self.client.list_keys('basebackup'), [('postgresql1', 'postgresql0')])
+
+    def test_key_with_another_ttl(self):
+        self.client.create_key('switchover', '{}', 60)
+        lease = self.server.kvs['/governor/switchover']['lease']
+        self.assertNotEqual(lease, self.client.lease)
+        self.assertAlmostEqual(self.server.leases[lease], time.time() + 60, delta=5)
+
+    def test_keys_share_a_lease_per_ttl(self):
+        self.client.create_key('sync/postgresql1', 'postgresql0', 60)
+        self.client.create_key('sync/postgresql2', 'postgresql0', 60)
+        lease = self.server.kvs['/governor/sync/postgresql1']['lease']
+        self.assertEqual(self.server.kvs['/governor/sync/postgresql2']['lease'], lease)
+        self.assertNotEqual(lease, self.client.lease)
+
+        self.server.leases[lease] = time.time() + 1
+        self.client.refresh_key('sync/postgresql1', 'postgresql0', 60)
+        self.assertAlmostEqual(self.server.leases[lease], time.time() + 30, delta=5)
+
+        self.client.delete_key('sync/postgresql1', 'postgresql0')
+        self.assertIn(lease, self.server.leases)
+        self.client.delete_key('sync/postgresql2', 'postgresql0')
+        self.assertNotIn(lease, self.server.leases)
+        self.assertEqual(self.server.requests[-1], '/v3/lease/revoke')
+
+    def test_watch_timeout(self):
+        self.assertEqual(self.client.watch_scope(self.server.revision + 10, 0.2), [])
+
+        # a gateway which accepts the connection but never answers
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        try:
+            self.client.base_url = 'http://127.0.0.1:{}/v3'.format(listener.getsockname()[1])
+            self.assertEqual(self.client.watch_scope(1, 0.2), [])
+            self.client.TIMEOUT = 0.2
+            self.assertRaises(DCSTimeout, self.client.load_scope)
+        finally:
+            listener.close()
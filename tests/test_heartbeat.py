@@ -0,0 +1,114 @@
+import time
+import unittest
+
+from argparse import Namespace
+
+from governor.dcs import Member
+from governor.ha import Ha
+from governor.heartbeat import Heartbeat
+from governor.memory import Client, Store
+
+
+class Postgresql:
+
+    def __init__(self, name):
+        self.name = name
+        self.responded_at = time.time()
+        self.followed = []
+        self.demotes = True
+
+    def follow_the_leader(self, leader):
+        self.followed.append(leader)
+        return self.demotes
+
+
+class TestHeartbeat(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestHeartbeat, self).__init__(method_name)
+
+    def set_up(self):
+        self.store = Store()
+        self.dcs = Client(self.store, ttl=30)
+        self.psql = Postgresql('postgresql0')
+        self.ha = Ha(self.psql, self.dcs)
+        self.governor = Namespace(ha=self.ha, psql=self.psql, touch_member=self.touch_member)
+        self.heartbeat = Heartbeat(self.governor, 10, 30)
+        self.ha.acquire_leadership()
+
+    def touch_member(self, leader=False):
+        return self.ha.touch_member(Member(self.psql.name, 'host:5432').to_value(), leader)
+
+    def test_renews_while_postgres_answers(self):
+        self.dcs.requests.clear()
+        self.assertTrue(self.heartbeat.beat())
+        self.assertEqual(self.dcs.requests['touch_member'], 1)
+        self.assertEqual(self.dcs.requests['update_leadership'], 1)
+        self.assertTrue(self.ha.has_lock)
+
+    def test_fences_when_postgres_is_stale(self):
+        self.psql.responded_at = time.time() - 31
+        self.dcs.requests.clear()
+        self.assertFalse(self.heartbeat.beat())
+        # demoted before the key goes, so a replica promoting at once meets no other writable leader
+        self.assertEqual(self.psql.followed, [None])
+        self.assertIsNone(self.dcs.get_cluster().leader_name)
+        self.assertFalse(self.ha.has_lock)
+        self.assertEqual(self.dcs.requests['touch_member'], 0)
+        self.assertTrue(self.ha.view.wait_for_change(None, 0))
+
+        self.assertFalse(self.heartbeat.beat())
+        self.assertEqual(self.dcs.requests['vacate_leadership'], 1)
+        self.assertFalse(self.heartbeat.step_down_if_released())
+
+    def test_stuck_loop_lets_the_key_expire(self):
+        self.heartbeat.interval = 0.01
+        self.psql.responded_at = time.time() - 31
+        with self.ha.lock:
+            self.assertFalse(self.heartbeat.beat())
+        # neither released nor renewed any more
+        self.assertEqual(self.dcs.get_cluster().leader_name, 'postgresql0')
+        self.assertEqual(self.psql.followed, [])
+        self.assertTrue(self.ha.view.wait_for_change(None, 0))
+
+        # the loop demotes once it gets to its next cycle
+        self.assertTrue(self.heartbeat.step_down_if_released())
+        self.assertFalse(self.ha.has_lock)
+        self.assertEqual(self.psql.followed, [None])
+        self.assertIsNone(self.dcs.get_cluster().leader_name)
+        self.assertFalse(self.heartbeat.step_down_if_released())
+
+    def test_keeps_the_key_when_demoting_fails(self):
+        self.psql.demotes = False
+        self.psql.responded_at = time.time() - 31
+        self.assertFalse(self.heartbeat.beat())
+        self.assertEqual(self.psql.followed, [None])
+        self.assertEqual(self.dcs.get_cluster().leader_name, 'postgresql0')
+        self.assertFalse(self.ha.has_lock)
+
+    def test_demotes_after_the_loop_lost_the_lock(self):
+        self.heartbeat.interval = 0.01
+        self.psql.responded_at = time.time() - 31
+        with self.ha.lock:
+            self.heartbeat.beat()
+        # the cycle found the key gone before it got to demote
+        self.ha.has_lock = False
+        self.assertTrue(self.heartbeat.step_down_if_released())
+        self.assertEqual(self.psql.followed, [None])
+
+    def test_renews_again_once_postgres_answers(self):
+        self.psql.responded_at = time.time() - 31
+        self.heartbeat.beat()
+        self.heartbeat.step_down_if_released()
+        self.psql.responded_at = time.time()
+        self.assertTrue(self.heartbeat.beat())
+        self.assertFalse(self.heartbeat.released)
+
+    def test_lost_lock(self):
+        self.dcs.take_leadership('postgresql1', force=True)
+        self.assertTrue(self.heartbeat.beat())
+        # the loop finds out on its own
+        self.assertTrue(self.ha.has_lock)
+        self.assertTrue(self.ha.view.wait_for_change(None, 0))
+        self.assertEqual(self.dcs.get_cluster().leader_name, 'postgresql1')
@@ -0,0 +1,55 @@
+import unittest
+
+from governor.dcs import AlreadyExists, CompareFailed, DCSConnectionError, HistoryCleared, Member
+from governor.memory import Client, SimulatedClock, Store
+
+
+class TestMemory(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestMemory, self).__init__(method_name)
+
+    def set_up(self):
+        self.clock = SimulatedClock()
+        self.store = Store(self.clock)
+        self.client = Client(self.store, ttl=30)
+        self.other = Client(self.store, ttl=30)
+
+    def test_leadership(self):
+        self.client.take_leadership('postgresql0')
+        self.assertRaises(AlreadyExists, self.other.take_leadership, 'postgresql1')
+        self.assertRaises(CompareFailed, self.other.update_leadership, 'postgresql1')
+        self.client.update_leadership('postgresql0')
+        self.other.take_leadership('postgresql1', force=True)
+        self.assertRaises(CompareFailed, self.client.vacate_leadership, 'postgresql0')
+
+    def test_ttl(self):
+        self.client.touch_member('postgresql0', Member('postgresql0', 'host:5432').to_value())
+        self.client.take_leadership('postgresql0')
+        self.clock.advance(29)
+        self.assertEqual(self.other.get_cluster().leader.url, 'host:5432')
+        self.clock.advance(1)
+        cluster = self.other.get_cluster()
+        self.assertIsNone(cluster.leader_name)
+        self.assertEqual(cluster.members, {})
+
+    def test_cluster_view(self):
+        view = self.other.cluster_view()
+        cluster = view.cluster()
+        self.client.take_leadership('postgresql0')
+        self.assertEqual(view.cluster().leader_name, 'postgresql0')
+        self.assertGreater(view.cluster().changed_index, cluster.changed_index)
+
+    def test_history_cleared(self):
+        store = Store(self.clock, history=2)
+        client = Client(store)
+        for i in range(3):
+            client.write_optime(i)
+        self.assertRaises(HistoryCleared, client.watch_scope, 1, 0)
+        self.assertEqual(len(client.watch_scope(2, 0)), 2)
+
+    def test_partitioned(self):
+        self.client.partitioned = True
+        self.assertRaises(DCSConnectionError, self.client.touch_member, 'postgresql0', 'host:5432')
+        self.assertEqual(self.client.requests['touch_member'], 1)
@@ -0,0 +1,47 @@
+import unittest
+
+from governor.metrics import Counter, Gauge, Histogram, Registry
+
+
+class TestMetrics(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestMetrics, self).__init__(method_name)
+
+    def set_up(self):
+        self.registry = Registry()
+
+    def test_counter_and_gauge(self):
+        counter = Counter('requests_total', 'Requests', ['method'], registry=self.registry)
+        counter.labels('get').inc()
+        counter.labels('get').inc(2)
+        counter.labels('put').inc()
+        gauge = Gauge('lag_bytes', 'Lag', registry=self.registry)
+        gauge.set(42)
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{method="get"} 3',
+            'requests_total{method="put"} 1',
+            '# HELP lag_bytes Lag',
+            '# TYPE lag_bytes gauge',
+            'lag_bytes 42',
+        ]) + '\n')
+
+    def test_histogram(self):
+        histogram = Histogram('cycle_seconds', 'Cycle', registry=self.registry)
+        histogram.observe(0.2)
+        histogram.observe(3)
+
+        @histogram.time()
+        def cycle():
+            pass
+        cycle()
+        cycle()
+
+        lines = self.registry.render().splitlines()
+        self.assertIn('cycle_seconds_bucket{le="0.005"} 2', lines)
+        self.assertIn('cycle_seconds_bucket{le="0.25"} 3', lines)
+        self.assertIn('cycle_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('cycle_seconds_count 4', lines)
@@ -0,0 +1,75 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from argparse import Namespace
+
+from governor.postgresql import Postgresql, process_start_time
+
+
+class TestPostmaster(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestPostmaster, self).__init__(method_name)
+
+    def set_up(self):
+        self.data_dir = tempfile.mkdtemp()
+        config = Namespace(name='postgresql0', listen_address='127.0.0.1:5432', data_dir=self.data_dir)
+        self.p = Postgresql(config, [])
+        self.forks = 0
+        self.p.pg_ctl = self.pg_ctl
+
+    def tear_down(self):
+        shutil.rmtree(self.data_dir)
+
+    def pg_ctl(self, *args, **kwargs):
+        self.forks += 1
+        return 3
+
+    def write_pid(self, pid, data_dir=None, start_time=None):
+        if start_time is None:
+            start_time = process_start_time(pid)
+        with open(self.p.pid_path, 'w') as f:
+            f.write('{}\n{}\n{}\n5432\n'.format(pid, data_dir or self.data_dir, int(start_time)))
+
+    def test_no_pid_file(self):
+        self.assertFalse(self.p.is_running())
+        self.assertEqual(self.forks, 0)
+
+    def test_running(self):
+        self.write_pid(os.getpid())
+        self.assertTrue(self.p.is_running())
+        self.assertEqual(self.forks, 0)
+
+    def test_stale(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        self.write_pid(proc.pid, start_time=time.time())
+        self.assertFalse(self.p.is_running())
+
+        self.write_pid(os.getpid(), start_time=time.time() - 3600)
+        self.assertFalse(self.p.is_running())
+
+        self.write_pid(os.getpid(), data_dir='/somewhere/else')
+        self.assertFalse(self.p.is_running())
+        self.assertEqual(self.forks, 0)
+
+    def test_fallback(self):
+        with open(self.p.pid_path, 'w') as f:
+            f.write('123\n')
+        self.assertFalse(self.p.is_running())
+        self.assertEqual(self.forks, 1)
+
+    def test_popen_handle(self):
+        self.p._postmaster = subprocess.Popen(['sleep', '10'])
+        try:
+            self.assertTrue(self.p.is_running())
+        finally:
+            self.p._postmaster.kill()
+            self.p._postmaster.wait()
+        self.assertFalse(self.p.is_running())
@@ -0,0 +1,126 @@
+import threading
+import time
+import unittest
+
+from argparse import Namespace
+
+from governor.dcs import Cluster, Member
+from governor.postgresql import Postgresql, State
+from psycopg2 import OperationalError
+
+
+class ProbedPostgresql(Postgresql):
+    """Replica at position 100 whose probes answer from a dict of callables by member name."""
+
+    PROBE_TIMEOUT = 0.2
+
+    def __init__(self, answers):
+        self.name = 'postgresql0'
+        self.config = Namespace(maximum_lag=10)
+        self.answers = answers
+        self.probed = []
+
+    def probe_member(self, name, url, position):
+        self.probed.append(name)
+        return self.answers[name](position)
+
+
+def member(name, **kwargs):
+    return Member(name, 'host:5432', **kwargs)
+
+
+def answer(in_recovery, replayed):
+    return lambda position: (in_recovery, position - replayed)
+
+
+class TestProbe(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestProbe, self).__init__(method_name)
+
+    def set_up(self):
+        self.state = State(True, 100, 100, 100)
+        self.release = threading.Event()
+
+    def tear_down(self):
+        self.release.set()
+
+    def is_healthiest(self, answers, optime=None, **records):
+        members = {name: records.get(name, member(name)) for name in answers}
+        members.update((name, m) for name, m in records.items() if name not in members)
+        self.psql = ProbedPostgresql(answers)
+        return self.psql.is_healthiest_node(Cluster(members, optime=optime), self.state)
+
+    def hang(self, position):
+        self.release.wait(5)
+        return True, 0
+
+    def test_behind(self):
+        self.assertTrue(self.is_healthiest({'postgresql1': answer(True, 90), 'postgresql2': answer(True, 100)}))
+        self.assertEqual(sorted(self.psql.probed), ['postgresql1', 'postgresql2'])
+
+    def test_ahead(self):
+        self.assertFalse(self.is_healthiest({'postgresql1': answer(True, 90), 'postgresql2': answer(True, 101)}))
+
+    def test_primary(self):
+        self.assertFalse(self.is_healthiest({'postgresql1': answer(False, 50)}))
+
+    def test_later_answer_decides(self):
+        def slow_ahead(position):
+            time.sleep(0.05)
+            return True, -1
+        self.assertFalse(self.is_healthiest({'postgresql1': answer(True, 90), 'postgresql2': slow_ahead}))
+
+    def test_probes_concurrently(self):
+        barrier = threading.Barrier(3, timeout=1)
+
+        def meet(position):
+            barrier.wait()
+            return True, 0
+        self.assertTrue(self.is_healthiest({'postgresql1': meet, 'postgresql2': meet, 'postgresql3': meet}))
+
+    def test_failing_member(self):
+        def refuse(position):
+            raise OperationalError('could not connect')
+        self.assertTrue(self.is_healthiest({'postgresql1': refuse, 'postgresql2': answer(True, 100)}))
+        self.assertFalse(self.is_healthiest({'postgresql1': refuse, 'postgresql2': answer(True, 110)}))
+
+    def test_hung_member(self):
+        started = time.time()
+        self.assertTrue(self.is_healthiest({'postgresql1': self.hang, 'postgresql2': answer(True, 100)}))
+        self.assertLess(time.time() - started, 1)
+
+    def test_hung_member_does_not_hide_others(self):
+        self.assertFalse(self.is_healthiest({'postgresql1': self.hang, 'postgresql2': answer(False, 100)}))
+
+    def test_records(self):
+        # members publishing their state are not probed
+        ahead = member('postgresql1', in_recovery=True, lsn=101, timestamp=1)
+        primary = member('postgresql1', in_recovery=False, lsn=50, timestamp=1)
+        level = member('postgresql1', in_recovery=True, lsn=100, timestamp=1)
+        not_answering = member('postgresql2', timestamp=1)
+        self.assertFalse(self.is_healthiest({}, postgresql1=ahead))
+        self.assertFalse(self.is_healthiest({}, postgresql1=primary))
+        self.assertTrue(self.is_healthiest({}, postgresql1=level, postgresql2=not_answering))
+        self.assertEqual(self.psql.probed, [])
+
+    def test_stale_record(self):
+        # the record of a member whose loop is stuck says nothing about its position now
+        stale = member('postgresql1', in_recovery=True, lsn=90, timestamp=1)
+        members = {'postgresql1': stale}
+        self.psql = ProbedPostgresql({'postgresql1': answer(True, 120)})
+        self.assertFalse(self.psql.is_healthiest_node(Cluster(members, stale={'postgresql1'}), self.state))
+        self.assertEqual(self.psql.probed, ['postgresql1'])
+        self.assertTrue(self.psql.is_healthiest_node(Cluster(members), self.state))
+
+    def test_too_far_behind_the_optime(self):
+        self.assertFalse(self.is_healthiest({'postgresql1': answer(True, 0)}, optime=111))
+        self.assertEqual(self.psql.probed, [])
+        self.assertTrue(self.is_healthiest({'postgresql1': answer(True, 0)}, optime=110))
+
+    def test_leader(self):
+        self.state = State(False, 100, None, None)
+        self.assertTrue(self.is_healthiest({'postgresql1': answer(True, 200)}))
+        self.assertEqual(self.psql.probed, [])
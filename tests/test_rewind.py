@@ -0,0 +1,165 @@
+import unittest
+
+from argparse import Namespace
+
+from governor.dcs import Member
+from governor.ha import Ha
+from governor.memory import Client, Store
+from governor.postgresql import Postgresql, State, parse_history, parse_lsn
+from psycopg2 import OperationalError
+
+CONTROLDATA = """pg_control version number:            960
+Database cluster state:               {}
+Latest checkpoint location:           0/5000028
+Latest checkpoint's TimeLineID:       {}
+Minimum recovery ending location:     0/6000000
+"""
+
+
+class TestRewind(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestRewind, self).__init__(method_name)
+
+    def set_up(self):
+        config = Namespace(name='postgresql0', listen_address='127.0.0.1:5432', data_dir='/tmp/data',
+                           use_pg_rewind=True)
+        self.p = Postgresql(config, [])
+        self.p.data_directory_empty = lambda: False
+        self.leader = Member('postgresql1', 'host:5432', timeline=2)
+        self.state = 'shut down'
+        self.timeline = 1
+        self.history = [(1, parse_lsn('0/5000098'))]
+        self.p.controldata = lambda: dict((k.strip(), v.strip()) for k, _, v in (
+            line.partition(':') for line in CONTROLDATA.format(self.state, self.timeline).splitlines()))
+        self.p.leader_timeline = lambda leader: (2, self.history)
+
+    def test_parse(self):
+        self.assertEqual(parse_lsn('1/0000000A'), (1 << 32) + 10)
+        self.assertEqual(list(parse_history('1\t0/5000098\tno recovery target specified\n\n'
+                                            '2\t0/7000000\tno recovery target specified\n')),
+                         [(1, 0x5000098), (2, 0x7000000)])
+
+    def test_not_diverged(self):
+        self.assertFalse(self.p.diverged(self.leader))
+        self.timeline = 2
+        self.assertFalse(self.p.diverged(self.leader))
+
+    def test_diverged(self):
+        self.history = [(1, parse_lsn('0/5000000'))]
+        self.assertTrue(self.p.diverged(self.leader))
+
+        # a replica which replayed past the switch point
+        self.history = [(1, parse_lsn('0/5000098'))]
+        self.state = 'shut down in recovery'
+        self.assertTrue(self.p.diverged(self.leader))
+
+        # a timeline the leader never went through
+        self.timeline = 3
+        self.assertTrue(self.p.diverged(self.leader))
+
+    def test_resync_falls_back_to_clone(self):
+        self.history = []
+        calls = []
+        self.p.rewind = lambda leader: calls.append('rewind') or False
+        self.p.reclone = lambda leader: calls.append('clone') or True
+        self.assertTrue(self.p.resync(self.leader))
+        self.assertEqual(calls, ['rewind', 'clone'])
+
+    def test_resync_failed(self):
+        self.history = []
+        self.p.rewind = lambda leader: False
+        self.assertFalse(self.p.resync(self.leader))
+
+        def unreachable(leader):
+            raise OperationalError('could not connect')
+        self.p.leader_timeline = unreachable
+        self.p.reclone = lambda leader: self.fail('cloned without comparing the timelines')
+        self.assertFalse(self.p.resync(self.leader))
+
+    def test_resync_empty_data_directory(self):
+        # an earlier clone did not finish
+        self.p.data_directory_empty = lambda: True
+        self.p.controldata = lambda: self.fail('looked at an empty data directory')
+        self.p.reclone = lambda leader: True
+        self.assertTrue(self.p.resync(self.leader))
+
+
+class TestFollow(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestFollow, self).__init__(method_name)
+
+    def set_up(self):
+        config = Namespace(name='postgresql0', listen_address='127.0.0.1:5432', data_dir='/tmp/data',
+                           use_pg_rewind=True)
+        self.p = Postgresql(config, [])
+        self.p.state = State(True, None, 100, 100, 2)
+        self.leader = Member('postgresql1', 'host:5432', timeline=2)
+        self.events = []
+        self.resynced = True
+        self.p.check_recovery_conf = lambda leader: False
+        self.p.write_recovery_conf = lambda leader: self.events.append('recovery.conf')
+        for action in ('stop', 'start', 'restart'):
+            setattr(self.p, action, self.recorder(action))
+        self.p.resync = lambda leader: self.events.append('resync') or self.resynced
+
+    def recorder(self, action):
+        return lambda: self.events.append(action) or True
+
+    def test_new_upstream(self):
+        # a replica on the timeline of the leader only needs to restart
+        self.p.follow_the_leader(self.leader)
+        self.assertEqual(self.events, ['recovery.conf', 'restart'])
+
+    def test_other_timeline(self):
+        self.leader.timeline = 3
+        self.p.follow_the_leader(self.leader)
+        self.assertEqual(self.events, ['stop', 'resync', 'recovery.conf', 'start'])
+
+    def test_former_leader(self):
+        self.p.state = State(False, 200, None, None, 2)
+        self.p.follow_the_leader(self.leader)
+        self.assertEqual(self.events, ['stop', 'resync', 'recovery.conf', 'start'])
+
+    def test_unknown_timeline(self):
+        self.leader.timeline = None
+        self.p.follow_the_leader(self.leader)
+        self.assertEqual(self.events, ['stop', 'resync', 'recovery.conf', 'start'])
+
+    def test_resync_failed(self):
+        self.leader.timeline = 3
+        self.resynced = False
+        self.p.follow_the_leader(self.leader)
+        self.assertEqual(self.events, ['stop', 'resync'])
+        self.assertTrue(self.p.needs_resync)
+
+        # tried again, even though recovery.conf already points at the leader
+        self.p.check_recovery_conf = lambda leader: True
+        self.resynced = True
+        self.p.follow_the_leader(self.leader)
+        self.assertEqual(self.events, ['stop', 'resync', 'stop', 'resync', 'recovery.conf', 'start'])
+        self.assertFalse(self.p.needs_resync)
+
+    def test_without_rewind(self):
+        self.p.config.use_pg_rewind = False
+        self.leader.timeline = 3
+        self.p.follow_the_leader(self.leader)
+        self.assertEqual(self.events, ['recovery.conf', 'restart'])
+
+    def test_not_started_while_resync_is_needed(self):
+        self.p.needs_resync = True
+        self.p.is_healthy = lambda: False
+        dcs = Client(Store())
+        dcs.touch_member('postgresql1', self.leader.to_value())
+        dcs.take_leadership('postgresql1')
+        ha = Ha(self.p, dcs)
+        ha.refresh_cluster()
+        self.assertFalse(ha.recover())
+        self.assertEqual(self.events, [])
+
+        self.p.needs_resync = False
+        self.assertTrue(ha.recover())
+        self.assertEqual(self.events, ['recovery.conf', 'start'])
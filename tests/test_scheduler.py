@@ -0,0 +1,93 @@
+import unittest
+
+from governor.memory import SimulatedClock
+from governor.scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestScheduler, self).__init__(method_name)
+
+    def set_up(self):
+        self.clock = SimulatedClock(1000)
+        self.scheduler = Scheduler(10, self.clock)
+
+    def refresh(self, key, ttl, rtt):
+        started = self.clock.time()
+        self.clock.advance(rtt)
+        self.scheduler.refreshed(key, ttl, started)
+
+    def test_loop_time(self):
+        self.assertEqual(self.scheduler.next_cycle(), 1010)
+        self.scheduler.start_cycle()
+        self.clock.advance(3)
+        self.assertEqual(self.scheduler.end_cycle(), 3)
+        self.assertEqual(self.scheduler.next_cycle(), 1010)
+        self.assertEqual(self.scheduler.wait_time(), 7)
+
+    def test_ttl_deadline(self):
+        self.scheduler.start_cycle()
+        self.clock.advance(2)
+        # refreshed 2 seconds into the cycle, answered after 1 second
+        self.refresh('postgresql0', 10, 1)
+        self.scheduler.end_cycle()
+        self.assertAlmostEqual(self.scheduler.rtt, 0.2)
+        # expires at 1012, the next cycle needs 2 seconds to get there and 3 round trips to spare
+        self.assertAlmostEqual(self.scheduler.next_cycle(), 1012 - 2 - 3 * 0.2)
+
+    def test_rtt_average(self):
+        self.refresh('postgresql0', 30, 1)
+        self.refresh('postgresql0', 30, 1)
+        self.assertAlmostEqual(self.scheduler.rtt, 0.2 + 0.8 * 0.2)
+        self.refresh('postgresql0', 30, 0)
+        self.assertAlmostEqual(self.scheduler.rtt, 0.8 * 0.36)
+
+    def test_refreshed_outside_of_a_cycle(self):
+        self.scheduler.start_cycle()
+        self.scheduler.end_cycle()
+        self.clock.advance(5)
+        # a heartbeat refresh needs no head start
+        self.refresh('leader', 4, 0)
+        self.assertEqual(self.scheduler.next_cycle(), 1005 + 4)
+        self.refresh('leader', 3, 0)
+        self.assertEqual(self.scheduler.next_cycle(), 1005 + 3)
+
+    def test_forget(self):
+        self.scheduler.start_cycle()
+        self.refresh('leader', 4, 0)
+        self.assertEqual(self.scheduler.next_cycle(), 1004)
+        self.scheduler.forget('leader')
+        self.assertEqual(self.scheduler.next_cycle(), 1010)
+        self.scheduler.forget('leader')
+
+    def test_missed_refresh(self):
+        self.refresh('postgresql0', 5, 0)
+        self.clock.advance(5)
+        self.refresh('postgresql0', 5, 0)
+        self.assertEqual(self.scheduler.missed, 0)
+        self.clock.advance(5.5)
+        self.refresh('postgresql0', 5, 0)
+        self.assertEqual(self.scheduler.missed, 1)
+        # a forgotten key starts over
+        self.scheduler.forget('postgresql0')
+        self.clock.advance(10)
+        self.refresh('postgresql0', 5, 0)
+        self.assertEqual(self.scheduler.missed, 1)
+
+    def test_wait_time_is_never_negative(self):
+        self.scheduler.start_cycle()
+        self.clock.advance(12)
+        self.scheduler.end_cycle()
+        self.assertEqual(self.scheduler.wait_time(), 0)
+
+    def test_overruns(self):
+        self.scheduler.start_cycle()
+        self.clock.advance(10)
+        self.scheduler.end_cycle()
+        self.assertEqual(self.scheduler.overruns, 0)
+        self.scheduler.start_cycle()
+        self.clock.advance(10.5)
+        self.scheduler.end_cycle()
+        self.assertEqual(self.scheduler.overruns, 1)
@@ -0,0 +1,48 @@
+import unittest
+
+from governor.memory import Client, SimulatedClock, Store
+from governor.semaphore import Semaphore, holders
+
+
+class TestSemaphore(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestSemaphore, self).__init__(method_name)
+
+    def set_up(self):
+        self.clock = SimulatedClock()
+        self.store = Store(self.clock)
+
+    def semaphore(self, name, source, limit=2, source_limit=0):
+        semaphore = Semaphore(Client(self.store, ttl=30), 'basebackup', name, limit, source_limit)
+        semaphore.source = source
+        return semaphore
+
+    def test_holders(self):
+        tickets = [('a', 'leader'), ('b', 'leader'), ('c', 'replica'), ('d', 'leader')]
+        self.assertEqual(holders(tickets, 2), ['a', 'b'])
+        self.assertEqual(holders(tickets, 2, source_limit=1), ['a', 'c'])
+        self.assertEqual(holders(tickets, 5, source_limit=2), ['a', 'b', 'c'])
+
+    def test_queue(self):
+        semaphores = [self.semaphore('postgresql{}'.format(i), 'postgresql0') for i in range(1, 5)]
+        self.assertEqual([s.position() for s in semaphores], [0, 0, 1, 2])
+
+        semaphores[0].release()
+        self.assertEqual([s.position() for s in semaphores[1:]], [0, 0, 1])
+
+    def test_per_source_limit(self):
+        first = self.semaphore('postgresql1', 'postgresql0', source_limit=1)
+        second = self.semaphore('postgresql2', 'postgresql0', source_limit=1)
+        third = self.semaphore('postgresql3', 'postgresql1', source_limit=1)
+        self.assertEqual([first.position(), second.position(), third.position()], [0, 1, 0])
+
+    def test_expired_ticket_frees_the_slot(self):
+        first = self.semaphore('postgresql1', 'postgresql0', limit=1)
+        second = self.semaphore('postgresql2', 'postgresql0', limit=1)
+        self.assertEqual([first.position(), second.position()], [0, 1])
+        self.clock.advance(20)
+        second.dcs.refresh_key(second.key, second.source, 30)
+        self.clock.advance(15)
+        self.assertEqual(second.position(), 0)
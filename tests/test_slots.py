@@ -0,0 +1,99 @@
+import unittest
+
+from argparse import Namespace
+
+from governor.postgresql import SLOT_RETAINED, Postgresql, State
+
+
+class SlotsPostgresql(Postgresql):
+    """Answers the reconcile statement from a dict of slot name: active."""
+
+    def __init__(self, slots):
+        self.name = 'postgresql0'
+        self.slots = slots
+        self.members = set(slots)
+        self.queries = []
+
+    def query(self, sql, *params):
+        self.queries.append(sql)
+        wanted, = params
+        rows = [('dropped', s) for s, active in sorted(self.slots.items()) if s not in wanted and not active]
+        rows += [('created', s) for s in wanted if s not in self.slots]
+        for action, slot in rows:
+            if action == 'dropped':
+                del self.slots[slot]
+            else:
+                self.slots[slot] = False
+        return rows
+
+
+class TestSlots(unittest.TestCase):
+
+    def test_single_statement(self):
+        p = SlotsPostgresql({'gone': False, 'postgresql1': True})
+        p.sync_replication_slots(['postgresql0', 'postgresql1', 'postgresql2', 'postgresql3'])
+        self.assertEqual(len(p.queries), 1)
+        self.assertEqual(p.slots, {'postgresql1': True, 'postgresql2': False, 'postgresql3': False})
+        self.assertEqual(p.members, {'postgresql1', 'postgresql2', 'postgresql3'})
+
+        # nothing changed, nothing sent
+        p.sync_replication_slots(['postgresql3', 'postgresql2', 'postgresql1'])
+        self.assertEqual(len(p.queries), 1)
+
+    def test_active_slot_kept(self):
+        p = SlotsPostgresql({'postgresql1': True, 'postgresql2': False})
+        p.drop_replication_slots()
+        self.assertEqual(p.members, {'postgresql1'})
+        p.slots['postgresql1'] = False
+        p.drop_replication_slots()
+        self.assertEqual(len(p.queries), 2)
+        self.assertEqual(p.members, set())
+        p.drop_replication_slots()
+        self.assertEqual(len(p.queries), 2)
+
+
+class GuardedPostgresql(SlotsPostgresql):
+
+    def __init__(self, slots, budget=1000, grace=60):
+        super(GuardedPostgresql, self).__init__(dict((name, active) for name, (_, active) in slots.items()))
+        self.config = Namespace(max_slot_wal_keep=budget, slot_grace_period=grace)
+        self._over_budget = {}
+        self.state = State(False, 5000, slots=slots)
+
+    def query(self, sql, *params):
+        if 'unnest' in sql:
+            return super(GuardedPostgresql, self).query(sql, *params)
+        self.queries.append(sql)
+        dropped = [(s,) for s in params[0] if not self.slots.get(s, True)]
+        for s, in dropped:
+            del self.slots[s]
+        return dropped
+
+
+class TestGuard(unittest.TestCase):
+
+    def test_retention_budget(self):
+        p = GuardedPostgresql({'partitioned': (5000, False), 'streaming': (5000, True), 'fine': (10, False),
+                               'new': (None, False)})
+        self.assertEqual(p.guard_replication_slots(now=100), [])
+        self.assertEqual(p.queries, [])
+        self.assertEqual(set(p._over_budget), {'partitioned', 'streaming'})
+        self.assertEqual(p.guard_replication_slots(now=130), [])
+
+        # the slot of a member which is still around comes back, reserving nothing
+        self.assertEqual(p.guard_replication_slots(now=160), ['partitioned'])
+        self.assertEqual(set(p._over_budget), {'streaming'})
+        p.sync_replication_slots(['partitioned', 'streaming', 'fine', 'new'])
+        self.assertIn('partitioned', p.slots)
+
+        self.assertEqual(SLOT_RETAINED.labels('partitioned').value, 5000)
+        p.state = State(False, 5000, slots={'fine': (10, False)})
+        p.guard_replication_slots(now=200)
+        self.assertEqual(SLOT_RETAINED.children(), [('fine',)])
+        self.assertEqual(p._over_budget, {})
+
+    def test_unlimited(self):
+        p = GuardedPostgresql({'partitioned': (5000, False)}, budget=0)
+        self.assertEqual(p.guard_replication_slots(now=100), [])
+        self.assertEqual(p.guard_replication_slots(now=1000), [])
+        self.assertEqual(p.queries, [])
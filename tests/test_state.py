@@ -0,0 +1,208 @@
+import unittest
+
+from argparse import Namespace
+
+from governor.api import Status
+from governor.dcs import Member
+from governor.ha import Ha
+from governor.memory import Client, SimulatedClock, Store
+from governor.postgresql import Postgresql, State
+from psycopg2 import OperationalError
+
+
+class SnapshotOnlyPostgresql(Postgresql):
+    """Fails every call which should have been answered from the snapshot."""
+
+    def __init__(self, name, state):
+        self.name = name
+        self.config = Namespace(maximum_lag=1000, max_slot_wal_keep=0)
+        self.promoted = False
+        self.snapshot = state
+        self.followed = []
+
+    def collect_state(self):
+        self.state = self.snapshot
+        return self.state
+
+    def follow_the_leader(self, leader):
+        self.followed.append(leader and leader.name)
+        return True
+
+    def create_replication_slots(self, cluster, leader):
+        pass
+
+    def drop_replication_slots(self):
+        pass
+
+    def is_leader(self):
+        raise AssertionError('is_leader() queried postgres')
+
+    def xlog_position(self):
+        raise AssertionError('xlog_position() queried postgres')
+
+    def is_running(self):
+        raise AssertionError('is_running() forked pg_ctl')
+
+    def probe_member(self, name, url, position):
+        raise OperationalError('could not connect')
+
+
+class Cursor:
+
+    def __init__(self, row):
+        self.row = row
+        self.closed = False
+
+    def execute(self, sql, params=None):
+        if isinstance(self.row, Exception):
+            raise self.row
+
+    def fetchone(self):
+        return self.row
+
+
+class QueriedPostgresql(Postgresql):
+    """Postgresql whose single cursor answers the snapshot query with a fixed row."""
+
+    def __init__(self, row):
+        self.promoted = True
+        self.members = set()
+        self._cursor_holder = Cursor(row)
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+        self._cursor_holder = None
+
+
+class TestState(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestState, self).__init__(method_name)
+
+    def set_up(self):
+        self.clock = SimulatedClock()
+        self.dcs = Client(Store(self.clock), ttl=30)
+
+    def ha(self, name, state):
+        ha = Ha(SnapshotOnlyPostgresql(name, state), self.dcs)
+        ha.collect_state()
+        self.dcs.touch_member(name, Member(name, 'host:5432', timestamp=1, **state.member_state()).to_value())
+        return ha
+
+    def test_state(self):
+        state = State(True, None, 200, 100, 2, {'postgresql1': (100, True)})
+        self.assertFalse(state.is_leader)
+        self.assertEqual(state.position, 100)
+        self.assertEqual(state.member_state(), {'in_recovery': True, 'lsn': 100, 'receive_lsn': 200, 'timeline': 2})
+        self.assertEqual(State(False, 300, None, 100).position, 300)
+
+    def test_collect_state(self):
+        slots = {'postgresql1': ['100', True], 'postgresql2': [None, False]}
+        psql = QueriedPostgresql((True, None, '200', '100', 2, slots))
+        state = psql.collect_state()
+        self.assertIs(psql.state, state)
+        self.assertEqual((state.in_recovery, state.current_lsn, state.receive_lsn, state.replay_lsn, state.timeline),
+                         (True, None, 200, 100, 2))
+        self.assertEqual(state.slots, {'postgresql1': (100, True), 'postgresql2': (None, False)})
+        self.assertEqual(psql.members, {'postgresql1', 'postgresql2'})
+        self.assertTrue(psql.promoted)
+
+        psql = QueriedPostgresql((False, '300', None, None, 3, None))
+        state = psql.collect_state()
+        self.assertEqual((state.position, state.slots), (300, {}))
+        self.assertFalse(psql.promoted)
+
+    def test_collect_state_failed(self):
+        psql = QueriedPostgresql(OperationalError('server closed the connection unexpectedly'))
+        psql.state = State(False, 300)
+        self.assertIsNone(psql.collect_state())
+        self.assertIsNone(psql.state)
+        self.assertTrue(psql.disconnected)
+        self.assertEqual(psql.member_state(), {})
+
+    def test_record(self):
+        state = State(True, None, 200, 100, 3)
+        value = Member('postgresql1', 'host:5432', timestamp=1, **state.member_state()).to_value()
+        member = Member.from_value('postgresql1', value)
+        self.assertEqual((member.in_recovery, member.lsn, member.receive_lsn, member.timeline), (True, 100, 200, 3))
+        self.assertTrue(member.has_state)
+        # postgres did not answer, the record still shows the member is alive
+        member = Member.from_value('postgresql1', Member('postgresql1', 'host:5432', timestamp=1).to_value())
+        self.assertTrue(member.has_state)
+        self.assertIsNone(member.lsn)
+        # older governors publish the url only
+        self.assertFalse(Member.from_value('postgresql1', 'host:5432').has_state)
+
+    def test_leader_cycle(self):
+        ha = self.ha('postgresql0', State(False, 300))
+        self.dcs.take_leadership('postgresql0')
+        self.assertEqual(ha.run_cycle(), 'No action. I am the leader with the lock')
+        self.assertEqual(self.dcs.get_cluster().optime, 300)
+        ha.sync_replication_slots()
+
+    def test_election(self):
+        self.ha('postgresql1', State(True, None, 200, 200))
+        ha = self.ha('postgresql0', State(True, None, 100, 100))
+        self.assertEqual(ha.run_cycle(), 'Following the leader')
+        self.assertEqual(ha.psql.followed, [None])
+
+        ha = self.ha('postgresql2', State(True, None, 300, 300))
+        ha.psql.promote = lambda: True
+        self.assertEqual(ha.run_cycle(), 'Promoted self to leader by acquiring session lock')
+
+    def test_no_new_snapshot_while_following(self):
+        self.ha('postgresql1', State(False, 300))
+        self.dcs.take_leadership('postgresql1')
+        ha = self.ha('postgresql0', State(True, None, 300, 300))
+        self.assertEqual(ha.run_cycle(), 'Following the leader')
+        ha.psql.collect_state = lambda: self.fail('queried postgres again')
+        self.assertIs(ha.refresh_state(), ha.psql.snapshot)
+
+    def test_status_after_promotion(self):
+        ha = self.ha('postgresql0', State(True, None, 300, 300))
+
+        def promote():
+            ha.psql.snapshot = State(False, 300)
+            return True
+        ha.psql.promote = promote
+        self.assertEqual(ha.run_cycle(), 'Promoted self to leader by acquiring session lock')
+        self.assertEqual(Status.from_ha(ha).role, 'replica')
+        ha.refresh_state()
+        # haproxy sends writes to the new leader without waiting for its next cycle
+        self.assertEqual(Status.from_ha(ha).role, 'master')
+
+    def test_election_ignores_stale_records(self):
+        self.ha('postgresql1', State(True, None, 200, 200))
+        ha = self.ha('postgresql0', State(True, None, 100, 100))
+        ha.psql.promote = lambda: True
+        self.assertEqual(ha.run_cycle(), 'Following the leader')
+        self.clock.advance(20)
+        # postgresql1 is kept alive by its heartbeat while its HA loop is stuck
+        self.dcs.touch_member('postgresql1', self.dcs.get_cluster().members['postgresql1'].to_value())
+        self.dcs.touch_member('postgresql0', Member('postgresql0', 'host:5432', timestamp=21,
+                                                    **ha.psql.snapshot.member_state()).to_value())
+        self.clock.advance(11)
+        ha.collect_state()
+        self.assertEqual(ha.run_cycle(), 'Promoted self to leader by acquiring session lock')
+
+    def test_keep_alive_renews_once(self):
+        ha = self.ha('postgresql0', State(False, 300))
+        self.dcs.take_leadership('postgresql0')
+        ha.has_lock = True
+        self.dcs.requests.clear()
+        ha.keep_alive(Member('postgresql0', 'host:5432', timestamp=2, **ha.state.member_state()).to_value())
+        self.assertEqual(ha.run_cycle(), 'No action. I am the leader with the lock')
+        self.assertEqual([self.dcs.requests[m] for m in ('touch_member', 'update_leadership', 'write_optime')],
+                         [1, 1, 1])
+        self.assertEqual(self.dcs.get_cluster().optime, 300)
+
+    def test_keep_alive_lost_lock(self):
+        ha = self.ha('postgresql0', State(False, 300))
+        self.dcs.take_leadership('postgresql1')
+        ha.has_lock = True
+        ha.keep_alive(Member('postgresql0', 'host:5432', timestamp=2, **ha.state.member_state()).to_value())
+        self.assertFalse(ha.has_lock)
+        self.assertEqual(self.dcs.get_cluster().members['postgresql0'].timestamp, 2)
+        self.assertIsNone(self.dcs.get_cluster().optime)
@@ -0,0 +1,83 @@
+import io
+import logging
+import os
+import signal
+import threading
+import time
+import unittest
+
+from governor.memory import Client, Store
+from governor.supervisor import LogPump, Supervisor, zombie_children
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestSupervisor, self).__init__(method_name)
+
+    def set_up(self):
+        self.supervisor = Supervisor()
+        self.handler = ListHandler()
+        self.log = logging.getLogger('test_supervisor')
+        self.log.addHandler(self.handler)
+        self.log.setLevel(logging.INFO)
+        self.log.propagate = False
+
+    def tear_down(self):
+        self.log.removeHandler(self.handler)
+
+    def test_log_pump(self):
+        pump = LogPump(io.StringIO(''.join('line {}\n'.format(i) for i in range(50))), self.log, max_lines=10)
+        pump._read()
+        self.assertEqual(pump.dropped, 40)
+        pump._write()
+        messages = [r.getMessage() for r in self.handler.records]
+        self.assertEqual(messages[0], 'Dropped 40 lines of output')
+        self.assertEqual(messages[1], '\n'.join('line {}'.format(i) for i in range(40, 50)))
+
+    def test_start(self):
+        exited = threading.Event()
+        self.supervisor.start(['sh', '-c', 'echo hello; exit 3'], self.log, lambda proc: exited.set())
+        self.assertTrue(exited.wait(5))
+        time.sleep(0.1)
+        self.assertIn('hello', [r.getMessage() for r in self.handler.records])
+
+    def test_reap_leaves_owned_children_alone(self):
+        proc = self.supervisor.popen(['sh', '-c', 'exit 7'])
+        orphan = os.fork()
+        if orphan == 0:
+            os._exit(0)
+        deadline = time.time() + 5
+        while len(zombie_children()) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertTrue(self.supervisor.reap())
+        self.assertEqual(zombie_children(), [proc.pid])
+        self.assertEqual(self.supervisor.wait(proc), 7)
+
+    def test_sigchld(self):
+        previous = signal.signal(signal.SIGCHLD, self.supervisor.handle_sigchld)
+        try:
+            self.supervisor.start_reaper()
+            for _ in range(5):
+                self.assertEqual(self.supervisor.call(['sh', '-c', 'exit 5']), 5)
+        finally:
+            signal.signal(signal.SIGCHLD, previous)
+
+    def test_wake(self):
+        view = Client(Store()).cluster_view()
+        threading.Timer(0.1, view.wake).start()
+        self.assertTrue(view.wait_for_change(None, 5))
+        self.assertFalse(view.wait_for_change(None, 0.1))
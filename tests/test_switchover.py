@@ -0,0 +1,170 @@
+import time
+import unittest
+
+from argparse import Namespace
+
+from governor.dcs import Member, to_json
+from governor.ha import Ha
+from governor.memory import Client, Store
+from governor.postgresql import Postgresql, State
+from psycopg2 import OperationalError
+
+
+class SwitchoverPostgresql(Postgresql):
+    """Postgres recording what was done to it, with the positions of the other members in a dict."""
+
+    def __init__(self, name, in_recovery=False, replayed=None):
+        self.name = name
+        self.config = Namespace(maximum_lag=0)
+        self.state = State(in_recovery, None if in_recovery else 100, 100, 100)
+        self.replayed = replayed or {}
+        self.promoted = set()
+        self.events = []
+
+    def collect_state(self):
+        return self.state
+
+    def is_leader(self):
+        return not self.state.in_recovery
+
+    def query(self, sql, *params):
+        self.events.append(sql)
+
+    def xlog_position(self):
+        return 100
+
+    def local_position(self):
+        return 1, 120
+
+    def probe_member(self, name, url, position):
+        if name not in self.replayed:
+            raise OperationalError('could not connect')
+        return name not in self.promoted, position - self.replayed[name]
+
+    def stop(self):
+        self.events.append('stop')
+        return True
+
+    def start(self):
+        self.events.append('start')
+        return True
+
+    def write_recovery_conf(self, leader):
+        self.events.append('recovery.conf ' + (leader.name if leader else 'none'))
+        self.state = State(leader is not None, None if leader else 120, 120, 120)
+
+    def follow_the_leader(self, leader):
+        pass
+
+    def promote(self):
+        self.events.append('promote')
+        self.state = State(False, 120, 120, 120)
+        return True
+
+
+class TestSwitchover(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestSwitchover, self).__init__(method_name)
+
+    def set_up(self):
+        self.dcs = Client(Store(), ttl=30)
+        self.dcs.touch_member('postgresql0', Member('postgresql0', 'host:5432', False, 100, timestamp=1).to_value())
+        self.dcs.touch_member('postgresql1', Member('postgresql1', 'host:5433', True, 100, timestamp=1).to_value())
+        self.dcs.take_leadership('postgresql0')
+        self.psql = SwitchoverPostgresql('postgresql0', replayed={'postgresql1': 120})
+        self.ha = Ha(self.psql, self.dcs)
+        self.ha.POLL_INTERVAL = 0.01
+
+    def request(self, target='postgresql1'):
+        self.dcs.create_key(self.dcs.SWITCHOVER_KEY, to_json({'leader': 'postgresql0', 'target': target}), 30)
+
+    def run_cycle(self):
+        self.ha.collect_state()
+        return self.ha.run_cycle()
+
+    def test_switchover(self):
+        self.assertEqual(self.run_cycle(), 'No action. I am the leader with the lock')
+        self.request()
+
+        # the target promotes as soon as it is handed the leader key
+        target = Ha(SwitchoverPostgresql('postgresql1', in_recovery=True), self.dcs)
+        target.collect_state()
+        target.run_cycle()
+        self.assertEqual(target.cluster.switchover_target, 'postgresql1')
+        self.dcs.transfer_leadership = self.transfer(self.dcs.transfer_leadership, target)
+
+        self.assertEqual(self.run_cycle(), 'Switching over to postgresql1, waiting for it to catch up')
+        self.assertEqual(self.psql.events, ['CHECKPOINT'])
+        self.assertTrue(self.run_cycle().startswith('Switched over to postgresql1'))
+        self.assertEqual(self.psql.events, ['CHECKPOINT', 'stop', 'recovery.conf postgresql1', 'start'])
+        self.assertEqual(target.psql.events, ['promote'])
+        self.assertFalse(self.ha.has_lock)
+
+        cluster = self.dcs.get_cluster()
+        self.assertEqual(cluster.leader_name, 'postgresql1')
+        self.assertEqual(cluster.switchover['result'], 'done')
+        self.assertIsNone(cluster.switchover_target)
+        self.assertEqual(self.run_cycle(), 'Following the leader')
+
+    def transfer(self, transfer_leadership, target):
+        def wrapper(value, name):
+            result = transfer_leadership(value, name)
+            target.collect_state()
+            self.assertEqual(target.run_cycle(), 'Promoted self to leader')
+            self.psql.promoted.add(name)
+            return result
+        return wrapper
+
+    def test_renews_while_waiting(self):
+        self.psql.replayed['postgresql1'] = 90
+        self.request()
+        self.assertEqual(self.run_cycle(), 'Switching over to postgresql1, waiting for it to catch up')
+        renewals = self.dcs.requests['update_leadership']
+        for _ in range(3):
+            self.assertEqual(self.run_cycle(), 'Switching over to postgresql1, waiting for it to catch up')
+        self.assertEqual(self.dcs.requests['update_leadership'], renewals + 3)
+        # and the loop comes back for the next step soon
+        started = time.time()
+        self.ha.wait_for_change(5)
+        self.assertLess(time.time() - started, 1)
+
+        self.psql.replayed['postgresql1'] = 120
+        self.assertEqual(self.run_cycle(), 'Handed over to postgresql1, waiting for it to promote')
+        self.assertEqual(self.dcs.get_cluster().leader_name, 'postgresql1')
+        self.psql.promoted.add('postgresql1')
+        self.assertTrue(self.run_cycle().startswith('Switched over to postgresql1'))
+
+    def test_refused(self):
+        self.request('postgresql0')
+        self.assertEqual(self.run_cycle(), 'Refused the switchover to postgresql0')
+        self.assertEqual(self.psql.events, [])
+        self.assertEqual(self.dcs.get_cluster().switchover['result'], 'failed')
+        self.assertEqual(self.run_cycle(), 'No action. I am the leader with the lock')
+
+    def test_target_behind(self):
+        self.psql.replayed['postgresql1'] = 110
+        self.request()
+        self.run_cycle()
+        self.assertEqual(self.run_cycle(),
+                         'Switching over to postgresql1, waiting for it to replay the shutdown checkpoint')
+        self.ha.switchover.deadline = time.time()
+        self.assertEqual(self.run_cycle(),
+                         'Switchover to postgresql1 failed, it did not receive the shutdown checkpoint')
+        # still the leader, running again
+        self.assertEqual(self.psql.events, ['CHECKPOINT', 'stop', 'start'])
+        self.assertEqual(self.dcs.get_cluster().leader_name, 'postgresql0')
+        self.assertEqual(self.dcs.get_cluster().switchover['reason'], 'did not receive the shutdown checkpoint')
+        self.assertIsNone(self.ha.switchover)
+
+    def test_lost_lock(self):
+        self.psql.replayed['postgresql1'] = 110
+        self.request()
+        self.run_cycle()
+        self.run_cycle()
+        self.dcs.vacate_leadership('postgresql0')
+        self.dcs.take_leadership('postgresql1')
+        self.assertEqual(self.run_cycle(), 'Switchover to postgresql1 failed, lost the leader lock')
+        self.assertEqual(self.psql.events, ['CHECKPOINT', 'stop', 'start'])
+        self.assertFalse(self.ha.has_lock)
@@ -0,0 +1,97 @@
+import unittest
+
+from argparse import Namespace
+
+from governor.dcs import Member
+from governor.ha import Ha
+from governor.memory import Client, Store
+from governor.postgresql import Postgresql, State
+
+
+class SyncPostgresql(Postgresql):
+    """Leader whose pg_stat_replication is a dict, recording the statements sent."""
+
+    def __init__(self, name, streaming=None, in_recovery=False):
+        self.name = name
+        self.config = Namespace(maximum_lag=0)
+        self.promoted = False
+        self.streaming = streaming or {}
+        self.synchronous_standby_names = None
+        self.state = State(in_recovery, None if in_recovery else 100, 100, 100)
+        self.queries = []
+
+    def collect_state(self):
+        return self.state
+
+    def query(self, sql, *params):
+        self.queries.append(params[0] if params else sql)
+
+    def replication_lag(self):
+        return dict(self.streaming)
+
+    def follow_the_leader(self, leader):
+        pass
+
+    def is_healthiest_node(self, cluster, state=None):
+        raise AssertionError('asked the other members')
+
+
+class TestSynchronousStandbys(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestSynchronousStandbys, self).__init__(method_name)
+
+    def set_up(self):
+        self.dcs = Client(Store())
+        for name in ('postgresql0', 'a', 'b', 'c'):
+            self.dcs.touch_member(name, Member(name, 'host:5432', timestamp=1).to_value())
+
+    def leader(self, streaming, count=1):
+        ha = Ha(SyncPostgresql('postgresql0', streaming), self.dcs, synchronous_standbys=count)
+        self.dcs.take_leadership('postgresql0')
+        ha.collect_state()
+        ha.run_cycle()
+        return ha
+
+    def test_lowest_lag(self):
+        ha = self.leader({'a': (300, 'async'), 'b': (100, 'async'), 'c': (200, 'async'),
+                          'governor_clone_d': (0, 'async')})
+        ha.update_synchronous_standbys()
+        self.assertEqual(ha.psql.queries, ['1 ("b")', 'SELECT pg_reload_conf()'])
+        # not waited for yet, so not published yet
+        self.assertIsNone(self.dcs.get_cluster().sync)
+
+        ha.psql.streaming['b'] = (0, 'sync')
+        ha.update_synchronous_standbys()
+        self.assertEqual(len(ha.psql.queries), 2)
+        self.assertEqual(self.dcs.get_cluster().sync, {'leader': 'postgresql0', 'members': ['b']})
+
+        # b is gone: unpublished first, then postgres stops waiting for it
+        del ha.psql.streaming['b']
+        ha.update_synchronous_standbys()
+        self.assertEqual(ha.psql.queries[2], '1 ("c")')
+        self.assertEqual(self.dcs.get_cluster().sync, {'leader': 'postgresql0', 'members': []})
+
+    def test_nobody_streaming(self):
+        ha = self.leader({}, count=2)
+        ha.update_synchronous_standbys()
+        self.assertEqual(ha.psql.queries, ['', 'SELECT pg_reload_conf()'])
+        self.assertIsNone(self.dcs.get_cluster().sync)
+
+    def test_failover_prefers_sync_standby(self):
+        self.dcs.write_sync('{"leader":"old","members":["b"]}')
+        for name, expected in (('a', 'Following the leader'),
+                               ('b', 'Promoted self to leader by acquiring session lock')):
+            psql = SyncPostgresql(name, in_recovery=True)
+            psql.promote = lambda: True
+            ha = Ha(psql, self.dcs)
+            ha.collect_state()
+            self.assertEqual(ha.run_cycle(), expected)
+
+        # once the standbys are gone, the most up to date member wins as before
+        self.dcs.vacate_leadership('b')
+        self.dcs.delete_member('b')
+        ha = Ha(SyncPostgresql('a', in_recovery=True), self.dcs)
+        ha.collect_state()
+        self.assertRaises(AssertionError, ha.run_cycle)
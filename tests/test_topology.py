@@ -0,0 +1,126 @@
+import unittest
+
+from governor import topology
+from governor.dcs import Cluster, Member
+from governor.memory import Client, SimulatedClock, Store
+
+
+def member(name, fanout=None, replicatefrom=None, in_recovery=True):
+    tags = {}
+    if fanout is not None:
+        tags['fanout'] = fanout
+    if replicatefrom:
+        tags['replicatefrom'] = replicatefrom
+    return Member(name, 'postgres://repl@{}:5432/postgres'.format(name), in_recovery, 100, 100, 1, tags=tags)
+
+
+def cluster(*members, leader='leader', stale=frozenset()):
+    return Cluster(dict((m.name, m) for m in members), leader, stale=stale)
+
+
+class TestTopology(unittest.TestCase):
+
+    def test_flat_without_tags(self):
+        c = cluster(member('leader', in_recovery=False), member('a'), member('b'))
+        self.assertEqual(topology.plan(c, 'leader'), {'a': 'leader', 'b': 'leader'})
+        self.assertEqual(topology.children(c, 'leader', 'leader'), ['a', 'b'])
+        self.assertEqual(topology.children(c, 'leader', 'a'), [])
+        self.assertIs(topology.upstream(c, 'a'), c.leader)
+        self.assertEqual(topology.plan(c, None), {})
+
+    def test_fanout(self):
+        c = cluster(member('leader', 2, in_recovery=False), member('a'), member('b', 2), member('c', 1),
+                    member('d'), member('e'), member('f'))
+        self.assertEqual(topology.plan(c, 'leader'),
+                         {'b': 'leader', 'c': 'leader', 'a': 'b', 'd': 'b', 'e': 'c', 'f': 'leader'})
+        self.assertEqual(topology.children(c, 'leader', 'b'), ['a', 'd'])
+
+    def test_replicate_from(self):
+        c = cluster(member('leader', in_recovery=False), member('a', replicatefrom='b'), member('b', 1),
+                    member('c', replicatefrom='b'), member('d', replicatefrom='nobody'))
+        self.assertEqual(topology.plan(c, 'leader'), {'b': 'leader', 'a': 'b', 'c': 'leader', 'd': 'leader'})
+        self.assertEqual(topology.upstream(c, 'a').name, 'b')
+
+    def test_reparent(self):
+        c = cluster(member('leader', 1, in_recovery=False), member('a', 2), member('b'), member('c'))
+        self.assertEqual(topology.plan(c, 'leader'), {'a': 'leader', 'b': 'a', 'c': 'a'})
+
+        # the upstream is gone, or still there but cloning
+        del c.members['a']
+        self.assertEqual(topology.plan(c, 'leader'), {'b': 'leader', 'c': 'leader'})
+        c.members['a'] = member('a', 2)
+        c.members['a'].clone = {'done': 1}
+        self.assertEqual(topology.plan(c, 'leader')['b'], 'leader')
+
+    def test_missed_snapshot(self):
+        c = cluster(member('leader', 1, in_recovery=False), member('a', 2), member('b'), member('c'))
+        # postgres of a did not answer when it published its record
+        c.members['a'] = Member('a', c.members['a'].url, timestamp=2, tags={'fanout': 2})
+        self.assertEqual(topology.plan(c, 'leader'), {'a': 'leader', 'b': 'a', 'c': 'a'})
+
+        c.stale = frozenset(['a'])
+        self.assertEqual(topology.plan(c, 'leader'), {'a': 'leader', 'b': 'leader', 'c': 'leader'})
+
+    def test_flapping_record(self):
+        clock = SimulatedClock()
+        dcs = Client(Store(clock), ttl=30)
+        view = dcs.cluster_view()
+        dcs.take_leadership('postgresql0')
+        dcs.touch_member('postgresql0', member('postgresql0', 1, in_recovery=False).to_value())
+
+        plans = []
+        for i in range(10):
+            # every other cycle of a misses its snapshot
+            a = member('a', 2) if i % 2 else Member('a', 'a:5432', tags={'fanout': 2})
+            a.timestamp = i
+            for m in (member('b'), member('c'), a):
+                dcs.touch_member(m.name, m.to_value())
+            dcs.update_leadership('postgresql0')
+            plans.append(topology.plan(view.cluster(), 'postgresql0'))
+            clock.advance(3)
+        self.assertEqual(plans, [{'a': 'postgresql0', 'b': 'a', 'c': 'a'}] * 10)
+
+        # its loop gets stuck, the heartbeat keeps the record alive as it was
+        for _ in range(11):
+            for m in (member('postgresql0', 1, in_recovery=False), member('b'), member('c'), a):
+                dcs.touch_member(m.name, m.to_value())
+            dcs.update_leadership('postgresql0')
+            clock.advance(3)
+        self.assertEqual(topology.plan(view.cluster(), 'postgresql0'),
+                         {'a': 'postgresql0', 'b': 'postgresql0', 'c': 'postgresql0'})
+
+    def test_postgres_down(self):
+        clock = SimulatedClock()
+        dcs = Client(Store(clock), ttl=30)
+        view = dcs.cluster_view()
+        dcs.take_leadership('postgresql0')
+        # postgres of a stays down after a failed rewind, its loop goes on publishing fresh records
+        for i in range(11):
+            a = Member('a', 'a:5432', tags={'fanout': 2})
+            for m in (member('postgresql0', 1, in_recovery=False), member('b'), member('c'), a):
+                m.timestamp = i
+                dcs.touch_member(m.name, m.to_value())
+            dcs.update_leadership('postgresql0')
+            plan = topology.plan(view.cluster(), 'postgresql0')
+            clock.advance(3)
+        # not for the ttl yet
+        self.assertEqual(plan, {'a': 'postgresql0', 'b': 'a', 'c': 'a'})
+        cluster = view.cluster()
+        self.assertEqual((cluster.stale, cluster.down), (frozenset(), {'a'}))
+        self.assertEqual(topology.plan(cluster, 'postgresql0'),
+                         {'a': 'postgresql0', 'b': 'postgresql0', 'c': 'postgresql0'})
+
+        # back in the tree as soon as postgres answers again
+        dcs.touch_member('a', member('a', 2).to_value())
+        self.assertEqual(topology.plan(view.cluster(), 'postgresql0'), {'a': 'postgresql0', 'b': 'a', 'c': 'a'})
+
+    def test_no_cycles(self):
+        c = cluster(member('leader', 0, in_recovery=False), member('a', 1, replicatefrom='b'),
+                    member('b', 1, replicatefrom='a'))
+        plan = topology.plan(c, 'leader')
+        for name in plan:
+            seen = set()
+            while name != 'leader':
+                self.assertNotIn(name, seen)
+                seen.add(name)
+                name = plan[name]
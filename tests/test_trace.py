@@ -0,0 +1,54 @@
+import json
+import threading
+import unittest
+
+from governor.trace import Tracer
+
+
+class TestTrace(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestTrace, self).__init__(method_name)
+
+    def set_up(self):
+        self.tracer = Tracer(size=2)
+
+    def test_nested_spans(self):
+        @self.tracer.span('refresh_cluster')
+        def refresh_cluster():
+            with self.tracer.span('etcd load_scope'):
+                pass
+
+        with self.tracer.cycle():
+            refresh_cluster()
+            try:
+                with self.tracer.span('query'):
+                    raise ValueError
+            except ValueError:
+                pass
+
+        cycle, = json.loads(self.tracer.dumps())
+        self.assertEqual(cycle['name'], 'cycle')
+        self.assertIn('started', cycle)
+        self.assertEqual([s['name'] for s in cycle['spans']], ['refresh_cluster', 'query'])
+        self.assertEqual(cycle['spans'][0]['spans'][0]['name'], 'etcd load_scope')
+        self.assertGreaterEqual(cycle['spans'][0]['spans'][0]['offset'], cycle['spans'][0]['offset'])
+        self.assertEqual(cycle['spans'][1]['error'], 'ValueError')
+        self.assertGreaterEqual(cycle['duration'], cycle['spans'][0]['duration'])
+
+    def test_ring_buffer(self):
+        for name in ('first', 'second', 'third'):
+            with self.tracer.cycle(name):
+                pass
+        self.assertEqual([c['name'] for c in self.tracer.dump()], ['second', 'third'])
+
+    def test_outside_of_cycle(self):
+        with self.tracer.span('heartbeat'):
+            pass
+        with self.tracer.cycle():
+            # spans of other threads do not end up in the cycle of this one
+            thread = threading.Thread(target=self.tracer.span('heartbeat')(lambda: None))
+            thread.start()
+            thread.join()
+        self.assertNotIn('spans', self.tracer.dump()[0])
@@ -0,0 +1,93 @@
+import unittest
+
+from governor.dcs import Member
+from governor.memory import Client, SimulatedClock, Store
+
+
+def record(name, timestamp, lsn=100):
+    return Member(name, 'host:5432', True, lsn, lsn, timestamp=timestamp).to_value()
+
+
+class TestClusterView(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestClusterView, self).__init__(method_name)
+
+    def set_up(self):
+        self.clock = SimulatedClock()
+        self.store = Store(self.clock)
+        self.client = Client(self.store, ttl=30)
+        self.other = Client(self.store, ttl=30)
+        self.view = self.client.cluster_view()
+
+    def test_members(self):
+        self.other.touch_member('postgresql1', record('postgresql1', 1))
+        cluster = self.view.cluster()
+        self.assertEqual(cluster.members['postgresql1'].lsn, 100)
+
+        self.other.touch_member('postgresql1', record('postgresql1', 2, lsn=200))
+        self.assertEqual(self.view.cluster().members['postgresql1'].lsn, 200)
+        # a changed record is not a change of the cluster
+        self.assertEqual(self.view.cluster().changed_index, cluster.changed_index)
+
+        self.other.delete_member('postgresql1')
+        self.assertEqual(self.view.cluster().members, {})
+        self.assertGreater(self.view.cluster().changed_index, cluster.changed_index)
+
+    def test_own_writes_are_not_undone(self):
+        self.view.cluster()
+        self.view.apply(self.client.touch_member('postgresql0', record('postgresql0', 1)))
+        self.view.apply(self.client.take_leadership('postgresql0'))
+        # the watch delivers the same events later
+        for event in self.client.watch_scope(1, 0):
+            self.view.apply(event, watched=True)
+        cluster = self.view.cluster()
+        self.assertEqual(cluster.leader_name, 'postgresql0')
+        self.assertEqual(list(cluster.members), ['postgresql0'])
+
+    def test_stale_record(self):
+        self.other.touch_member('postgresql1', record('postgresql1', 1))
+        self.assertEqual(self.view.cluster().stale, frozenset())
+        self.clock.advance(20)
+        # the record is kept alive, but nobody stamps it anew
+        self.other.touch_member('postgresql1', record('postgresql1', 1))
+        self.clock.advance(11)
+        cluster = self.view.cluster()
+        self.assertIn('postgresql1', cluster.members)
+        self.assertEqual(cluster.stale, {'postgresql1'})
+
+        self.other.touch_member('postgresql1', record('postgresql1', 31))
+        self.assertEqual(self.view.cluster().stale, frozenset())
+
+    def test_stale_record_survives_reload(self):
+        self.other.touch_member('postgresql1', record('postgresql1', 1))
+        self.view.cluster()
+        self.clock.advance(20)
+        self.other.touch_member('postgresql1', record('postgresql1', 1))
+        self.view.load()
+        self.clock.advance(11)
+        self.assertEqual(self.view.cluster().stale, {'postgresql1'})
+
+    def test_removed_member_is_forgotten(self):
+        self.other.touch_member('postgresql1', record('postgresql1', 1))
+        self.view.cluster()
+        self.clock.advance(20)
+        self.other.touch_member('postgresql1', record('postgresql1', 1))
+        self.clock.advance(11)
+        self.assertEqual(self.view.cluster().stale, {'postgresql1'})
+        self.other.delete_member('postgresql1')
+        self.assertEqual(self.view.cluster().stale, frozenset())
+        # coming back with the same record is a fresh start
+        self.other.touch_member('postgresql1', record('postgresql1', 1))
+        self.assertEqual(self.view.cluster().stale, frozenset())
+
+    def test_one_shot_cluster(self):
+        # one read cannot tell how old a record is
+        self.other.touch_member('postgresql1', record('postgresql1', 1))
+        self.clock.advance(20)
+        self.other.touch_member('postgresql1', record('postgresql1', 1))
+        self.clock.advance(11)
+        cluster = self.other.get_cluster()
+        self.assertIn('postgresql1', cluster.members)
+        self.assertEqual(cluster.stale, frozenset())
@@ -0,0 +1,228 @@
+import etcd
+import threading
+import unittest
+
+from argparse import Namespace
+
+from governor.dcs import AbstractDCS, ClusterView, HistoryCleared, Member
+from governor.etcd import Client as Etcd
+from governor.ha import Ha
+from governor.memory import Client, Store
+
+
+class EtcdResult:
+
+    def __init__(self, key, value, index, etcd_index=None, action='set'):
+        self.key = key
+        self.value = value
+        self.modifiedIndex = index
+        self.etcd_index = index if etcd_index is None else etcd_index
+        self.action = action
+        self.dir = False
+
+
+class EtcdScope:
+
+    def __init__(self, nodes, etcd_index):
+        self.leaves = nodes
+        self.etcd_index = etcd_index
+
+
+class TestEtcdWatch(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestEtcdWatch, self).__init__(method_name)
+
+    def set_up(self):
+        self.client = Etcd(Namespace(etcd_url='http://127.0.0.1:4001', etcd_ttl=20, etcd_prefix='/governor',
+                                     ca_file=None, cert_file=None, key_file=None))
+        self.reads = []
+
+    def stub_read(self, result):
+        def read(key, **kwargs):
+            self.reads.append((key, kwargs))
+            if isinstance(result, Exception):
+                raise result
+            return result
+        self.client.read = read
+
+    def test_event(self):
+        self.stub_read(EtcdResult('/governor/leader', 'postgresql0', 8))
+        events = self.client.watch_scope(8, 5)
+        self.assertEqual([e.value for e in events], ['postgresql0'])
+        self.assertEqual(self.reads, [('/governor', {'recursive': True, 'wait': True, 'waitIndex': 8, 'timeout': 5})])
+
+    def test_waiting_events_in_one_read(self):
+        self.stub_read(EtcdScope([EtcdResult('/governor/postgresql0', 'a', 3),
+                                  EtcdResult('/governor/postgresql1', 'b', 4)], 6))
+        self.client.load_scope()
+
+        def read(key, **kwargs):
+            self.reads.append((key, kwargs))
+            if kwargs.get('wait'):
+                return EtcdResult('/governor/postgresql0', 'c', 7, etcd_index=10)
+            # postgresql1 went away, postgresql2 joined and postgresql0 changed once more
+            return EtcdScope([EtcdResult('/governor/postgresql0', 'd', 9),
+                              EtcdResult('/governor/postgresql2', 'e', 8)], 10)
+        self.reads = []
+        self.client.read = read
+        events = self.client.watch_scope(7, 5)
+        self.assertEqual([(e.action, e.key, e.value, e.modifiedIndex) for e in events],
+                         [('set', '/governor/postgresql0', 'c', 7), ('set', '/governor/postgresql0', 'd', 9),
+                          ('set', '/governor/postgresql2', 'e', 8), ('delete', '/governor/postgresql1', None, 10)])
+        self.assertEqual(self.reads, [('/governor', {'recursive': True, 'wait': True, 'waitIndex': 7, 'timeout': 5}),
+                                      ('/governor', {'recursive': True})])
+
+    def test_timeout(self):
+        self.stub_read(etcd.EtcdWatchTimedOut('timed out'))
+        self.assertEqual(self.client.watch_scope(8, 5), [])
+
+    def test_index_cleared(self):
+        self.stub_read(etcd.EtcdEventIndexCleared('cleared', payload={'index': 2000}))
+        self.assertRaises(HistoryCleared, self.client.watch_scope, 8, 5)
+
+
+class FlakyClient(Client):
+    """Memory client whose next watch misses the history, or fails with `error`."""
+
+    cleared = False
+    error = None
+
+    def watch_scope(self, index, timeout):
+        if self.cleared:
+            self.cleared = False
+            raise HistoryCleared('Index {} was cleared'.format(index))
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+        return super(FlakyClient, self).watch_scope(index, timeout)
+
+
+class TestClusterView(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestClusterView, self).__init__(method_name)
+
+    def set_up(self):
+        self.store = Store()
+        self.client = FlakyClient(self.store)
+        self.other = Client(self.store)
+        self.other.touch_member('postgresql0', Member('postgresql0', 'host:5432').to_value())
+
+    def test_wakes_up_on_change(self):
+        view = ClusterView(self.client)
+        cluster = view.cluster()
+        self.other.take_leadership('postgresql0')
+        self.assertTrue(view.wait_for_change(cluster.changed_index, 5))
+        self.assertEqual(view.cluster().leader_name, 'postgresql0')
+
+    def test_ignores_renewals(self):
+        self.other.take_leadership('postgresql0')
+        view = ClusterView(self.client)
+        cluster = view.cluster()
+        self.other.update_leadership('postgresql0')
+        self.other.write_optime(100)
+        self.assertFalse(view.wait_for_change(cluster.changed_index, 0.3))
+        self.assertEqual(view.cluster().optime, 100)
+
+    def test_own_writes(self):
+        view = ClusterView(self.client)
+        cluster = view.cluster()
+        view.apply(self.client.take_leadership('postgresql1'))
+        self.assertEqual(view.cluster().leader_name, 'postgresql1')
+        self.assertFalse(view.wait_for_change(cluster.changed_index, 0.3))
+
+    def test_wake(self):
+        view = ClusterView(self.client)
+        view.cluster()
+        view.wake()
+        self.assertTrue(view.wait_for_change(None, 5))
+        self.assertFalse(view.wait_for_change(None, 0))
+
+    def test_reloads_after_missed_index(self):
+        view = ClusterView(self.client)
+        cluster = view.cluster()
+        self.client.cleared = True
+        self.other.take_leadership('postgresql0')
+        self.assertTrue(view.wait_for_change(cluster.changed_index, 5))
+        self.assertEqual(view.cluster().leader_name, 'postgresql0')
+        self.assertEqual(self.client.requests['load_scope'], 2)
+
+    def test_survives_unexpected_errors(self):
+        view = ClusterView(self.client)
+        view.RETRY_INTERVAL = 0.01
+        self.client.error = ValueError('truncated watch response')
+        cluster = view.cluster()
+        self.other.take_leadership('postgresql0')
+        self.assertTrue(view.wait_for_change(cluster.changed_index, 5))
+        self.assertEqual(view.cluster().leader_name, 'postgresql0')
+        self.assertTrue(view._thread.is_alive())
+
+    def test_restarts_dead_watcher(self):
+        view = ClusterView(self.client)
+        view.cluster()
+        view._thread = threading.Thread(target=lambda: None)
+        view._thread.start()
+        view._thread.join()
+        self.other.take_leadership('postgresql0')
+        self.assertEqual(view.cluster().leader_name, 'postgresql0')
+        self.assertTrue(view._thread.is_alive())
+
+    def test_catch_up(self):
+        view = self.client.cluster_view()
+        cluster = view.cluster()
+        self.other.take_leadership('postgresql0')
+        self.other.write_optime(100)
+        cluster = view.cluster()
+        self.assertEqual((cluster.leader_name, cluster.optime), ('postgresql0', 100))
+        self.assertEqual(cluster.index, self.store.index)
+        self.assertEqual(self.client.requests['load_scope'], 1)
+
+    def test_catch_up_after_missed_index(self):
+        self.client = Client(Store(history=2))
+        other = Client(self.client.store)
+        view = self.client.cluster_view()
+        view.cluster()
+        other.touch_member('postgresql0', Member('postgresql0', 'host:5432').to_value())
+        other.take_leadership('postgresql0')
+        other.write_optime(100)
+        cluster = view.cluster()
+        self.assertEqual((cluster.leader_name, cluster.optime), ('postgresql0', 100))
+        self.assertEqual(list(cluster.members), ['postgresql0'])
+        self.assertEqual(self.client.requests['load_scope'], 2)
+
+
+class TestHaWait(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        super(TestHaWait, self).__init__(method_name)
+
+    def set_up(self):
+        self.store = Store()
+        self.dcs = Client(self.store)
+        self.dcs.touch_member('postgresql0', Member('postgresql0', 'host:5432').to_value())
+        self.ha = Ha(Namespace(name='postgresql1'), self.dcs)
+        self.ha.view = ClusterView(self.dcs)
+        self.ha.refresh_cluster()
+
+    def test_watch(self):
+        Client(self.store).take_leadership('postgresql0')
+        self.assertTrue(self.ha.wait_for_change(5))
+
+    def test_without_watch(self):
+        Client(self.store).take_leadership('postgresql0')
+        self.assertFalse(self.ha.wait_for_change(0.3, watch=False))
+        self.ha.view.wake()
+        self.assertTrue(self.ha.wait_for_change(5, watch=False))
+
+    def test_switchover_target_watches(self):
+        other = Client(self.store)
+        other.take_leadership('postgresql0')
+        other.create_key(AbstractDCS.SWITCHOVER_KEY, '{"leader":"postgresql0","target":"postgresql1"}', 30)
+        self.assertTrue(self.ha.wait_for_change(5))
+        self.ha.refresh_cluster()
+        other.transfer_leadership('postgresql0', 'postgresql1')
+        self.assertTrue(self.ha.wait_for_change(5, watch=False))